@@ -1,192 +1,3597 @@
 # Author(s): Dr. Patrick Lemoine
 
-import webview
-import requests
+import time
+_STARTUP_T0 = time.perf_counter()
 import json
 import socket
 import os
 import sys
-from geopy.geocoders import Nominatim
-import requests
-import json
+import math
+import re
+import hashlib
+import functools
+import struct
+import mmap
+import sqlite3
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import xml.etree.ElementTree as ET
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+# webview, requests and geopy are imported where they are used so a cached launch does not pay
+# for modules it never touches.
+
+def internet_connection_1(url=None, timeout=5):
+    import requests
+    url = url or ENDPOINTS["connectivity"]
+    try:
+        _ = requests.head(url, timeout=timeout)
+        return True
+    except requests.RequestException:
+        return False
+
+def internet_connection_2(host="8.8.8.8", port=53, timeout=3):
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+class ConnectivityProbe:
+    # Runs both connectivity checks in background threads; the first positive answer wins.
+    def __init__(self, checks=(internet_connection_1, internet_connection_2)):
+        self.checks = checks
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.pending = len(checks)
+        self.online = None
+
+    def start(self):
+        for check in self.checks:
+            threading.Thread(target=self._run, args=(check,), daemon=True).start()
+        return self
+
+    def _run(self, check):
+        try:
+            ok = check()
+        except Exception:
+            ok = False
+        with self.lock:
+            self.pending -= 1
+            if ok and not self.online:
+                self.online = True
+                self.event.set()
+            elif self.pending == 0 and self.online is None:
+                self.online = False
+                self.event.set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return bool(self.online)
+
+    def offline_known(self):
+        # True only once every check has failed; an unfinished probe counts as online.
+        return self.event.is_set() and not self.online
+
+
+class StartupTimer:
+    # Per-phase wall-clock breakdown of the launch, measured from module import.
+    def __init__(self, t0=_STARTUP_T0):
+        self.t0 = t0
+        self.last = t0
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        metrics.event(f"startup.{name}", ms=round((now - self.last) * 1000, 3))
+        self.last = now
+
+    def report(self, budget_ms=0):
+        total_ms = (self.last - self.t0) * 1000
+        print("Startup timing:")
+        for name, seconds in self.phases:
+            print(f"  {name:<16} {seconds * 1000:8.1f} ms")
+        print(f"  {'total':<16} {total_ms:8.1f} ms")
+        if budget_ms and total_ms > budget_ms:
+            print(f"WARNING: startup took {total_ms:.0f} ms, over the {budget_ms} ms budget")
+        return total_ms
+
+    def save(self, path, **extra):
+        # JSON copy of the breakdown (--StartupReport), e.g. for the benchmarks.
+        report = {"phases_ms": {name: round(seconds * 1000, 2) for name, seconds in self.phases},
+                  "total_ms": round((self.last - self.t0) * 1000, 2), **extra}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+
+# --- INSTRUMENTATION ---
+class Metrics:
+    # Named spans and counters for the whole process. Spans are timed (wall ms, and self ms: minus
+    # the child spans opened on the same thread) and totalled per name. With a JSON lines sink
+    # (--Metrics) every finished span, every event (e.g. viewer timings) and, at close, the counters
+    # and totals are appended as one record each.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {}
+        self.totals = {}
+        self.sink = None
+
+    def open(self, path):
+        self.sink = open(path, "a", encoding="utf-8")
+        self._emit({"type": "start", "pid": os.getpid(), "argv": sys.argv[1:]})
+
+    def _emit(self, record):
+        record["t"] = round(time.time(), 4)
+        line = json.dumps(record, default=str)
+        with self.lock:
+            if self.sink is not None:
+                self.sink.write(line + "\n")
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _observe(self, name, ms, self_ms):
+        with self.lock:
+            total = self.totals.setdefault(name, [0, 0.0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += ms
+            total[2] += self_ms
+            total[3] = max(total[3], ms)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        # The yielded dict takes attributes known only at the end (bytes, counts...).
+        stack = self.local.__dict__.setdefault("stack", [])
+        frame = [name, 0.0]
+        stack.append(frame)
+        error = None
+        t0 = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            stack.pop()
+            if stack:
+                stack[-1][1] += ms
+            self._observe(name, ms, ms - frame[1])
+            if self.sink is not None:
+                record = {"type": "span", "name": name, "ms": round(ms, 3), "self_ms": round(ms - frame[1], 3),
+                          "parent": stack[-1][0] if stack else None, "thread": threading.current_thread().name, **attrs}
+                if error:
+                    record["error"] = error[:300]
+                self._emit(record)
+
+    def timed(self, name):
+        # Decorator: every call is a span.
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def event(self, name, ms=None, **fields):
+        if ms is not None:
+            self._observe(name, float(ms), float(ms))
+        if self.sink is not None:
+            self._emit({"type": "event", "name": name, "ms": ms, **fields})
+
+    def summary(self):
+        with self.lock:
+            spans = {name: {"count": c, "total_ms": round(t, 1), "self_ms": round(st, 1), "max_ms": round(m, 1)}
+                     for name, (c, t, st, m) in self.totals.items()}
+            return {"spans": spans, "counters": dict(self.counters)}
+
+    def report(self):
+        summary = self.summary()
+        print("Metrics:")
+        for name, span in sorted(summary["spans"].items(), key=lambda kv: -kv[1]["total_ms"]):
+            print(f"  {name:<28} {span['count']:6d} x {span['total_ms']:10.1f} ms (self {span['self_ms']:.1f}, max {span['max_ms']:.1f})")
+        for name, value in sorted(summary["counters"].items()):
+            print(f"  {name:<28} {value}")
+
+    def close(self):
+        if self.sink is not None:
+            self._emit({"type": "summary", **self.summary()})
+            with self.lock:
+                self.sink.close()
+                self.sink = None
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def profile_section(prefix):
+    # --Profile: cProfile of what runs inside (on this thread) in <prefix>.prof, a tracemalloc
+    # snapshot in <prefix>.tracemalloc, and the top functions / allocation sites of both in <prefix>.txt.
+    import cProfile
+    import pstats
+    import tracemalloc
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(f"{prefix}.prof")
+        snapshot.dump(f"{prefix}.tracemalloc")
+        with open(f"{prefix}.txt", "w", encoding="utf-8") as f:
+            f.write(f"tracemalloc: {current / 1e6:.1f} MB still allocated, peak {peak / 1e6:.1f} MB\n\n")
+            pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+            f.write("Top allocation sites:\n")
+            for stat in snapshot.statistics("lineno")[:30]:
+                f.write(f"  {stat}\n")
+        print(f"Profile written to {prefix}.prof, {prefix}.txt and {prefix}.tracemalloc")
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    # One pooled session shared by the city-info lookups so connections are reused across threads.
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+# Upstream base URLs, overridable from the command line (e.g. to run against local stand-ins).
+ENDPOINTS = {
+    "nominatim": "https://nominatim.openstreetmap.org",
+    "wikidata": "https://www.wikidata.org",
+    "wikidata-sparql": "https://query.wikidata.org",
+    "geonames": "http://api.geonames.org",
+    "open-meteo": "https://api.open-meteo.com",
+    "connectivity": "https://www.google.com",
+}
+
+# Requests per second and burst size allowed for each upstream (Nominatim usage policy: 1 req/s).
+DEFAULT_RATE_LIMITS = {
+    "nominatim": (1.0, 1),
+    "overpass": (1.0, 2),
+    "wikidata": (5.0, 5),
+    "geonames": (1.0, 2),
+    "open-meteo": (5.0, 5),
+}
+
+class RateLimiter:
+    # One token bucket per upstream, shared by every thread of the process. acquire() blocks until
+    # a token is available; upstreams without a configured rate are not limited.
+    def __init__(self, limits=None):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.configure(limits or {})
+
+    def configure(self, limits):
+        now = time.monotonic()
+        with self.lock:
+            for name, (rate, burst) in limits.items():
+                self.buckets[name] = [float(rate), float(burst), float(burst), now]
+
+    def acquire(self, name):
+        while True:
+            with self.lock:
+                bucket = self.buckets.get(name)
+                if bucket is None or bucket[0] <= 0:
+                    return
+                rate, burst, tokens, last = bucket
+                now = time.monotonic()
+                tokens = min(burst, tokens + (now - last) * rate)
+                if tokens >= 1.0:
+                    bucket[2], bucket[3] = tokens - 1.0, now
+                    return
+                bucket[2], bucket[3] = tokens, now
+                wait = (1.0 - tokens) / rate
+            metrics.count(f"ratelimit.{name}.wait_ms", round(wait * 1000))
+            time.sleep(wait)
+
+rate_limiter = RateLimiter(DEFAULT_RATE_LIMITS)
+
+
+# --- SHARED FILES ---
+# Several viewers and batch runs may share one --Path. Files are written under a name unique to the
+# writing process and thread, then renamed over the target, so readers only ever see a complete
+# old or new file; read-modify-write of a shared file happens under an advisory lock file.
+def temp_path(path):
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.part"
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    tmp_path = temp_path(path)
+    f = open(tmp_path, mode, **({} if "b" in mode else {"encoding": "utf-8"}))
+    try:
+        yield f
+        f.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        f.close()
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class FileLock:
+    # Exclusive advisory lock on `path` (created if needed), between processes as well as between
+    # threads holding separate FileLock objects: flock on POSIX, msvcrt.locking on Windows.
+    POLL = 0.05
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.name == "nt":
+                import msvcrt
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(self.POLL)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(fd)
+            if blocking:
+                raise
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is None:
+            return
+        if os.name == "nt":
+            import msvcrt
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class TTLCache:
+    # Small persistent key/value store where each entry carries its own expiry time. Entries set by
+    # other processes sharing the file are picked up on a miss (when the file changed) and merged
+    # in on save, so concurrent launches do not lose or repeat each other's lookups.
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = set()
+        self.mtime = None
+        self._reload()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _reload(self):
+        # Takes the entries from the file if it changed since last read, keeping the local unsaved ones.
+        if not self.path:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        entries = self._read()
+        entries.update({k: self.entries[k] for k in self.dirty if k in self.entries})
+        self.entries = entries
+        return True
+
+    def get(self, key, default=None):
+        kind = key.split(":", 1)[0]
+        with self.lock:
+            entry = self.entries.get(key)
+            if not (entry and entry["expires"] > time.time()) and self._reload():
+                entry = self.entries.get(key)
+            if entry and entry["expires"] > time.time():
+                metrics.count(f"cache.{kind}.hit")
+                return entry["value"]
+        metrics.count(f"cache.{kind}.miss")
+        return default
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = {"value": value, "expires": time.time() + ttl}
+            self.dirty.add(key)
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        with FileLock(f"{self.path}.lock"):
+            self.mtime = None
+            self._reload()
+            now = time.time()
+            self.entries = {k: e for k, e in self.entries.items() if e["expires"] > now}
+            with atomic_write(self.path) as f:
+                json.dump(self.entries, f)
+            self.mtime = os.stat(self.path).st_mtime_ns
+            self.dirty.clear()
+
+
+# Population (P1082) lookups ask for that one property only: wbgetclaims for a single city, one
+# SPARQL query per WIKIDATA_SPARQL_BATCH entities for batches, instead of the full entity document.
+WIKIDATA_USER_AGENT = "py-maptiler-webview"
+WIKIDATA_CITY_WORDS = ('city', 'commune', 'municipality', 'town', 'capital', 'metropolis')
+WIKIDATA_ENTITY_TTL = 180 * 86400
+WIKIDATA_SPARQL_BATCH = 50
+WIKIDATA_RANKS = {"preferred": 2, "normal": 1, "deprecated": 0}
+WIKIDATA_POPULATION_SPARQL = """
+SELECT ?item ?population ?date ?rank WHERE {{
+  VALUES ?item {{ {items} }}
+  ?item p:P1082 ?statement .
+  ?statement ps:P1082 ?population ; wikibase:rank ?rank .
+  OPTIONAL {{ ?statement pq:P585 ?date . }}
+}}"""
+
+# GeoNames fallback account (--GeoNamesUser); without one GeoNames is not asked.
+GEONAMES_USERNAME = os.environ.get("GEONAMES_USERNAME", "")
+
+def wikidata_get(endpoint, path, params, span_name, timeout=8):
+    rate_limiter.acquire("wikidata")
+    with metrics.span(span_name) as span:
+        resp = http_session().get(f"{ENDPOINTS[endpoint]}{path}", params=params, timeout=timeout,
+                                  headers={"User-Agent": WIKIDATA_USER_AGENT, "Accept": "application/json"})
+        span["bytes"] = len(resp.content)
+    metrics.count("http.wikidata.bytes", len(resp.content))
+    if resp.status_code != 200:
+        raise Exception(f"Wikidata error {resp.status_code}: {resp.text[:200]}")
+    return resp.json()
+
+def wikidata_city_entity(city, country=None, cache=None):
+    # Item id of a city: the first search result described as a city (commune, town...), one
+    # mentioning the country first, else the first result. Kept in `cache` (None when not found).
+    key = f"wikidata:{city.lower()}"
+    cached = cache.get(key) if cache else None
+    if cached is not None:
+        return cached or None
+    results = wikidata_get("wikidata", "/w/api.php", {
+        'action': 'wbsearchentities', 'search': city, 'language': 'en', 'format': 'json', 'type': 'item', 'limit': 7
+    }, "wikidata.search").get('search', [])
+    def rank(result):
+        description = result.get('description', '').lower()
+        is_city = any(word in description for word in WIKIDATA_CITY_WORDS)
+        return (is_city and bool(country) and country.lower() in description, is_city)
+    entity_id = max(results, key=rank)['id'] if results else None
+    if cache:
+        cache.set(key, entity_id or "", WIKIDATA_ENTITY_TTL if entity_id else CITY_POPULATION_RETRY_TTL)
+    return entity_id
+
+def pick_population(statements):
+    # statements: (rank, amount, point in time or None). The best ranked one wins, then the most
+    # recent; deprecated statements never count. Times compare as ISO strings ("2021-01-01T...").
+    statements = [s for s in statements if s[0] != "deprecated" and s[1] is not None]
+    if not statements:
+        return "-"
+    best = max(statements, key=lambda s: (WIKIDATA_RANKS.get(s[0], 1), s[2] or ""))
+    return str(int(float(best[1])))
+
+def wikidata_claims_population(entity_id):
+    # wbgetclaims returns the P1082 statements only.
+    claims = wikidata_get("wikidata", "/w/api.php", {
+        'action': 'wbgetclaims', 'entity': entity_id, 'property': 'P1082', 'format': 'json'
+    }, "wikidata.claims").get("claims", {}).get("P1082", [])
+    statements = []
+    for claim in claims:
+        value = claim.get("mainsnak", {}).get("datavalue", {}).get("value", {})
+        times = claim.get("qualifiers", {}).get("P585", [])
+        when = times[0].get("datavalue", {}).get("value", {}).get("time") if times else None
+        statements.append((claim.get("rank", "normal"), value.get("amount"), when.lstrip("+") if when else None))
+    return pick_population(statements)
+
+def wikidata_populations(entity_ids):
+    # {entity id: population or "-"}: one SPARQL query per WIKIDATA_SPARQL_BATCH ids, wbgetclaims
+    # per id when a batch fails (or for a single id).
+    entity_ids = list(dict.fromkeys(entity_ids))
+    if len(entity_ids) == 1:
+        return {entity_ids[0]: wikidata_claims_population(entity_ids[0])}
+    populations = {}
+    for start in range(0, len(entity_ids), WIKIDATA_SPARQL_BATCH):
+        chunk = entity_ids[start:start + WIKIDATA_SPARQL_BATCH]
+        try:
+            query = WIKIDATA_POPULATION_SPARQL.format(items=" ".join(f"wd:{q}" for q in chunk))
+            rows = wikidata_get("wikidata-sparql", "/sparql", {'query': query, 'format': 'json'},
+                                "wikidata.sparql", timeout=30)["results"]["bindings"]
+            statements = {q: [] for q in chunk}
+            for row in rows:
+                entity_id = row["item"]["value"].rsplit("/", 1)[-1]
+                rank = row["rank"]["value"].rsplit("#", 1)[-1].replace("Rank", "").lower()
+                when = row.get("date", {}).get("value")
+                statements.setdefault(entity_id, []).append((rank, row["population"]["value"], when))
+            populations.update({q: pick_population(found) for q, found in statements.items()})
+        except Exception as e:
+            print(f"Wikidata SPARQL failed ({str(e)[:200]}), asking the {len(chunk)} entities one by one")
+            for entity_id in chunk:
+                try:
+                    populations[entity_id] = wikidata_claims_population(entity_id)
+                except Exception:
+                    populations[entity_id] = "-"
+    return populations
+
+def get_wikidata_population(city, country=None, cache=None):
+    try:
+        entity_id = wikidata_city_entity(city, country, cache)
+        return wikidata_populations([entity_id])[entity_id] if entity_id else "-"
+    except Exception:
+        return "-"
+
+def get_geonames_population(city):
+    if not GEONAMES_USERNAME:
+        return "-"
+    try:
+        rate_limiter.acquire("geonames")
+        with metrics.span("geonames.search") as span:
+            geonames_resp = http_session().get(f"{ENDPOINTS['geonames']}/searchJSON",
+                                               params={'q': city, 'maxRows': 1, 'username': GEONAMES_USERNAME}, timeout=6)
+            span["bytes"] = len(geonames_resp.content)
+        metrics.count("http.geonames.bytes", len(geonames_resp.content))
+        return geonames_resp.json().get('geonames', [{}])[0].get('population', '-')
+    except Exception:
+        return "-"
+
+def resolve_populations(cities, cache, countries=None):
+    # Batch version of get_city_population for pre-warm runs: entity searches (cached), then the
+    # populations of all found entities in SPARQL batches, stored in `cache` under the keys
+    # get_city_infos reads. Cities already cached are skipped. Returns {city: population}.
+    countries = countries or {}
+    result = {}
+    entities = {}
+    for city in dict.fromkeys(cities):
+        cached = cache.get(f"population:{city.lower()}")
+        if cached is not None:
+            result[city] = cached
+            continue
+        try:
+            entities[city] = wikidata_city_entity(city, countries.get(city), cache)
+        except Exception as e:
+            print(f"Wikidata search failed for {city}: {e}")
+            entities[city] = None
+    found = {}
+    try:
+        found = wikidata_populations([q for q in entities.values() if q]) if any(entities.values()) else {}
+    except Exception as e:
+        print(f"Wikidata population lookup failed: {e}")
+    for city, entity_id in entities.items():
+        population = found.get(entity_id, "-") if entity_id else "-"
+        if population == "-":
+            population = get_geonames_population(city)
+        cache.set(f"population:{city.lower()}", population,
+                  CITY_POPULATION_TTL if population != "-" else CITY_POPULATION_RETRY_TTL)
+        result[city] = population
+    return result
+
+CITY_GEOCODE_TTL = 90 * 86400
+CITY_POPULATION_TTL = 30 * 86400
+CITY_POPULATION_RETRY_TTL = 3600
+WEATHER_TTL = 600
+
+def geocode_city(city, cache=None, offline=False, fallback="New York"):
+    key = f"geocode:{city.lower()}"
+    cached = cache.get(key) if cache else None
+    if cached:
+        return cached
+    if offline:
+        raise Exception(f"No cached location for {city} and no Internet connection")
+    from geopy.geocoders import Nominatim
+    from urllib.parse import urlsplit
+    endpoint = urlsplit(ENDPOINTS["nominatim"])
+    geolocator = Nominatim(user_agent="py-maptiler-webview", timeout=6,
+                           domain=endpoint.netloc + endpoint.path.rstrip("/"), scheme=endpoint.scheme)
+    rate_limiter.acquire("nominatim")
+    with metrics.span("nominatim.geocode", city=city):
+        loc = geolocator.geocode(city, exactly_one=True, addressdetails=True)
+    if not loc and fallback:
+        rate_limiter.acquire("nominatim")
+        with metrics.span("nominatim.geocode", city=fallback):
+            loc = geolocator.geocode(fallback, addressdetails=True)
+    if not loc:
+        raise Exception(f"City {city} not found")
+    address = loc.raw['address']
+    result = {
+        'lat': float(loc.latitude), 'lon': float(loc.longitude),
+        'country': address.get('country', '?'),
+        'region': address.get('state', address.get('region', '?'))
+    }
+    if cache:
+        cache.set(key, result, CITY_GEOCODE_TTL)
+    return result
+
+def cache_population(cache, key, population):
+    cache.set(key, population, CITY_POPULATION_TTL if population != "-" else CITY_POPULATION_RETRY_TTL)
+
+def get_city_population(city, country=None, cache=None):
+    population = get_wikidata_population(city, country, cache)
+    if population == "-":
+        population = get_geonames_population(city)
+    return population
+
+def get_current_weather(lat, lon):
+    rate_limiter.acquire("open-meteo")
+    with metrics.span("open-meteo.weather") as span:
+        weather_resp = http_session().get(f"{ENDPOINTS['open-meteo']}/v1/forecast",
+                                          params={'latitude': lat, 'longitude': lon, 'current_weather': 'true'}, timeout=6)
+        span["bytes"] = len(weather_resp.content)
+    metrics.count("http.open-meteo.bytes", len(weather_resp.content))
+    weather = weather_resp.json()['current_weather']
+    return {'temp': weather.get('temperature', '-'), 'wind': weather.get('windspeed', '-')}
+
+@metrics.timed("city.infos")
+def get_city_infos(city, cache=None, deadline=10, offline=False, cached_only=False):
+    # Geocodes first, then runs the population and weather lookups in parallel. Results are kept in
+    # `cache` (a TTLCache): geocode and population for weeks, weather for WEATHER_TTL seconds.
+    # Offline, only cached values are used; with cached_only, population and weather are not
+    # looked up either (a cache-first start fetches them afterwards).
+    geo = geocode_city(city, cache, offline)
+    lat, lon = geo['lat'], geo['lon']
+    population_key = f"population:{city.lower()}"
+    weather_key = f"weather:{lat:.3f},{lon:.3f}"
+    population = cache.get(population_key) if cache else None
+    weather = cache.get(weather_key) if cache else None
+    if offline or cached_only:
+        population = "-" if population is None else population
+        weather = {'temp': "-", 'wind': "-"} if weather is None else weather
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        jobs = {}
+        if population is None:
+            jobs['population'] = pool.submit(get_city_population, city, geo['country'], cache)
+        if weather is None:
+            jobs['weather'] = pool.submit(get_current_weather, lat, lon)
+        t_end = time.monotonic() + deadline
+        if 'population' in jobs:
+            try:
+                population = jobs['population'].result(timeout=max(0.0, t_end - time.monotonic()))
+                if cache:
+                    cache_population(cache, population_key, population)
+            except FutureTimeout:
+                # Nothing cached yet: the lookup goes on and caches its own answer.
+                population = "-"
+                if cache:
+                    jobs['population'].add_done_callback(
+                        lambda job: cache_population(cache, population_key, "-" if job.exception() else job.result()))
+            except Exception:
+                population = "-"
+                if cache:
+                    cache_population(cache, population_key, population)
+        if 'weather' in jobs:
+            try:
+                weather = jobs['weather'].result(timeout=max(0.0, t_end - time.monotonic()))
+                if cache:
+                    cache.set(weather_key, weather, WEATHER_TTL)
+            except Exception:
+                weather = {'temp': "-", 'wind': "-"}
+    finally:
+        pool.shutdown(wait=False)
+    return {
+        'lat': lat, 'lon': lon,
+        'country': geo['country'], 'region': geo['region'],
+        'population': population, 'temp': weather['temp'], 'wind': weather['wind'], 'city': city
+    }
+
+
+BUILDING_INFO_KEYS = [
+    'name', 'building', 'building:levels', 'height',
+    'roof:shape', 'roof:material', 'roof:height',
+    'addr:street', 'addr:housenumber', 'addr:postcode', 'addr:city',
+    'start_date', 'amenity', 'shop', 'office', 'industrial',
+    'website', 'brand', 'condition', 'surface', 'source'
+]
+
+def building_properties(tags):
+    properties_dict = {k: tags[k] for k in BUILDING_INFO_KEYS if k in tags}
+    for k, v in tags.items():
+        if k not in properties_dict:
+            properties_dict[k] = v
+    return properties_dict
+
+
+# Tags read by the viewer style and popup: the only ones carried by the building vector tiles
+# (--KeepTags viewer also cuts the cache down to them). The others stay in the cache and reach the
+# popup through the BuildingIndex.
+VIEWER_KEEP_TAGS = [
+    'name', 'building', 'building:levels', 'height', 'amenity',
+    'addr:street', 'addr:housenumber', 'addr:postcode', 'addr:city'
+]
+RENDER_PROPERTIES = ('render_height', 'render_min_height', 'render_levels')
+TILE_PROPERTIES = frozenset(VIEWER_KEEP_TAGS) | frozenset(RENDER_PROPERTIES)
+LEVEL_HEIGHT = 3.0
+DEFAULT_RENDER_HEIGHT = 30.0
+
+_LENGTH_RE = re.compile(r"""^\s*(\d+(?:[.,]\d+)?)\s*(m|meters?|metres?|ft|feet|'|)\s*(?:(\d+(?:\.\d+)?)\s*(?:"|in))?\s*$""", re.I)
+
+def parse_length(value):
+    # OSM length in metres: "12", "12 m", "12,5", "40 ft", "12'6\"". None when unparsable.
+    if value is None:
+        return None
+    m = _LENGTH_RE.match(str(value))
+    if not m:
+        return None
+    number = float(m.group(1).replace(",", "."))
+    if m.group(2).lower() in ("ft", "feet", "'"):
+        return (number * 12.0 + float(m.group(3) or 0.0)) * 0.0254
+    return number
+
+def parse_levels(value):
+    # "3", "3.5", "3;4" or "3-4" (highest wins). None when unparsable.
+    if value is None:
+        return None
+    numbers = re.findall(r"\d+(?:[.,]\d+)?", str(value))
+    return max(float(n.replace(",", ".")) for n in numbers) if numbers else None
+
+def normalize_building(tags, keep_tags=None):
+    # Numeric render_height / render_min_height (metres) and render_levels resolved once from
+    # height, building:levels, roof:height/roof:levels, min_height and building:min_level, then
+    # the tags projected on keep_tags (None keeps every tag).
+    height = parse_length(tags.get('height'))
+    levels = parse_levels(tags.get('building:levels'))
+    if height is None and levels is not None:
+        roof_height = parse_length(tags.get('roof:height'))
+        if roof_height is None and tags.get('roof:levels') is not None:
+            roof_height = (parse_levels(tags.get('roof:levels')) or 0.0) * LEVEL_HEIGHT
+        height = levels * LEVEL_HEIGHT + (roof_height or 0.0)
+    if height is None:
+        height = DEFAULT_RENDER_HEIGHT
+    min_height = parse_length(tags.get('min_height'))
+    if min_height is None and tags.get('building:min_level') is not None:
+        min_height = (parse_levels(tags.get('building:min_level')) or 0.0) * LEVEL_HEIGHT
+    if keep_tags is None:
+        props = building_properties(tags)
+    else:
+        props = {k: tags[k] for k in keep_tags if k in tags}
+    props['render_height'] = round(height, 2)
+    props['render_min_height'] = round(min(min_height or 0.0, height), 2)
+    if levels is not None:
+        props['render_levels'] = levels
+    return props
+
+
+class NodeStore:
+    # Node coordinates kept as packed int64 ids / float64 lon,lat instead of a str-keyed dict.
+    def __init__(self):
+        self._ids = array('q')
+        self._coords = array('d')
+        self.ids = None
+        self.coords = None
+
+    def __len__(self):
+        return len(self._ids) if self.ids is None else len(self.ids)
+
+    def add(self, node_id, lon, lat):
+        self._ids.append(node_id)
+        self._coords.append(lon)
+        self._coords.append(lat)
+
+    def freeze(self):
+        ids = np.frombuffer(self._ids, dtype=np.int64)
+        coords = np.frombuffer(self._coords, dtype=np.float64).reshape(-1, 2)
+        if self.ids is not None:
+            ids = np.concatenate((self.ids, ids))
+            coords = np.concatenate((self.coords, coords))
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.coords = coords[order]
+        self._ids = array('q')
+        self._coords = array('d')
+
+    def arrays(self):
+        if self.ids is None or len(self._ids):
+            self.freeze()
+        return self.ids, self.coords
+
+
+class WayBatch:
+    # A block of ways in flat form: node refs of way i are refs[offsets[i]:offsets[i+1]].
+    def __init__(self):
+        self.ids = array('q')
+        self.refs = array('q')
+        self.offsets = array('q', [0])
+        self.tags = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, way_id, refs, tags):
+        self.ids.append(way_id)
+        self.refs.extend(refs)
+        self.offsets.append(len(self.refs))
+        self.tags.append(tags)
+
+
+def assemble_polygons(node_ids, node_coords, refs, way_offsets):
+    # Resolves every way reference of a batch with one searchsorted pass over the sorted node ids.
+    # Returns (coords, ring_offsets, way_index): ring k is coords[ring_offsets[k]:ring_offsets[k+1]]
+    # and belongs to way way_index[k]. Unknown refs are dropped, ways left with < 3 coords are skipped,
+    # and open rings get their first coordinate appended.
+    refs = np.asarray(refs, dtype=np.int64)
+    way_offsets = np.asarray(way_offsets, dtype=np.int64)
+    n_ways = len(way_offsets) - 1
+    if len(node_ids) and len(refs):
+        idx = np.searchsorted(node_ids, refs)
+        np.minimum(idx, len(node_ids) - 1, out=idx)
+        found = node_ids[idx] == refs
+    else:
+        idx = np.zeros(len(refs), dtype=np.intp)
+        found = np.zeros(len(refs), dtype=bool)
+    way_of_ref = np.repeat(np.arange(n_ways), np.diff(way_offsets))
+    counts = np.bincount(way_of_ref[found], minlength=n_ways)
+    keep = counts >= 3
+    pts = node_coords[idx[found & keep[way_of_ref]]]
+    coords, ring_offsets = close_rings(pts, counts[keep])
+    return coords, ring_offsets, np.flatnonzero(keep)
+
+def close_rings(pts, counts):
+    # Packs consecutive point runs of `counts` into rings, appending the first point to open ones.
+    starts = np.cumsum(counts) - counts
+    ends = starts + counts - 1
+    need_close = np.any(pts[starts] != pts[ends], axis=1)
+    ring_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts + need_close, out=ring_offsets[1:])
+    shift = np.repeat(np.cumsum(need_close) - need_close, counts)
+    coords = np.empty((ring_offsets[-1], 2), dtype=np.float64)
+    coords[np.arange(len(pts)) + shift] = pts
+    coords[ring_offsets[1:][need_close] - 1] = pts[starts[need_close]]
+    return coords, ring_offsets
+
+
+class GeometryBatch:
+    # A block of ways with inline coordinates (Overpass `out geom`): way i has the points
+    # coords[offsets[i]:offsets[i+1]] (lon, lat pairs).
+    def __init__(self):
+        self.ids = array('q')
+        self.coords = array('d')
+        self.offsets = array('q', [0])
+        self.tags = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, way_id, flat_coords, tags):
+        self.ids.append(way_id)
+        self.coords.extend(flat_coords)
+        self.offsets.append(len(self.coords) // 2)
+        self.tags.append(tags)
+
+
+def stitch_rings(segments):
+    # Joins member way segments end to end into closed rings; chains that never close are dropped.
+    by_end = {}
+    for k, seg in enumerate(segments):
+        by_end.setdefault(tuple(seg[0]), []).append(k)
+        by_end.setdefault(tuple(seg[-1]), []).append(k)
+    used = [False] * len(segments)
+    rings = []
+    for k, seg in enumerate(segments):
+        if used[k]:
+            continue
+        used[k] = True
+        parts = [seg]
+        start, end = tuple(seg[0]), tuple(seg[-1])
+        while start != end:
+            nxt = next((j for j in by_end.get(end, ()) if not used[j]), None)
+            if nxt is None:
+                break
+            used[nxt] = True
+            following = segments[nxt] if tuple(segments[nxt][0]) == end else segments[nxt][::-1]
+            parts.append(following[1:])
+            end = tuple(following[-1])
+        if start == end and sum(len(p) for p in parts) >= 4:
+            rings.append(np.concatenate(parts))
+    return rings
+
+def point_in_ring(ring, x, y):
+    ax, ay, bx, by = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((ay > y) != (by > y)) & (x < ax + (bx - ax) * (y - ay) / (by - ay))
+    return bool(np.count_nonzero(crosses) % 2)
+
+def assemble_multipolygon(members):
+    # members: (role, (k, 2) coords) of a multipolygon relation. Returns the rings ordered as
+    # outer, its inners, next outer, ... with their exterior flags; inners outside every outer are dropped.
+    outers = stitch_rings([c for role, c in members if role != "inner" and len(c) >= 2])
+    inners = stitch_rings([c for role, c in members if role == "inner" and len(c) >= 2])
+    holes = [[] for _ in outers]
+    for inner in inners:
+        owner = next((k for k, outer in enumerate(outers) if point_in_ring(outer, inner[0, 0], inner[0, 1])), None)
+        if owner is not None:
+            holes[owner].append(inner)
+    rings, exterior = [], []
+    for outer, inner_rings in zip(outers, holes):
+        rings += [outer] + inner_rings
+        exterior += [True] + [False] * len(inner_rings)
+    return rings, exterior
+
+def rings_geometry(rings, exterior):
+    # GeoJSON Polygon (one exterior ring) or MultiPolygon from rings in store order.
+    polygons = []
+    for ring, is_exterior in zip(rings, exterior):
+        if is_exterior or not polygons:
+            polygons.append([])
+        polygons[-1].append(ring.tolist() if isinstance(ring, np.ndarray) else ring)
+    if len(polygons) == 1:
+        return {"type": "Polygon", "coordinates": polygons[0]}
+    return {"type": "MultiPolygon", "coordinates": polygons}
+
+
+# --ExportExtended: exported features also carry the OSM id ("id", negative for relations) and the
+# render_* properties. By default they keep the original schema: geometry and OSM tags only.
+GEOJSON_EXTENDED = False
+
+class GeoJSONFeatureWriter:
+    # Writes a FeatureCollection one Feature at a time, byte-identical to json.dump of the whole dict.
+    # The file is built under a temporary name and only renamed to `path` once closed cleanly.
+    PREFIX = '{"type": "FeatureCollection", "features": ['
+    SUFFIX = ']}'
+
+    def __init__(self, path, extended=None):
+        self.path = path
+        self.extended = GEOJSON_EXTENDED if extended is None else extended
+        self.tmp_path = temp_path(path)
+        self.f = open(self.tmp_path, "w", encoding="utf-8")
+        self.f.write(self.PREFIX)
+        self.count = 0
+
+    def write(self, feature):
+        if self.count:
+            self.f.write(", ")
+        self.f.write(json.dumps(feature))
+        self.count += 1
+
+    def feature(self, way_id, geometry, properties):
+        if self.extended:
+            return {"type": "Feature", "id": way_id, "geometry": geometry, "properties": properties}
+        return {"type": "Feature", "geometry": geometry,
+                "properties": {k: v for k, v in properties.items() if k not in RENDER_PROPERTIES}}
+
+    @metrics.timed("serialize.geojson")
+    def write_polygons(self, coords, ring_offsets, way_ids, properties, ring_exterior=None, feature_rings=None):
+        # Bulk entry point shared with BuildingStoreWriter: one single-ring polygon per way unless
+        # feature_rings / ring_exterior group the rings into (multi)polygons.
+        coords = coords.tolist()
+        ring_offsets = ring_offsets.tolist()
+        for k, way_id in enumerate(way_ids.tolist()):
+            if feature_rings is None:
+                geometry = {"type": "Polygon", "coordinates": [coords[ring_offsets[k]:ring_offsets[k + 1]]]}
+            else:
+                rings = range(feature_rings[k], feature_rings[k + 1])
+                geometry = rings_geometry([coords[ring_offsets[r]:ring_offsets[r + 1]] for r in rings],
+                                          [bool(ring_exterior[r]) for r in rings])
+            self.write(self.feature(way_id, geometry, properties[k]))
+
+    def close(self):
+        self.f.write(self.SUFFIX)
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+        metrics.count("write.geojson.bytes", os.path.getsize(self.path))
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def iter_overpass_elements(stream, meta=None):
+    # Incremental parse of an Overpass XML response: yields
+    # ("node", id, lon, lat) and ("way", id, node_refs, tags) while the body is still downloading,
+    # or, for `out geom` output, ("way_geom", id, [lon, lat, lon, lat, ...], tags) and
+    # ("relation", id, [(role, (k, 2) coords), ...], tags) with the member way geometries.
+    # The data timestamp (osm_base) and any remark are stored in the `meta` dict when given.
+    meta = {} if meta is None else meta
+    context = ET.iterparse(stream, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event != "end":
+            continue
+        if elem.tag == "meta":
+            meta["osm_base"] = elem.get("osm_base")
+        elif elem.tag == "node":
+            yield "node", int(elem.get("id")), float(elem.get("lon")), float(elem.get("lat"))
+            root.clear()
+        elif elem.tag == "way":
+            nds = elem.findall("nd")
+            tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+            if nds and nds[0].get("lat") is not None:
+                flat = [float(v) for nd in nds for v in (nd.get("lon"), nd.get("lat"))]
+                yield "way_geom", int(elem.get("id")), flat, tags
+            else:
+                yield "way", int(elem.get("id")), [int(nd.get("ref")) for nd in nds], tags
+            root.clear()
+        elif elem.tag == "relation":
+            members = [(m.get("role"), np.array([(float(nd.get("lon")), float(nd.get("lat"))) for nd in m.iter("nd")],
+                                                dtype=np.float64).reshape(-1, 2))
+                       for m in elem.iter("member") if m.get("type") == "way"]
+            tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+            yield "relation", int(elem.get("id")), members, tags
+            root.clear()
+        elif elem.tag == "remark":
+            meta["remark"] = (elem.text or "").strip()
+            print(f"Overpass remark: {meta['remark'][:200]}")
+            root.clear()
+
+def iter_overpass_deleted_ids(stream, meta=None):
+    # Feature ids under the "delete" actions of an Overpass [adiff:...] response: ways (and
+    # relations, negated) that were in the queried set at the diff date and are not any more
+    # (deleted, untagged or moved away).
+    meta = {} if meta is None else meta
+    action = None
+    context = ET.iterparse(stream, events=("start", "end"))
+    _, root = next(context)
+    for event, elem in context:
+        if event == "start":
+            if elem.tag == "action":
+                action = elem.get("type")
+            continue
+        if elem.tag == "meta":
+            meta["osm_base"] = elem.get("osm_base")
+        elif elem.tag in ("way", "relation") and action == "delete":
+            yield int(elem.get("id")) * (-1 if elem.tag == "relation" else 1)
+        elif elem.tag == "action":
+            action = None
+            root.clear()
+        elif elem.tag == "remark":
+            meta["remark"] = (elem.text or "").strip()
+
+
+WAY_BATCH_SIZE = 4096
+
+@metrics.timed("extract.join")
+def write_way_batch(nodes, batch, writer, keep_tags=None):
+    if not len(batch):
+        return 0
+    node_ids, node_coords = nodes.arrays()
+    coords, ring_offsets, way_index = assemble_polygons(node_ids, node_coords, batch.refs, batch.offsets)
+    way_ids = np.frombuffer(batch.ids, dtype=np.int64)[way_index]
+    properties = [normalize_building(batch.tags[i], keep_tags) for i in way_index.tolist()]
+    writer.write_polygons(coords, ring_offsets, way_ids, properties)
+    return len(way_index)
+
+
+@metrics.timed("extract.rings")
+def write_geometry_batch(batch, writer, keep_tags=None):
+    # Ways that came with inline coordinates: no node join, just ring closing.
+    if not len(batch):
+        return 0
+    pts = np.frombuffer(batch.coords, dtype=np.float64).reshape(-1, 2)
+    counts = np.diff(np.frombuffer(batch.offsets, dtype=np.int64))
+    keep = counts >= 3
+    coords, ring_offsets = close_rings(pts[np.repeat(keep, counts)], counts[keep])
+    way_index = np.flatnonzero(keep)
+    way_ids = np.frombuffer(batch.ids, dtype=np.int64)[way_index]
+    properties = [normalize_building(batch.tags[i], keep_tags) for i in way_index.tolist()]
+    writer.write_polygons(coords, ring_offsets, way_ids, properties)
+    return len(way_index)
+
+
+@metrics.timed("extract.relations")
+def write_relations(relations, writer, keep_tags=None):
+    # Multipolygon relations, stored under their negated id (as osm2pgsql does) so they never
+    # collide with way ids.
+    rings, exterior, feature_rings, ids, properties = [], [], [0], [], []
+    for relation_id, members, tags in relations:
+        if tags.get("type") != "multipolygon":
+            continue
+        polygon_rings, polygon_exterior = assemble_multipolygon(members)
+        if not polygon_rings:
+            continue
+        rings += polygon_rings
+        exterior += polygon_exterior
+        feature_rings.append(len(rings))
+        ids.append(-relation_id)
+        properties.append(normalize_building(tags, keep_tags))
+    if not ids:
+        return 0
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rings], out=ring_offsets[1:])
+    writer.write_polygons(np.concatenate(rings), ring_offsets, np.array(ids, dtype=np.int64), properties,
+                          np.array(exterior, dtype=np.uint8), np.array(feature_rings, dtype=np.int64))
+    return len(ids)
+
+
+def write_osm_building_features(elements, writer, batch_size=WAY_BATCH_SIZE, keep_tags=None):
+    # The self time of the extract.features span is the XML parse (and the wait for the body).
+    with metrics.span("extract.features") as span:
+        count = _write_osm_building_features(elements, writer, batch_size, keep_tags)
+        span["features"] = count
+    metrics.count("features.emitted", count)
+    return count
+
+def _write_osm_building_features(elements, writer, batch_size, keep_tags):
+    nodes = NodeStore()
+    batch = WayBatch()
+    geometries = GeometryBatch()
+    relations = []
+    count = 0
+    for elem in elements:
+        kind = elem[0]
+        if kind == "node":
+            nodes.add(elem[1], elem[2], elem[3])
+        elif kind == "way":
+            batch.add(elem[1], elem[2], elem[3])
+            if len(batch) >= batch_size:
+                count += write_way_batch(nodes, batch, writer, keep_tags)
+                batch = WayBatch()
+        elif kind == "way_geom":
+            geometries.add(elem[1], elem[2], elem[3])
+            if len(geometries) >= batch_size:
+                count += write_geometry_batch(geometries, writer, keep_tags)
+                geometries = GeometryBatch()
+        elif kind == "relation":
+            relations.append(elem[1:])
+            if len(relations) >= batch_size:
+                count += write_relations(relations, writer, keep_tags)
+                relations = []
+    count += write_way_batch(nodes, batch, writer, keep_tags)
+    count += write_geometry_batch(geometries, writer, keep_tags)
+    count += write_relations(relations, writer, keep_tags)
+    return count
+
+
+# Nodes are output before the ways so every way can be resolved and written as soon as it is parsed.
+OVERPASS_BUILDINGS_QUERY = """
+    [out:xml][timeout:90];
+    way["building"]({bbox})->.w;
+    node(w.w);
+    out skel qt;
+    .w out body;
+    """
+
+# Inline geometry: every way carries its coordinates (no node ids, no client-side join) and
+# building multipolygon relations come with their member way geometries.
+OVERPASS_GEOM_BUILDINGS_QUERY = """
+    [out:xml][timeout:90];
+    way["building"]({bbox});
+    out tags geom qt;
+    relation["building"]["type"="multipolygon"]({bbox});
+    out body geom qt;
+    """
+
+# Incremental refresh since a previous osm_base: ways gone from the building set (adiff), then the
+# building ways edited since, or whose nodes were moved, with the same layout as the full query.
+OVERPASS_DELETED_BUILDINGS_QUERY = """
+    [out:xml][timeout:90][adiff:"{since}"];
+    way["building"]({bbox});
+    out ids;
+    """
+
+OVERPASS_CHANGED_BUILDINGS_QUERY = """
+    [out:xml][timeout:90];
+    (
+      way["building"]({bbox})(newer:"{since}");
+      node({bbox})(newer:"{since}");
+      way(bn)["building"];
+    )->.c;
+    way.c["building"]->.w;
+    node(w.w);
+    out skel qt;
+    .w out body;
+    """
+
+OVERPASS_GEOM_DELETED_BUILDINGS_QUERY = """
+    [out:xml][timeout:90][adiff:"{since}"];
+    (
+      way["building"]({bbox});
+      relation["building"]["type"="multipolygon"]({bbox});
+    );
+    out ids;
+    """
+
+OVERPASS_GEOM_CHANGED_BUILDINGS_QUERY = """
+    [out:xml][timeout:90];
+    node({bbox})(newer:"{since}")->.n;
+    way({bbox})(newer:"{since}")->.cw;
+    (way(bn.n); .cw;)->.w;
+    way.w["building"];
+    out tags geom qt;
+    (
+      relation(bw.w)["building"]["type"="multipolygon"];
+      relation["building"]["type"="multipolygon"]({bbox})(newer:"{since}");
+    );
+    out body geom qt;
+    """
+
+# --OverpassMode: full extraction, removed features and changed features queries.
+OVERPASS_QUERY_MODES = {
+    "geom": {"full": OVERPASS_GEOM_BUILDINGS_QUERY, "deleted": OVERPASS_GEOM_DELETED_BUILDINGS_QUERY,
+             "changed": OVERPASS_GEOM_CHANGED_BUILDINGS_QUERY},
+    "nodes": {"full": OVERPASS_BUILDINGS_QUERY, "deleted": OVERPASS_DELETED_BUILDINGS_QUERY,
+              "changed": OVERPASS_CHANGED_BUILDINGS_QUERY},
+}
+
+OVERPASS_URLS = [
+    "https://overpass-api.de/api/interpreter",
+    "https://overpass.kumi.systems/api/interpreter",
+    "https://z.overpass-api.de/api/interpreter"
+]
+
+TILE_ROUTING = "anchor"
+
+def overpass_query_hash(template=OVERPASS_GEOM_BUILDINGS_QUERY, keep_tags=None):
+    # Identifies what a cache tile was built from: the query, the tag projection and the way
+    # buildings are routed to tiles (TileFeatureRouter).
+    projection = "*" if keep_tags is None else ",".join(keep_tags)
+    return hashlib.sha1(f"{template}|{projection}|{TILE_ROUTING}".encode("utf-8")).hexdigest()
+
+
+def geocode_nominatim(city, headers, timeout=10):
+    rate_limiter.acquire("nominatim")
+    with metrics.span("nominatim.search", city=city) as span:
+        resp_nom_raw = http_session().get(f"{ENDPOINTS['nominatim']}/search", params={'q': city, 'format': 'json'},
+                                          headers=headers, timeout=timeout)
+        span["bytes"] = len(resp_nom_raw.content)
+    metrics.count("http.nominatim.bytes", len(resp_nom_raw.content))
+    if resp_nom_raw.status_code != 200:
+        raise Exception(f"Nominatim error {resp_nom_raw.status_code}: {resp_nom_raw.text[:200]}")
+    resp_nom = resp_nom_raw.json()
+    if not resp_nom:
+        raise Exception(f"City {city} not found or no data found!")
+    return float(resp_nom[0]["lat"]), float(resp_nom[0]["lon"])
+
+
+class OverpassMirrorPool:
+    # Hedged Overpass requests: the best-scored mirror is asked first and the next one is started
+    # whenever the current one has not answered within the latency percentile of the fastest
+    # healthy mirror (or has failed). Mirrors never measured are assumed fast, so each one gets
+    # tried. Per-mirror latency history, error rate and 429/504 back-off are persisted to state_path;
+    # like TTLCache, a save merges under a FileLock: the outcomes recorded here since the last save
+    # are replayed over the file, so processes sharing it keep each other's observations.
+    HISTORY = 20
+    UNMEASURED_LATENCY = 1.0
+    DEFAULT_BACKOFF = 60.0
+
+    def __init__(self, urls, state_path=None, hedge_percentile=90, min_hedge=2.0, max_hedge=30.0, timeout=120):
+        self.urls = list(urls)
+        self.state_path = state_path
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge = min_hedge
+        self.max_hedge = max_hedge
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        saved = self._read()
+        self.state = {url: saved.get(url, {"latencies": [], "errors": 0.0, "backoff_until": 0.0}) for url in self.urls}
+        self.busy = {url: 0 for url in self.urls}  # requests waiting for their answer, per mirror
+        self.unsaved = {}  # url -> latencies (None for a failure) recorded since the last save
+
+    def _read(self):
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        # Called under the lock.
+        if not self.state_path:
+            self.unsaved.clear()
+            return
+        with FileLock(f"{self.state_path}.lock"):
+            shared = self._read()
+            for url in self.urls:
+                if url not in shared:
+                    shared[url] = self.state[url]
+                    continue
+                st = dict(shared[url])
+                for latency in self.unsaved.get(url, []):
+                    self._apply(st, latency)
+                st["backoff_until"] = max(st["backoff_until"], self.state[url]["backoff_until"])
+                shared[url] = self.state[url] = st
+            with atomic_write(self.state_path) as f:
+                json.dump(shared, f)
+        self.unsaved.clear()
+
+    def score(self, url):
+        st = self.state[url]
+        latency = float(np.median(st["latencies"])) if st["latencies"] else self.UNMEASURED_LATENCY
+        # Concurrent queries (parallel extraction blocks) spread over the mirrors.
+        return latency * (1.0 + 4.0 * st["errors"]) * (1 + self.busy[url])
+
+    def ranked(self):
+        now = time.time()
+        with self.lock:
+            ready = sorted((u for u in self.urls if self.state[u]["backoff_until"] <= now), key=self.score)
+            waiting = sorted((u for u in self.urls if self.state[u]["backoff_until"] > now),
+                             key=lambda u: self.state[u]["backoff_until"])
+        if not ready and waiting:
+            delay = min(self.state[waiting[0]]["backoff_until"] - now, self.DEFAULT_BACKOFF)
+            print(f"Overpass: every mirror asked to back off, waiting {delay:.0f} s")
+            time.sleep(max(0.0, delay))
+        return ready + waiting
+
+    def hedge_delay(self):
+        # Percentile of the fastest healthy mirror: a slow mirror is hedged once it is slower than
+        # the best one would have been, not after its own (slow) history.
+        now = time.time()
+        with self.lock:
+            delays = [float(np.percentile(st["latencies"], self.hedge_percentile)) for st in self.state.values()
+                      if st["latencies"] and st["backoff_until"] <= now]
+        return min(max(min(delays, default=self.min_hedge), self.min_hedge), self.max_hedge)
+
+    def _apply(self, st, latency):
+        # One outcome: a latency, or None for a failure.
+        if latency is not None:
+            st["latencies"] = (st["latencies"] + [round(latency, 3)])[-self.HISTORY:]
+            st["errors"] *= 0.7
+        else:
+            st["errors"] = st["errors"] * 0.7 + 0.3
+
+    def record(self, url, latency=None, status=None, retry_after=None):
+        with self.lock:
+            st = self.state[url]
+            self._apply(st, latency)
+            self.unsaved.setdefault(url, []).append(latency)
+            if status in (429, 504):
+                st["backoff_until"] = time.time() + (retry_after or self.DEFAULT_BACKOFF)
+            self._save()
+
+    @staticmethod
+    def _retry_after(resp):
+        try:
+            return float(resp.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+
+    def _attempt(self, url, query, headers, results):
+        import requests
+        t0 = time.monotonic()
+        try:
+            resp = requests.post(url, data={"data": query}, headers=headers, timeout=self.timeout, stream=True)
+        except Exception as ex:
+            results.put((url, None, ex, time.monotonic() - t0))
+            return
+        results.put((url, resp, None, time.monotonic() - t0))
+
+    def _settle(self, url, resp, ex, elapsed):
+        # Records the outcome of one attempt; returns the response only when it can be used.
+        with self.lock:
+            self.busy[url] -= 1
+        if ex is not None:
+            print(f"Erreur Overpass sur {url} : {ex}")
+            metrics.count("overpass.errors")
+            self.record(url)
+            return None
+        if resp.status_code != 200:
+            print(f"Instance {url} code {resp.status_code}")
+            metrics.count(f"overpass.status_{resp.status_code}")
+            self.record(url, status=resp.status_code, retry_after=self._retry_after(resp))
+            return None
+        self.record(url, latency=elapsed)
+        return resp
+
+    def _drain(self, results, pending):
+        for _ in range(pending):
+            url, resp, ex, elapsed = results.get()
+            self._settle(url, resp, ex, elapsed)
+            if resp is not None:
+                resp.close()
+
+    def fetch(self, query, headers):
+        order = self.ranked()
+        results = queue.Queue()
+        started = pending = 0
+        winner = last_error = None
+        deadline = None
+        failed = False
+        while winner is None and (pending or started < len(order)):
+            if started < len(order) and (pending == 0 or failed or time.monotonic() >= deadline):
+                if pending and not failed:
+                    print(f"Overpass: no answer within {hedge:.1f} s, hedging on {order[started]}")
+                    metrics.count("overpass.hedges")
+                if started:
+                    metrics.count("overpass.retries")
+                with self.lock:
+                    self.busy[order[started]] += 1
+                threading.Thread(target=self._attempt, args=(order[started], query, headers, results), daemon=True).start()
+                hedge = self.hedge_delay()
+                deadline = time.monotonic() + hedge
+                failed = False
+                started += 1
+                pending += 1
+            wait = max(0.0, deadline - time.monotonic()) if started < len(order) else None
+            try:
+                url, resp, ex, elapsed = results.get(timeout=wait)
+            except queue.Empty:
+                continue
+            pending -= 1
+            winner = self._settle(url, resp, ex, elapsed)
+            if winner is None:
+                failed = True
+                if resp is not None:
+                    last_error = f"{resp.status_code}: {resp.text[:200]}"
+                    resp.close()
+        if pending:
+            threading.Thread(target=self._drain, args=(results, pending), daemon=True).start()
+        if winner is None:
+            raise Exception(f"Overpass error {last_error or '-: No response'}")
+        return winner
+
+
+overpass_mirrors = OverpassMirrorPool(OVERPASS_URLS)
+
+@contextmanager
+def fetch_overpass(query, headers):
+    # `with fetch_overpass(...) as resp_ov`: the response of the first mirror to answer, body not
+    # read yet. The overpass.request span ends at the response headers; the bytes and the time
+    # spent streaming the body are recorded when the block exits.
+    rate_limiter.acquire("overpass")
+    with metrics.span("overpass.request") as span:
+        resp_ov = overpass_mirrors.fetch(query, headers)
+        span["mirror"] = resp_ov.url
+    resp_ov.raw.decode_content = True
+    t0 = time.perf_counter()
+    try:
+        with resp_ov:
+            yield resp_ov
+    finally:
+        size = resp_ov.raw.tell()
+        metrics.count("overpass.bytes", size)
+        metrics.event("overpass.body", ms=round((time.perf_counter() - t0) * 1000, 3), bytes=size, mirror=resp_ov.url)
+
+
+# --- BINARY BUILDING STORE ---
+# Columnar file: 8-byte magic, uint64 header length, JSON header, then 8-byte aligned little-endian
+# columns. Rings keep their closing point; feature i owns rings feature_rings[i]:feature_rings[i+1],
+# ring r owns coords ring_offsets[r]:ring_offsets[r+1], and ring_exterior flags the rings that start
+# a new polygon. Tags are (key, value) indexes into one deduplicated string table.
+BUILDING_STORE_MAGIC = b"BLDGSTR1"
+
+def lonlat_to_tile_array(lon, lat, zoom):
+    n = 2 ** zoom
+    x = ((np.asarray(lon) + 180.0) / 360.0 * n).astype(np.int64)
+    y = ((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n).astype(np.int64)
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+def take_rings(coords, ring_offsets, index):
+    # Sub-selects rings `index` from a (coords, ring_offsets) pair.
+    counts = np.diff(ring_offsets)[index]
+    new_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    pos = np.repeat(ring_offsets[:-1][index] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return coords[pos], new_offsets
+
+def feature_ring_index(feature_rings, features):
+    # Ring indexes of `features` (in order) and the number of rings of each.
+    counts = feature_rings[1:][features] - feature_rings[:-1][features]
+    first = np.repeat(feature_rings[:-1][features] - np.cumsum(counts) + counts, counts)
+    return first + np.arange(counts.sum()), counts
+
+def ring_centroids(coords, ring_offsets):
+    # Vertex mean of each closed ring, closing point excluded.
+    if len(ring_offsets) < 2:
+        return np.empty((0, 2), dtype=np.float64)
+    sums = np.add.reduceat(coords, ring_offsets[:-1], axis=0) - coords[ring_offsets[1:] - 1]
+    return sums / (np.diff(ring_offsets) - 1)[:, None]
+
+def ring_anchors(coords, ring_offsets):
+    # A point on each closed ring's polygon, so the tile holding it always intersects the footprint
+    # (a vertex mean can fall outside an L or U shape): the centre of the ring bbox when the ring
+    # contains it, else the first vertex.
+    n = len(ring_offsets) - 1
+    if n < 1:
+        return np.empty((0, 2), dtype=np.float64)
+    starts = ring_offsets[:-1]
+    centres = (np.minimum.reduceat(coords, starts, axis=0) + np.maximum.reduceat(coords, starts, axis=0)) / 2.0
+    ring = np.repeat(np.arange(n), np.diff(ring_offsets))
+    a, b, edge_ring = coords[:-1], coords[1:], ring[:-1]
+    cx, cy = centres[edge_ring, 0], centres[edge_ring, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((ring[1:] == edge_ring) & ((a[:, 1] > cy) != (b[:, 1] > cy))
+                   & (cx < (b[:, 0] - a[:, 0]) * (cy - a[:, 1]) / (b[:, 1] - a[:, 1]) + a[:, 0]))
+    inside = np.bincount(edge_ring[crosses], minlength=n) % 2 == 1
+    return np.where(inside[:, None], centres, coords[starts])
+
+
+class BuildingStoreWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = temp_path(path)
+        self.ids = array('q')
+        self.coords = array('d')
+        self.ring_offsets = array('q', [0])
+        self.ring_exterior = array('B')
+        self.feature_rings = array('q', [0])
+        self.render_height = array('f')
+        self.render_min_height = array('f')
+        self.render_levels = array('f')
+        self.tag_offsets = array('q', [0])
+        self.tag_keys = array('i')
+        self.tag_values = array('i')
+        self.strings = {}
+        self.count = 0
+
+    def _string(self, text):
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+        return index
+
+    @metrics.timed("serialize.store")
+    def write_polygons(self, coords, ring_offsets, way_ids, properties, ring_exterior=None, feature_rings=None):
+        # Without feature_rings every ring is its own single-polygon feature.
+        base = self.ring_offsets[-1]
+        ring_base = len(self.ring_offsets) - 1
+        self.coords.frombytes(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+        self.ring_offsets.frombytes((np.asarray(ring_offsets[1:], dtype=np.int64) + base).tobytes())
+        n_rings = len(ring_offsets) - 1
+        if ring_exterior is None:
+            ring_exterior = np.ones(n_rings, dtype=np.uint8)
+        self.ring_exterior.frombytes(np.asarray(ring_exterior, dtype=np.uint8).tobytes())
+        if feature_rings is None:
+            feature_rings = np.arange(n_rings + 1, dtype=np.int64)
+        self.feature_rings.frombytes((np.asarray(feature_rings[1:], dtype=np.int64) + ring_base).tobytes())
+        self.ids.frombytes(np.asarray(way_ids, dtype=np.int64).tobytes())
+        for props in properties:
+            for name in RENDER_PROPERTIES:
+                value = props.get(name)
+                getattr(self, name).append(float("nan") if value is None else float(value))
+            for k, v in props.items():
+                if k in RENDER_PROPERTIES:
+                    continue
+                self.tag_keys.append(self._string(k))
+                self.tag_values.append(self._string(str(v)))
+            self.tag_offsets.append(len(self.tag_keys))
+        self.count += len(properties)
+
+    def copy_features(self, store, index):
+        # Appends features `index` of a BuildingStore (geometry, tags and render values).
+        index = np.asarray(index, dtype=np.int64)
+        if not len(index):
+            return
+        rings, counts = feature_ring_index(store.feature_rings, index)
+        coords, ring_offsets = take_rings(store.coords, store.ring_offsets, rings)
+        feature_rings = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(counts, out=feature_rings[1:])
+        self.write_polygons(coords, ring_offsets, store.ids[index], [store.properties(i) for i in index.tolist()],
+                            store.ring_exterior[rings], feature_rings)
+
+    def close(self):
+        encoded = [s.encode("utf-8") for s in self.strings]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=string_offsets[1:])
+        columns = [
+            ("ids", np.frombuffer(self.ids, dtype=np.int64), (len(self.ids),)),
+            ("coords", np.frombuffer(self.coords, dtype=np.float64), (len(self.coords) // 2, 2)),
+            ("ring_offsets", np.frombuffer(self.ring_offsets, dtype=np.int64), (len(self.ring_offsets),)),
+            ("ring_exterior", np.frombuffer(self.ring_exterior, dtype=np.uint8), (len(self.ring_exterior),)),
+            ("feature_rings", np.frombuffer(self.feature_rings, dtype=np.int64), (len(self.feature_rings),)),
+            ("render_height", np.frombuffer(self.render_height, dtype=np.float32), (len(self.render_height),)),
+            ("render_min_height", np.frombuffer(self.render_min_height, dtype=np.float32), (len(self.render_min_height),)),
+            ("render_levels", np.frombuffer(self.render_levels, dtype=np.float32), (len(self.render_levels),)),
+            ("tag_offsets", np.frombuffer(self.tag_offsets, dtype=np.int64), (len(self.tag_offsets),)),
+            ("tag_keys", np.frombuffer(self.tag_keys, dtype=np.int32), (len(self.tag_keys),)),
+            ("tag_values", np.frombuffer(self.tag_values, dtype=np.int32), (len(self.tag_values),)),
+            ("string_offsets", string_offsets, (len(string_offsets),)),
+            ("strings", np.frombuffer(b"".join(encoded), dtype=np.uint8), (sum(len(b) for b in encoded),)),
+        ]
+        header = {"version": 1, "count": self.count, "columns": {}}
+        offset = 0
+        for name, data, shape in columns:
+            header["columns"][name] = {"dtype": data.dtype.str, "shape": list(shape), "offset": offset}
+            offset += (data.nbytes + 7) // 8 * 8
+        header_bytes = json.dumps(header).encode("utf-8")
+        with metrics.span("write.store", features=self.count) as span, open(self.tmp_path, "wb") as f:
+            f.write(BUILDING_STORE_MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes)
+            f.write(b"\0" * (-f.tell() % 8))
+            for name, data, shape in columns:
+                f.write(data.tobytes())
+                f.write(b"\0" * (-data.nbytes % 8))
+            span["bytes"] = f.tell()
+        metrics.count("write.store.bytes", span["bytes"])
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class BuildingStore:
+    # Read side of the columnar file: every column is a zero-copy NumPy view on an mmap.
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != BUILDING_STORE_MAGIC:
+            self.mm.close()
+            raise Exception(f"{path} is not a building store")
+        header_len = struct.unpack("<Q", self.mm[8:16])[0]
+        header = json.loads(self.mm[16:16 + header_len])
+        base = (16 + header_len + 7) // 8 * 8
+        self.count = header["count"]
+        for name, col in header["columns"].items():
+            n = int(np.prod(col["shape"]))
+            data = np.frombuffer(self.mm, dtype=np.dtype(col["dtype"]), count=n, offset=base + col["offset"]) if n else \
+                np.empty(0, dtype=np.dtype(col["dtype"]))
+            setattr(self, name, data.reshape(col["shape"]))
+
+    def __len__(self):
+        return self.count
+
+    def string(self, j):
+        return bytes(self.strings[self.string_offsets[j]:self.string_offsets[j + 1]]).decode("utf-8")
+
+    def properties(self, i, keys=None):
+        # Tags and render_* values of feature i, only those in `keys` when given.
+        t0, t1 = self.tag_offsets[i], self.tag_offsets[i + 1]
+        props = {}
+        for k, v in zip(self.tag_keys[t0:t1].tolist(), self.tag_values[t0:t1].tolist()):
+            key = self.string(k)
+            if keys is None or key in keys:
+                props[key] = self.string(v)
+        for name in RENDER_PROPERTIES:
+            value = float(getattr(self, name)[i])
+            if not math.isnan(value) and (keys is None or name in keys):
+                props[name] = round(value, 2)
+        return props
+
+    def rings(self, i):
+        r0, r1 = self.feature_rings[i], self.feature_rings[i + 1]
+        return [self.coords[self.ring_offsets[r]:self.ring_offsets[r + 1]] for r in range(r0, r1)]
+
+    def exterior_flags(self, i):
+        return self.ring_exterior[self.feature_rings[i]:self.feature_rings[i + 1]].astype(bool)
+
+    def exterior_rings(self):
+        # Index of the first ring of every feature.
+        return self.feature_rings[:-1]
+
+    def centroids(self):
+        first = self.exterior_rings()
+        return ring_centroids(self.coords, self.ring_offsets)[first] if len(first) else np.empty((0, 2))
+
+    def anchors(self):
+        # ring_anchors of every feature's exterior ring: where the feature belongs in tiles.
+        first = self.exterior_rings()
+        return ring_anchors(self.coords, self.ring_offsets)[first] if len(first) else np.empty((0, 2))
+
+    def geometry(self, i):
+        return rings_geometry(self.rings(i), self.exterior_flags(i))
+
+    def feature(self, i):
+        return {"type": "Feature", "id": int(self.ids[i]), "geometry": self.geometry(i), "properties": self.properties(i)}
+
+    def iter_features(self):
+        for i in range(self.count):
+            yield self.feature(i)
+
+    def close(self):
+        for name in list(vars(self)):
+            if isinstance(getattr(self, name), np.ndarray):
+                delattr(self, name)
+        try:
+            self.mm.close()
+        except BufferError:
+            pass  # views handed out are still alive; the map is released with them
+
+
+# --- TILED BUILDING CACHE ---
+TILE_ZOOM = 14
+
+def lonlat_to_tile(lon, lat, zoom):
+    n = 2 ** zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_bounds(x, y, zoom):
+    # (south, west, north, east), the Overpass bbox order.
+    n = 2 ** zoom
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+def tile_runs(tiles):
+    # Groups tiles into horizontal runs of adjacent x so each run is one rectangular Overpass query.
+    runs = []
+    for x, y in sorted(tiles, key=lambda t: (t[1], t[0])):
+        if runs and runs[-1][-1][1] == y and runs[-1][-1][0] == x - 1:
+            runs[-1].append((x, y))
+        else:
+            runs.append([(x, y)])
+    return runs
+
+# Large areas are fetched as several Overpass queries, each expected to hold at most
+# EXTRACT_MAX_BUILDINGS buildings, EXTRACT_WORKERS of them at a time. Tile counts are estimated
+# from the cache (the tile or its neighbours), else from one Overpass count query over a coarse
+# grid of the area (PROBE_GRID cells a side), else EXTRACT_TILE_BUILDINGS per tile.
+EXTRACT_MAX_BUILDINGS = 25000
+EXTRACT_TILE_BUILDINGS = 1500
+EXTRACT_WORKERS = 2
+PROBE_GRID = 4
+
+OVERPASS_COUNT_BUILDINGS_QUERY = """
+    way["building"]({bbox});
+    out count;
+    """
+
+def block_bounds(block, zoom):
+    # (south, west, north, east) of the rectangle holding a block of tiles.
+    xs, ys = [t[0] for t in block], [t[1] for t in block]
+    south, west, _, _ = tile_bounds(min(xs), max(ys), zoom)
+    _, _, north, east = tile_bounds(max(xs), min(ys), zoom)
+    return south, west, north, east
+
+def split_tile_block(block):
+    # Cuts a block of tiles in two across the longer side of its rectangle.
+    xs, ys = [t[0] for t in block], [t[1] for t in block]
+    axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+    values = xs if axis == 0 else ys
+    cut = min(values) + (max(values) - min(values) + 1) // 2
+    return [t for t in block if t[axis] < cut], [t for t in block if t[axis] >= cut]
+
+def plan_tile_blocks(tiles, estimate, max_buildings=None, min_fill=0.5):
+    # Groups tiles into blocks fetched by one Overpass query each: a block is cut in two until its
+    # estimated building count (sum of estimate(tile)) fits max_buildings and the requested tiles
+    # fill at least min_fill of its rectangle, so dense areas get small queries and sparse ones large.
+    max_buildings = EXTRACT_MAX_BUILDINGS if max_buildings is None else max_buildings
+    blocks, todo = [], [sorted(tiles, key=lambda t: (t[1], t[0]))] if tiles else []
+    while todo:
+        block = todo.pop()
+        xs, ys = [t[0] for t in block], [t[1] for t in block]
+        area = (max(xs) - min(xs) + 1) * (max(ys) - min(ys) + 1)
+        if len(block) == 1 or (sum(estimate(t) for t in block) <= max_buildings and len(block) >= min_fill * area):
+            blocks.append(block)
+        else:
+            todo.extend(reversed(split_tile_block(block)))
+    return blocks
+
+def probe_tile_counts(tiles, zoom, headers, grid=PROBE_GRID):
+    # {tile: estimated buildings}: the building ways of each cell of a grid x grid split of the
+    # tiles, counted by a single Overpass query and spread evenly over the tiles of the cell.
+    xs, ys = [t[0] for t in tiles], [t[1] for t in tiles]
+    step_x = -(-(max(xs) - min(xs) + 1) // grid)
+    step_y = -(-(max(ys) - min(ys) + 1) // grid)
+    cells = {}
+    for x, y in tiles:
+        cells.setdefault(((x - min(xs)) // step_x, (y - min(ys)) // step_y), []).append((x, y))
+    cells = list(cells.values())
+    query = "[out:json][timeout:60];" + "".join(
+        OVERPASS_COUNT_BUILDINGS_QUERY.format(bbox=",".join(str(v) for v in block_bounds(cell, zoom))) for cell in cells)
+    with metrics.span("buildings.probe", cells=len(cells)):
+        with fetch_overpass(query, headers) as resp_ov:
+            answer = resp_ov.json()
+    if "remark" in answer:
+        raise Exception(f"incomplete Overpass answer: {answer['remark'][:200]}")
+    counts = [int(e["tags"]["ways"]) for e in answer.get("elements", []) if e.get("type") == "count"]
+    if len(counts) != len(cells):
+        raise Exception(f"{len(counts)} counts for {len(cells)} cells")
+    return {t: count / len(cell) for cell, count in zip(cells, counts) for t in cell}
+
+def tile_estimator(tiles, zoom, headers, known=None):
+    # estimate(tile) for plan_tile_blocks: known(tile) when it has a count (None otherwise), else the
+    # density probe of the tiles known() knows nothing about, else EXTRACT_TILE_BUILDINGS.
+    known = known or (lambda tile: None)
+    unknown = [t for t in tiles if known(t) is None]
+    probed = {}
+    if len(unknown) > 1:
+        try:
+            probed = probe_tile_counts(unknown, zoom, headers)
+        except Exception as e:
+            print(f"Building density probe failed, assuming {EXTRACT_TILE_BUILDINGS} buildings per tile: {e}")
+
+    def estimate(tile):
+        count = known(tile)
+        return count if count is not None else probed.get(tile, EXTRACT_TILE_BUILDINGS)
+    return estimate
+
+def overpass_overloaded(error):
+    # Failures a smaller query can cure: Overpass runtime errors (timeout, out of memory) reported
+    # in a remark, and gateway timeouts.
+    text = str(error)
+    return "runtime error" in text or "Overpass error 504" in text
+
+def run_tile_blocks(blocks, fetch, workers=None):
+    # Runs fetch(block) for every block on `workers` threads. A block of several tiles failing
+    # because it asked too much of Overpass is split in two and both halves are queued; other
+    # failures are raised (the first one) once the remaining blocks are done.
+    workers = EXTRACT_WORKERS if workers is None else workers
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(fetch, block): block for block in blocks}
+        while futures:
+            done, _ = wait_futures(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                block = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    if len(block) > 1 and overpass_overloaded(e):
+                        print(f"Overpass query over {len(block)} tiles too large, splitting it ({str(e)[:120]})")
+                        metrics.count("buildings.split_blocks")
+                        futures.update((pool.submit(fetch, half), half) for half in split_tile_block(block))
+                    else:
+                        errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def feature_rings_of(way_ids, ring_exterior, feature_rings):
+    # write_polygons arguments without feature grouping stand for one exterior ring per feature.
+    if feature_rings is None:
+        return np.ones(len(way_ids), dtype=np.uint8), np.arange(len(way_ids) + 1, dtype=np.int64)
+    return np.asarray(ring_exterior), np.asarray(feature_rings, dtype=np.int64)
+
+def take_features(coords, ring_offsets, way_ids, properties, ring_exterior, feature_rings, index):
+    # write_polygons arguments of the features `index` only.
+    rings, counts = feature_ring_index(feature_rings, index)
+    sub_coords, sub_offsets = take_rings(coords, ring_offsets, rings)
+    sub_feature_rings = np.zeros(len(index) + 1, dtype=np.int64)
+    np.cumsum(counts, out=sub_feature_rings[1:])
+    return (sub_coords, sub_offsets, way_ids[index], [properties[i] for i in index.tolist()],
+            ring_exterior[rings], sub_feature_rings)
+
+
+class TileFeatureRouter:
+    # Sends each polygon to the writer of the tile holding its ring anchor (ring_anchors, a point on
+    # the footprint), so a way straddling a tile edge is stored exactly once.
+    def __init__(self, zoom, writers):
+        self.zoom = zoom
+        self.writers = writers
+
+    @metrics.timed("extract.route")
+    def write_polygons(self, coords, ring_offsets, way_ids, properties, ring_exterior=None, feature_rings=None):
+        if not len(way_ids):
+            return
+        ring_exterior, feature_rings = feature_rings_of(way_ids, ring_exterior, feature_rings)
+        anchors = ring_anchors(coords, ring_offsets)[feature_rings[:-1]]
+        tx, ty = lonlat_to_tile_array(anchors[:, 0], anchors[:, 1], self.zoom)
+        for (x, y), writer in self.writers.items():
+            index = np.flatnonzero((tx == x) & (ty == y))
+            if len(index):
+                writer.write_polygons(*take_features(coords, ring_offsets, way_ids, properties, ring_exterior,
+                                                     feature_rings, index))
+
+
+class UniqueFeatureFilter:
+    # Merges the answers of overlapping sub-queries into one writer, from several threads: batches
+    # are written as they arrive and a feature id already written (a way or relation straddling
+    # two sub-bboxes, or resent by a retried query) is dropped.
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.count = 0
+
+    def write_polygons(self, coords, ring_offsets, way_ids, properties, ring_exterior=None, feature_rings=None):
+        with self.lock:
+            ids = way_ids.tolist()
+            index = np.array([k for k, i in enumerate(ids) if i not in self.seen], dtype=np.int64)
+            self.seen.update(ids)
+            metrics.count("extract.duplicates", len(ids) - len(index))
+            if not len(index):
+                return
+            if len(index) < len(ids):
+                ring_exterior, feature_rings = feature_rings_of(way_ids, ring_exterior, feature_rings)
+                self.writer.write_polygons(*take_features(coords, ring_offsets, way_ids, properties, ring_exterior,
+                                                          feature_rings, index))
+            else:
+                self.writer.write_polygons(coords, ring_offsets, way_ids, properties, ring_exterior, feature_rings)
+            self.count += len(index)
+
+
+class BuildingTileCache:
+    # Building cache split into slippy-map tiles at a fixed zoom, one BuildingStore file per tile.
+    # Tile files are named after the Overpass query hash and their fetch time (so a refetch never
+    # overwrites a file that may still be mapped); manifest.json keeps fetch time, size and last use
+    # of each tile so stale tiles get refetched and the least recently used ones are evicted past max_bytes.
+    # Processes sharing the cache merge their changes into manifest.json under manifest.lock, and
+    # claim the tiles they fetch through per-tile lock files (locks/) so a tile is downloaded once.
+    FORMAT = "bldg2"
+    COMPANION_SUFFIXES = (".agg.npz", ".idx.npz")
+    def __init__(self, root, zoom=TILE_ZOOM, max_bytes=None, max_age=None):
+        self.root = root
+        self.zoom = zoom
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.lock_dir = os.path.join(root, "locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.lock = threading.RLock()  # manifest updates from concurrent extractions (batch mode)
+        self.dirty = set()  # keys changed here since the last save
+        self.removed = {}  # evicted key -> its file, dropped from the shared manifest on save
+        self.unremoved = set()  # files whose removal failed (still mapped, on Windows), retried later
+        self.tiles = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("zoom") != self.zoom or manifest.get("format") != self.FORMAT:
+            return {}
+        return manifest.get("tiles", {})
+
+    def _merge(self, shared):
+        # Local changes over the shared manifest: the latest fetch of a tile wins, a file that lost
+        # is removed, and evicted tiles are dropped unless refetched elsewhere meanwhile.
+        for key, filename in self.removed.items():
+            if shared.get(key, {}).get("file") == filename:
+                del shared[key]
+        for key in self.dirty:
+            mine, theirs = self.tiles.get(key), shared.get(key)
+            if mine is None:
+                continue
+            if theirs is None or theirs["file"] == mine["file"] or mine["fetched"] >= theirs["fetched"]:
+                if theirs is not None and theirs["file"] != mine["file"]:
+                    self._remove_file(theirs["file"])
+                shared[key] = dict(mine, last_used=max(mine["last_used"], (theirs or mine)["last_used"]))
+            else:
+                self._remove_file(mine["file"])
+        return shared
+
+    def reload(self):
+        # Picks up the tiles fetched by other processes.
+        with self.lock:
+            self.tiles = self._merge(self._load_manifest())
+
+    def save_manifest(self):
+        with self.lock, metrics.span("write.manifest", tiles=len(self.tiles)), \
+                FileLock(os.path.join(self.root, "manifest.lock")):
+            self.tiles = self._merge(self._load_manifest())
+            with atomic_write(self.manifest_path) as f:
+                json.dump({"zoom": self.zoom, "format": self.FORMAT, "tiles": self.tiles}, f)
+            self.dirty.clear()
+            self.removed.clear()
+
+    def _tile_lock(self, tile):
+        return FileLock(os.path.join(self.lock_dir, f"{self.zoom}_{tile[0]}_{tile[1]}.lock"))
+
+    def claim(self, tiles):
+        # Takes the lock of every tile that is free: returns {tile: FileLock} for the tiles claimed
+        # here and the list of those being fetched by another process or thread.
+        held, busy = {}, []
+        for t in tiles:
+            lock = self._tile_lock(t)
+            if lock.acquire(blocking=False):
+                held[t] = lock
+            else:
+                busy.append(t)
+        return held, busy
+
+    def release(self, held):
+        for lock in held.values():
+            lock.release()
+
+    def wait(self, tiles):
+        # Blocks until the given tiles are no longer claimed.
+        for t in tiles:
+            with self._tile_lock(t):
+                pass
+
+    def updated_since(self, tile, since):
+        entry = self.tiles.get(self.key(tile))
+        return bool(entry and entry["fetched"] >= since)
+
+    def key(self, tile):
+        return f"{self.zoom}/{tile[0]}/{tile[1]}"
+
+    def new_tile_path(self, tile, query_hash):
+        return os.path.join(self.root, f"{self.zoom}_{tile[0]}_{tile[1]}_{query_hash[:12]}_{time.time_ns():x}.bldg")
+
+    def open_store(self, tile):
+        entry = self.tiles.get(self.key(tile))
+        if not entry:
+            return None
+        try:
+            return BuildingStore(os.path.join(self.root, entry["file"]))
+        except Exception:
+            return None
+
+    def tiles_for_bbox(self, south, west, north, east):
+        x0, y0 = lonlat_to_tile(west, north, self.zoom)
+        x1, y1 = lonlat_to_tile(east, south, self.zoom)
+        return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def run_bounds(self, run):
+        return block_bounds(run, self.zoom)
+
+    def estimate_count(self, tile, radius=2):
+        # Buildings expected in a tile, for planning the queries: its last known count (whatever the
+        # query it was fetched with), else the mean count of the cached tiles within `radius`, else None.
+        x, y = tile
+        with self.lock:
+            entry = self.tiles.get(self.key(tile))
+            if entry:
+                return entry["count"]
+            counts = [self.tiles[k]["count"] for k in (self.key((x + dx, y + dy))
+                                                        for dy in range(-radius, radius + 1)
+                                                        for dx in range(-radius, radius + 1)) if k in self.tiles]
+        return sum(counts) / len(counts) if counts else None
+
+    def is_fresh(self, tile, query_hash, now=None):
+        entry = self.tiles.get(self.key(tile))
+        if not entry or entry["query_hash"] != query_hash or entry.get("stale"):
+            return False
+        if not os.path.exists(os.path.join(self.root, entry["file"])):
+            return False
+        now = time.time() if now is None else now
+        return self.max_age is None or now - entry["fetched"] <= self.max_age
+
+    def missing(self, tiles, query_hash):
+        now = time.time()
+        return [t for t in tiles if not self.is_fresh(t, query_hash, now)]
+
+    def store(self, tile, query_hash, path, count, osm_base=None):
+        with self.lock:
+            old = self.tiles.get(self.key(tile))
+            if old and old["file"] != os.path.basename(path):
+                self._remove_file(old["file"])
+            now = time.time()
+            self.tiles[self.key(tile)] = {
+                "file": os.path.basename(path), "query_hash": query_hash,
+                "fetched": now, "last_used": now, "size": os.path.getsize(path), "count": count,
+                "osm_base": osm_base
+            }
+            self.dirty.add(self.key(tile))
+            self.removed.pop(self.key(tile), None)
+
+    def refreshable(self, tile, query_hash):
+        # Tiles that can be brought up to date with a diff: same query and a known data timestamp.
+        entry = self.tiles.get(self.key(tile))
+        return bool(entry and entry["query_hash"] == query_hash and entry.get("osm_base")
+                    and os.path.exists(os.path.join(self.root, entry["file"])))
+
+    def mark_refreshed(self, tile, osm_base):
+        with self.lock:
+            entry = self.tiles[self.key(tile)]
+            entry["fetched"] = entry["last_used"] = time.time()
+            entry["osm_base"] = osm_base
+            entry.pop("stale", None)
+            self.dirty.add(self.key(tile))
+
+    def mark_stale(self, tiles):
+        # Cached tiles known to miss an edit (a way moved in from a refreshed neighbour): no longer
+        # fresh, so they are refreshed the next time they are needed.
+        marked = 0
+        with self.lock:
+            for t in tiles:
+                entry = self.tiles.get(self.key(t))
+                if entry:
+                    entry["stale"] = True
+                    self.dirty.add(self.key(t))
+                    marked += 1
+        return marked
+
+    def touch(self, tiles):
+        now = time.time()
+        with self.lock:
+            for t in tiles:
+                if self.key(t) in self.tiles:
+                    self.tiles[self.key(t)]["last_used"] = now
+                    self.dirty.add(self.key(t))
+
+    def export_geojson(self, tiles, output):
+        # On-demand GeoJSON conversion of the given tiles.
+        count = 0
+        with metrics.span("write.geojson_export", tiles=len(tiles)), GeoJSONFeatureWriter(output) as writer:
+            for t in tiles:
+                store = self.open_store(t)
+                if store is None:
+                    continue
+                for i in range(len(store)):
+                    writer.write(writer.feature(int(store.ids[i]), store.geometry(i), store.properties(i)))
+                count += len(store)
+                store.close()
+        return count
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            self.unremoved.add(name)
+
+    def _remove_file(self, filename):
+        for name in (filename,) + tuple(filename + suffix for suffix in self.COMPANION_SUFFIXES):
+            self._remove(name)
+
+    def retry_removals(self):
+        # Removes the files left behind because they were still mapped, once their stores are closed.
+        with self.lock:
+            pending, self.unremoved = self.unremoved, set()
+            for name in pending:
+                self._remove(name)
+            return len(pending) - len(self.unremoved)
+
+    def companion(self, tile, suffix, build, store=None):
+        # Arrays derived from a tile (build(store) -> dict of arrays), saved next to the tile file.
+        # The tile file name changes on every refetch, so a stale companion is never picked up.
+        entry = self.tiles.get(self.key(tile))
+        if not entry:
+            return None
+        path = os.path.join(self.root, entry["file"] + suffix)
+        try:
+            with np.load(path) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            pass
+        own_store = store is None
+        store = self.open_store(tile) if own_store else store
+        if store is None:
+            return None
+        result = build(store)
+        if own_store:
+            store.close()
+        with atomic_write(path, "wb") as f:
+            np.savez(f, **result)
+        return result
+
+    def aggregate(self, tile, store=None):
+        return self.companion(tile, ".agg.npz", aggregate_store, store)
+
+    def spatial_index(self, tile, store=None):
+        return self.companion(tile, ".idx.npz", build_str_index, store)
+
+    def evict(self, protect=()):
+        if self.max_bytes is None:
+            return 0
+        with self.lock:
+            self.retry_removals()
+            protected = {self.key(t) for t in protect}
+            total = sum(e["size"] for e in self.tiles.values())
+            evicted = 0
+            for key, entry in sorted(self.tiles.items(), key=lambda kv: kv[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                if key in protected:
+                    continue
+                self._remove_file(entry["file"])
+                del self.tiles[key]
+                self.dirty.discard(key)
+                self.removed[key] = entry["file"]
+                total -= entry["size"]
+                evicted += 1
+            if evicted:
+                self.save_manifest()
+                print(f"Building cache: evicted {evicted} tiles")
+            return evicted
+
+
+@metrics.timed("buildings.fetch_run")
+def fetch_building_tiles(cache, run, query_hash, headers, keep_tags=None, queries=OVERPASS_QUERY_MODES["geom"]):
+    south, west, north, east = cache.run_bounds(run)
+    query = queries["full"].format(bbox=f"{south},{west},{north},{east}")
+    writers = {t: BuildingStoreWriter(cache.new_tile_path(t, query_hash)) for t in run}
+    meta = {}
+    try:
+        with fetch_overpass(query, headers) as resp_ov:
+            write_osm_building_features(iter_overpass_elements(resp_ov.raw, meta), TileFeatureRouter(cache.zoom, writers),
+                                        keep_tags=keep_tags)
+        if "remark" in meta:
+            raise Exception(f"incomplete Overpass answer: {meta['remark'][:200]}")
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    for t, writer in writers.items():
+        writer.close()
+        cache.store(t, query_hash, writer.path, writer.count, meta.get("osm_base"))
+    cache.save_manifest()
+
+
+class PolygonBuffer:
+    # In-memory sink keeping write_polygons batches so they can be replayed into other sinks.
+    def __init__(self):
+        self.batches = []
+        self.way_ids = set()
+
+    def write_polygons(self, coords, ring_offsets, way_ids, properties, ring_exterior=None, feature_rings=None):
+        self.batches.append((coords, ring_offsets, way_ids, properties, ring_exterior, feature_rings))
+        self.way_ids.update(way_ids.tolist())
+
+    def tiles(self, zoom):
+        found = set()
+        for coords, ring_offsets, way_ids, _, _, feature_rings in self.batches:
+            first = np.arange(len(way_ids)) if feature_rings is None else np.asarray(feature_rings)[:-1]
+            anchors = ring_anchors(coords, ring_offsets)[first]
+            tx, ty = lonlat_to_tile_array(anchors[:, 0], anchors[:, 1], zoom)
+            found.update(zip(tx.tolist(), ty.tolist()))
+        return found
+
+
+@metrics.timed("buildings.refresh_run")
+def refresh_building_tiles(cache, run, query_hash, headers, keep_tags=None, queries=OVERPASS_QUERY_MODES["geom"]):
+    # Brings a run of cached tiles up to date from their osm_base: one adiff query for the ways that
+    # left the building set, one query for the ways edited (or with moved nodes) since, both sized
+    # by the edit volume. Only tiles holding or receiving a changed way are rewritten, the others
+    # just get the new timestamp; cached tiles outside the run receiving a way are marked stale (the
+    # way is in their own diff). Returns the number of changed and removed ways.
+    south, west, north, east = cache.run_bounds(run)
+    bbox = f"{south},{west},{north},{east}"
+    since = min(cache.tiles[cache.key(t)]["osm_base"] for t in run)
+    deleted_meta, changed_meta = {}, {}
+    with fetch_overpass(queries["deleted"].format(bbox=bbox, since=since), headers) as resp_ov:
+        deleted = set(iter_overpass_deleted_ids(resp_ov.raw, deleted_meta))
+    changed = PolygonBuffer()
+    with fetch_overpass(queries["changed"].format(bbox=bbox, since=since), headers) as resp_ov:
+        write_osm_building_features(iter_overpass_elements(resp_ov.raw, changed_meta), changed, keep_tags=keep_tags)
+    if "remark" in deleted_meta or "remark" in changed_meta or not deleted_meta.get("osm_base"):
+        raise Exception(f"incomplete Overpass diff: {deleted_meta.get('remark') or changed_meta.get('remark') or 'no osm_base'}")
+    # The earlier of the two timestamps: anything edited in between is seen again next time.
+    osm_base = min(deleted_meta["osm_base"], changed_meta.get("osm_base") or deleted_meta["osm_base"])
+    removed = np.fromiter(deleted | changed.way_ids, dtype=np.int64)
+    receiving = changed.tiles(cache.zoom)
+    for t in run:
+        store = cache.open_store(t)
+        keep = ~np.isin(store.ids, removed)
+        if keep.all() and t not in receiving:
+            store.close()
+            cache.mark_refreshed(t, osm_base)
+            continue
+        writer = BuildingStoreWriter(cache.new_tile_path(t, query_hash))
+        try:
+            writer.copy_features(store, np.flatnonzero(keep))
+            router = TileFeatureRouter(cache.zoom, {t: writer})
+            for batch in changed.batches:
+                router.write_polygons(*batch)
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            store.close()
+        writer.close()
+        cache.store(t, query_hash, writer.path, writer.count, osm_base)
+    moved = cache.mark_stale(receiving - set(run))
+    if moved:
+        print(f"Building tiles: {moved} tiles outside the refreshed ones receive changed ways, marked stale")
+    cache.save_manifest()
+    return len(changed.way_ids), len(deleted - changed.way_ids)
+
+
+def update_building_run(cache, run, query_hash, headers, keep_tags=None, queries=OVERPASS_QUERY_MODES["geom"], diff=False):
+    # Downloads a run of tiles, or with `diff` brings it up to date from an Overpass diff
+    # (downloading it again if the diff fails).
+    if diff:
+        try:
+            changed, removed = refresh_building_tiles(cache, run, query_hash, headers, keep_tags, queries)
+            print(f"Building tiles refreshed: {len(run)} tiles, {changed} ways changed, {removed} removed")
+            return
+        except Exception as e:
+            print(f"Incremental refresh failed ({e}), downloading the tiles again")
+            metrics.count("buildings.refresh_failures")
+    fetch_building_tiles(cache, run, query_hash, headers, keep_tags, queries)
+
+
+def update_building_tiles(cache, missing, stale, query_hash, headers, keep_tags=None, queries=OVERPASS_QUERY_MODES["geom"]):
+    # Downloads the `missing` tiles and refreshes the `stale` ones, once across the processes and
+    # threads sharing the cache: each tile is claimed first, tiles claimed elsewhere are waited for,
+    # and a claimed tile updated by someone else since this call started is skipped. The claimed
+    # tiles are fetched in blocks sized by plan_tile_blocks, EXTRACT_WORKERS at a time.
+    started = time.time()
+    stale = set(stale)
+    pending = list(dict.fromkeys(list(stale) + list(missing)))
+    while pending:
+        held, busy = cache.claim(pending)
+        try:
+            if held:
+                cache.reload()
+                todo = [t for t in held if not cache.updated_since(t, started)]
+                metrics.count("buildings.shared_tiles", len(held) - len(todo))
+                estimate = tile_estimator([t for t in todo if t not in stale], cache.zoom, headers, cache.estimate_count)
+                blocks = (plan_tile_blocks([t for t in todo if t in stale], estimate) +
+                          plan_tile_blocks([t for t in todo if t not in stale], estimate))
+                run_tile_blocks(blocks, lambda block: update_building_run(cache, block, query_hash, headers, keep_tags,
+                                                                          queries, diff=block[0] in stale))
+        finally:
+            cache.release(held)
+        if busy:
+            print(f"Waiting for {len(busy)} building tiles fetched by another process")
+            metrics.count("buildings.waited_tiles", len(busy))
+            with metrics.span("buildings.wait", tiles=len(busy)):
+                cache.wait(busy)
+        pending = busy
+
+
+def fetch_bbox_buildings(bbox, writer, headers, keep_tags=None, queries=OVERPASS_QUERY_MODES["geom"], zoom=TILE_ZOOM):
+    # Buildings of a (south, west, north, east) bbox of any size into one writer: the bbox is cut
+    # along the tiles of `zoom` into sub-queries (plan_tile_blocks), fetched concurrently and
+    # merged as they stream in through a UniqueFeatureFilter. Returns the number of buildings.
+    south, west, north, east = bbox
+    x0, y0 = lonlat_to_tile(west, north, zoom)
+    x1, y1 = lonlat_to_tile(east, south, zoom)
+    tiles = [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+    blocks = plan_tile_blocks(tiles, tile_estimator(tiles, zoom, headers))
+    if len(blocks) > 1:
+        print(f"Building extraction split into {len(blocks)} queries, {EXTRACT_WORKERS} at a time")
+    merged = UniqueFeatureFilter(writer)
 
-try:
-    import overpy
-    OVERPY_AVAILABLE = True
-except ImportError:
-    overpy = None
-    OVERPY_AVAILABLE = False
+    def fetch(block):
+        s, w, n, e = block_bounds(block, zoom)
+        sub = f"{max(s, south)},{max(w, west)},{min(n, north)},{min(e, east)}"
+        meta = {}
+        with fetch_overpass(queries["full"].format(bbox=sub), headers) as resp_ov:
+            write_osm_building_features(iter_overpass_elements(resp_ov.raw, meta), merged, keep_tags=keep_tags)
+        if "remark" in meta:
+            raise Exception(f"incomplete Overpass answer: {meta['remark'][:200]}")
 
-def internet_connection_1(url="https://www.google.com", timeout=5):
-    try:
-        _ = requests.get(url, timeout=timeout)
-        return True
-    except requests.ConnectionError:
-        return False
+    run_tile_blocks(blocks, fetch)
+    return merged.count
 
-def internet_connection_2(host="8.8.8.8", port=53, timeout=3):
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port)).close()
-        return True
-    except socket.error:
-        return False
 
-def get_wikidata_population(city, country=None):
-    try:
-        url_search = "https://www.wikidata.org/w/api.php"
-        params = {
-            'action': 'wbsearchentities',
-            'search': city,
-            'language': 'en',
-            'format': 'json',
-            'type': 'item'
-        }
-        resp = requests.get(url_search, params=params, timeout=6)
-        results = resp.json().get('search', [])
-        entity_id = None
-        for result in results:
-            if any(x in result['description'].lower() for x in ['commune', 'city', 'municipality']):
-                entity_id = result['id']
-                break
-        if not entity_id and results:
-            entity_id = results[0]['id']
-        if not entity_id:
-            return "-"
-        url_entity = f"https://www.wikidata.org/wiki/Special:EntityData/{entity_id}.json"
-        edata = requests.get(url_entity, timeout=8).json()
-        claims = edata.get("entities", {}).get(entity_id, {}).get("claims", {})
-        if "P1082" in claims:
-            latest = None
-            latest_year = None
-            for p in claims["P1082"]:
-                v = p.get("mainsnak", {}).get("datavalue", {}).get("value", {})
-                if "amount" in v:
-                    pop_str = v["amount"].lstrip('+')
-                    pop = str(int(float(pop_str)))
-                    year = "-"
-                    if "qualifiers" in p and "P585" in p["qualifiers"]:
-                        time_str = p["qualifiers"]["P585"][0]["datavalue"]["value"]["time"]
-                        if time_str.startswith("+"):
-                            year = time_str[1:5]
-                    if not latest or (year != "-" and int(year) > int(latest_year or 0)):
-                        latest = pop
-                        latest_year = year
-            return latest if latest else "-"
-        return "-"
-    except Exception:
-        return "-"
+@metrics.timed("buildings.export")
+def export_osm_buildings(api_user_adgent, city="Paris", output="buildings_cache.geojson", d=0.045,
+                         cache=None, center=None, force=False, offline=False, keep_tags=None, refresh=False,
+                         overpass_mode="geom"):
+    # Without a cache the buildings are written straight to the `output` GeoJSON. With a
+    # BuildingTileCache only missing tiles are fetched, and `output` (if given) gets a GeoJSON export.
+    # Stale tiles with a known osm_base (every cached tile with `refresh`) are updated from an
+    # Overpass diff instead of being downloaded again. overpass_mode picks the query shape
+    # (OVERPASS_QUERY_MODES): "geom" inline way geometry plus multipolygon relations, "nodes" the
+    # node list + way refs layout.
+    queries = OVERPASS_QUERY_MODES[overpass_mode]
+    headers = {'User-Agent': f'ICX Tools OSM Extraction ({api_user_adgent})'} 
+    lat, lon = center if center else geocode_nominatim(city, headers)
 
-def get_city_infos(city):
-    geolocator = Nominatim(user_agent="py-maptiler-webview")
-    loc = geolocator.geocode(city, exactly_one=True, addressdetails=True)
-    if not loc:
-        loc = geolocator.geocode("New York", addressdetails=True)
-    lat, lon = float(loc.latitude), float(loc.longitude)
-    address = loc.raw['address']
-    country = address.get('country', '?')
-    region = address.get('state', address.get('region', '?'))
-    population = get_wikidata_population(city, country)
-    if population == "-":
+    if cache is None:
+        with GeoJSONFeatureWriter(output) as writer:
+            count = fetch_bbox_buildings((lat - d, lon - d, lat + d, lon + d), writer, headers, keep_tags, queries)
+        print(f"Buildings saved to {output} ({count} buildings)")
+        return lat, lon
+
+    query_hash = overpass_query_hash(queries["full"], keep_tags=keep_tags)
+    tiles = cache.tiles_for_bbox(lat - d, lon - d, lat + d, lon + d)
+    cache.reload()
+    missing = list(tiles) if force else cache.missing(tiles, query_hash)
+    if offline:
+        print(f"Offline mode: {len(missing)} of {len(tiles)} building tiles missing or stale, using the cache as is")
+        missing = []
+    stale = [] if force or offline else [t for t in (tiles if refresh else missing) if cache.refreshable(t, query_hash)]
+    missing = [t for t in missing if t not in stale]
+    print(f"Building tiles: {len(tiles)} needed, {len(missing)} to fetch, {len(stale)} to refresh")
+    metrics.count("cache.building_tiles.hit", len(tiles) - len(missing) - len(stale))
+    metrics.count("cache.building_tiles.miss", len(missing))
+    metrics.count("cache.building_tiles.stale", len(stale))
+    update_building_tiles(cache, missing, stale, query_hash, headers, keep_tags, queries)
+    cache.touch(tiles)
+    cache.save_manifest()
+    cache.evict(protect=tiles)
+    count = sum(cache.tiles[cache.key(t)]["count"] for t in tiles if cache.key(t) in cache.tiles)
+    if output:
+        cache.export_geojson(tiles, output)
+        print(f"Buildings saved to {output} ({count} buildings)")
+    else:
+        print(f"Building cache ready ({count} buildings)")
+    return lat, lon
+
+
+
+# --- BATCH PRE-WARM ---
+def read_city_list(spec):
+    # A file with one city per line ('#' starts a comment) or a ';' separated list.
+    if os.path.exists(spec):
+        with open(spec, encoding="utf-8") as f:
+            lines = [line.split("#", 1)[0].strip() for line in f]
+    else:
+        lines = [c.strip() for c in spec.split(";")]
+    return [c for c in lines if c]
+
+def parse_mapping(spec):
+    # "name=value,name=value" -> dict
+    return dict(item.split("=", 1) for item in (i.strip() for i in spec.split(",")) if "=" in item)
+
+def parse_rate_limits(spec):
+    # "nominatim=1,overpass=0.5/2": requests per second and optional burst size.
+    limits = {}
+    for name, value in parse_mapping(spec).items():
+        rate, _, burst = value.partition("/")
+        limits[name.strip()] = (float(rate), int(burst or 1))
+    return limits
+
+
+class BatchPrewarm:
+    # Headless cache pre-building for a list of cities on a thread pool: geocoding, building tiles
+    # (plus optional GeoJSON export) and city infos per city. Upstream traffic is paced by the
+    # shared rate_limiter. Per-city status, timings and errors are written to state_path after every
+    # city, and cities already done there are skipped on the next run unless force is set.
+    def __init__(self, cache, city_cache, user_agent, state_path, d=0.02, keep_tags=None, workers=4,
+                 export_dir=None, force=False, refresh=False, overpass_mode="geom"):
+        self.cache = cache
+        self.city_cache = city_cache
+        self.user_agent = user_agent
+        self.state_path = state_path
+        self.d = d
+        self.keep_tags = keep_tags
+        self.workers = workers
+        self.export_dir = export_dir
+        self.force = force
+        self.refresh = refresh
+        self.overpass_mode = overpass_mode
+        self.lock = threading.Lock()
+        self.state = {"cities": {}}
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def _save(self):
+        with atomic_write(self.state_path) as f:
+            json.dump(self.state, f, indent=1)
+
+    def _record(self, city, record):
+        with self.lock:
+            self.state["cities"][city] = record
+            self._save()
+
+    def run_city(self, city):
+        record = {"status": "running", "started": time.time(), "timings": {}}
+        t0 = last = time.perf_counter()
+
+        def mark(phase):
+            nonlocal last
+            now = time.perf_counter()
+            record["timings"][phase] = round(now - last, 3)
+            last = now
+
+        try:
+            geo = geocode_city(city, self.city_cache, fallback=None)
+            record.update(lat=geo["lat"], lon=geo["lon"])
+            mark("geocode")
+            output = None
+            if self.export_dir:
+                output = os.path.join(self.export_dir, re.sub(r"[^\w-]+", "_", city.lower()) + ".geojson")
+            export_osm_buildings(self.user_agent, city=city, output=output, d=self.d, cache=self.cache,
+                                 center=(geo["lat"], geo["lon"]), force=self.force, keep_tags=self.keep_tags,
+                                 refresh=self.refresh, overpass_mode=self.overpass_mode)
+            tiles = self.cache.tiles_for_bbox(geo["lat"] - self.d, geo["lon"] - self.d, geo["lat"] + self.d, geo["lon"] + self.d)
+            record["buildings"] = sum(self.cache.tiles[self.cache.key(t)]["count"] for t in tiles
+                                      if self.cache.key(t) in self.cache.tiles)
+            mark("buildings")
+            get_city_infos(city, cache=self.city_cache)
+            mark("city_infos")
+            record["status"] = "done"
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["timings"]["total"] = round(time.perf_counter() - t0, 3)
+        self._record(city, record)
+        print(f"[{city}] {record['status']} in {record['timings']['total']:.1f} s" +
+              (f" ({record['error']})" if "error" in record else ""))
+        return record
+
+    def run(self, cities):
+        done = self.state["cities"]
+        todo = [c for c in dict.fromkeys(cities)
+                if self.force or self.refresh or done.get(c, {}).get("status") != "done"]
+        print(f"Batch pre-warm: {len(todo)} of {len(cities)} cities to process, {self.workers} workers")
+        if self.export_dir:
+            os.makedirs(self.export_dir, exist_ok=True)
+        t0 = time.perf_counter()
+        # Populations first, batched, so the per-city infos find them cached.
+        countries = {c: (self.city_cache.get(f"geocode:{c.lower()}") or {}).get("country") for c in todo}
+        resolve_populations(todo, self.city_cache, countries)
+        print(f"Batch pre-warm: populations resolved in {time.perf_counter() - t0:.1f} s")
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            records = list(pool.map(self.run_city, todo))
+        failed = [c for c, r in zip(todo, records) if r["status"] != "done"]
+        with self.lock:
+            self.state["last_run"] = {"finished": time.time(), "seconds": round(time.perf_counter() - t0, 3),
+                                      "processed": len(todo), "failed": failed}
+            self._save()
+        print(f"Batch pre-warm finished: {len(todo) - len(failed)} done, {len(failed)} failed, state in {self.state_path}")
+        return failed
+
+
+# --- LOCAL TILE SERVER ---
+MAPTILER_TILE_LAYERS = {
+    "satellite": "https://api.maptiler.com/tiles/satellite/{z}/{x}/{y}.jpg?key={key}",
+    "terrain-rgb": "https://api.maptiler.com/tiles/terrain-rgb/{z}/{x}/{y}.png?key={key}",
+}
+
+class TileStore:
+    # MBTiles-style SQLite store (TMS tile_row) shared by the proxy threads, with size/age eviction.
+    # WAL journal and a busy timeout let viewers sharing the file read while another one writes.
+    # Hits only note their access time in memory; the times are written with the next put/evict/close
+    # (or once ACCESS_FLUSH_ROWS have piled up), so serving a cached tile never commits.
+    ACCESS_FLUSH_ROWS = 256
+
+    def __init__(self, db_path, max_bytes=None, max_age=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.accessed = {}
+        self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tiles (
+            layer TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+            tile_data BLOB, content_type TEXT, fetched REAL, last_access REAL,
+            PRIMARY KEY (layer, zoom_level, tile_column, tile_row))""")
+        self.db.commit()
+
+    @staticmethod
+    def _row(z, x, y):
+        return z, x, (1 << z) - 1 - y
+
+    def get(self, layer, z, x, y):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT tile_data, content_type, fetched FROM tiles WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                (layer, *self._row(z, x, y))).fetchone()
+            if row is None or (self.max_age is not None and now - row[2] > self.max_age):
+                return None
+            self.accessed[(layer, *self._row(z, x, y))] = now
+            if len(self.accessed) >= self.ACCESS_FLUSH_ROWS:
+                self._flush_access()
+                self.db.commit()
+        return row[0], row[1]
+
+    def _flush_access(self):
+        # Called under the lock; the caller commits.
+        if self.accessed:
+            self.db.executemany(
+                "UPDATE tiles SET last_access=? WHERE layer=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                [(t, *key) for key, t in self.accessed.items()])
+            self.accessed.clear()
+
+    def put(self, layer, z, x, y, data, content_type):
+        now = time.time()
+        with self.lock:
+            self._flush_access()
+            self.db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (layer, *self._row(z, x, y), sqlite3.Binary(data), content_type, now, now))
+            self.db.commit()
+
+    def evict(self):
+        removed = 0
+        with self.lock:
+            self._flush_access()
+            if self.max_age is not None:
+                removed += self.db.execute("DELETE FROM tiles WHERE fetched < ?", (time.time() - self.max_age,)).rowcount
+            if self.max_bytes is not None:
+                total = self.db.execute("SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()[0]
+                rows = self.db.execute("SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY last_access").fetchall()
+                stale = []
+                for rowid, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((rowid,))
+                    total -= size
+                self.db.executemany("DELETE FROM tiles WHERE rowid=?", stale)
+                removed += len(stale)
+            self.db.commit()
+        return removed
+
+    def close(self):
+        with self.lock:
+            self._flush_access()
+            self.db.commit()
+            self.db.close()
+
+
+class TileProxyHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        proxy = self.server.proxy
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["stats"]:
+            return self._send(200, json.dumps(proxy.stats()).encode("utf-8"), "application/json")
+        try:
+            layer, z, x, y = parts[0], int(parts[1]), int(parts[2]), int(parts[3].split(".")[0])
+        except (IndexError, ValueError):
+            return self._send(404, b"", "text/plain")
+        tile = proxy.get_tile(layer, z, x, y)
+        if tile is None:
+            return self._send(404, b"", "text/plain")
+        self._send(200, tile[0], tile[1])
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "max-age=86400")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileProxy:
+    # Local HTTP server answering /{layer}/{z}/{x}/{y} from the TileStore; misses are fetched from
+    # the `upstreams` URL templates through one pooled session.
+    EVICT_EVERY = 500
+
+    def __init__(self, db_path, upstreams, api_key="", max_bytes=None, max_age=None, timeout=15):
+        self.store = TileStore(db_path, max_bytes=max_bytes, max_age=max_age)
+        self.upstreams = upstreams
+        self.api_key = api_key
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        self.counter_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.local_sources = {}
+        self.server = None
+        self.thread = None
+
+    def add_source(self, layer, get_tile):
+        # Serves /{layer}/{z}/{x}/{y} from get_tile(z, x, y) -> (data, content_type) or None.
+        self.local_sources[layer] = get_tile
+
+    def stats(self):
+        with self.counter_lock:
+            return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+    def _count(self, name):
+        metrics.count(f"tile_proxy.{name}")
+        with self.counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+            return self.misses
+
+    def get_tile(self, layer, z, x, y):
+        if layer in self.local_sources:
+            return self.local_sources[layer](z, x, y)
+        if layer not in self.upstreams:
+            return None
+        tile = self.store.get(layer, z, x, y)
+        if tile is not None:
+            self._count("hits")
+            return tile
+        misses = self._count("misses")
+        url = self.upstreams[layer].format(z=z, x=x, y=y, key=self.api_key)
         try:
-            geonames_resp = requests.get(f"http://api.geonames.org/searchJSON?q={city}&maxRows=1&username=demo")
-            population = geonames_resp.json().get('geonames', [{}])[0].get('population', '-')
+            with metrics.span("tile_proxy.upstream", layer=layer, z=z) as span:
+                resp = self.session.get(url, timeout=self.timeout)
+                span["status"] = resp.status_code
         except Exception:
-            population = "-"
-    try:
-        weather_resp = requests.get(f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true")
-        weather = weather_resp.json()['current_weather']
-        temp = weather.get('temperature', '-')
-        wind = weather.get('windspeed', '-')
-    except Exception:
-        temp, wind = "-", "-"
+            self._count("errors")
+            return None
+        metrics.count("tile_proxy.bytes", len(resp.content))
+        if resp.status_code != 200:
+            self._count("errors")
+            return None
+        content_type = resp.headers.get("Content-Type", "application/octet-stream")
+        self.store.put(layer, z, x, y, resp.content, content_type)
+        if misses % self.EVICT_EVERY == 0:
+            self.store.evict()
+        return resp.content, content_type
+
+    def start(self, host="127.0.0.1", port=0):
+        self.store.evict()
+        self.server = ThreadingHTTPServer((host, port), TileProxyHandler)
+        self.server.daemon_threads = True
+        self.server.proxy = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.session.close()
+        self.store.close()
+
+
+
+# --- BUILDING VECTOR TILES ---
+MVT_EXTENT = 4096
+
+def _pb_varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _pb_bytes(field, data):
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(data)) + data
+
+def _pb_uint(field, n):
+    return _pb_varint(field << 3) + _pb_varint(n)
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def _mvt_value(v):
+    if isinstance(v, bool):
+        return _pb_uint(7, int(v))
+    if isinstance(v, int):
+        return _pb_uint(5, v) if v >= 0 else _pb_uint(6, _zigzag(v))
+    if isinstance(v, float):
+        return _pb_varint(3 << 3 | 1) + struct.pack("<d", v)
+    return _pb_bytes(1, str(v).encode("utf-8"))
+
+def mvt_polygon_geometry(rings, exterior=None):
+    # Rings are integer (k, 2) arrays without the closing point. The first ring of each polygon
+    # (`exterior` flags, default: only ring 0) is wound with positive area, the others negative.
+    cmds = []
+    cx = cy = 0
+    for i, ring in enumerate(rings):
+        if len(ring) < 3:
+            continue
+        area = np.sum(ring[:, 0] * np.roll(ring[:, 1], -1) - np.roll(ring[:, 0], -1) * ring[:, 1])
+        is_exterior = (i == 0) if exterior is None else exterior[i]
+        if (area < 0) == is_exterior:
+            ring = ring[::-1]
+        d = np.diff(ring, axis=0)
+        cmds += [9, _zigzag(int(ring[0, 0]) - cx), _zigzag(int(ring[0, 1]) - cy), 2 | (len(d) << 3)]
+        cmds += np.where(d >= 0, d << 1, ((-d) << 1) - 1).ravel().tolist()
+        cmds.append(15)
+        cx, cy = int(ring[-1, 0]), int(ring[-1, 1])
+    return b"".join(_pb_varint(c) for c in cmds)
+
+def encode_mvt_layer(name, features, extent=MVT_EXTENT):
+    # features: iterable of (id or None, geometry bytes, properties dict).
+    keys, values, encoded = {}, {}, []
+    for fid, geometry, props in features:
+        if not geometry:
+            continue
+        tags = []
+        for k, v in props.items():
+            if v is None:
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault((type(v), v), len(values)))
+        feature = _pb_uint(1, fid) if fid is not None else b""
+        feature += _pb_bytes(2, b"".join(_pb_varint(t) for t in tags)) + _pb_uint(3, 3) + _pb_bytes(4, geometry)
+        encoded.append(_pb_bytes(2, feature))
+    if not encoded:
+        return b""
+    layer = (_pb_uint(15, 2) + _pb_bytes(1, name.encode("utf-8")) + b"".join(encoded)
+             + b"".join(_pb_bytes(3, k.encode("utf-8")) for k in keys)
+             + b"".join(_pb_bytes(4, _mvt_value(v[1])) for v in values)
+             + _pb_uint(5, extent))
+    return _pb_bytes(3, layer)
+
+
+def building_lod(coords, ring_offsets, feature_rings, zoom, simplify=True, tolerance_px=0.5, min_area_px=2.0,
+                 tile_size=512, extent=MVT_EXTENT, passes=10):
+    # Level of detail for a whole store at one zoom, vectorised over every ring at once:
+    # - coordinates are quantized to fixed-point world units (extent units per tile),
+    # - consecutive duplicates collapse,
+    # - with `simplify`, vertices whose Visvalingam triangle is under tolerance_px^2 are dropped
+    #   (local minima only, rings never go below 3 vertices),
+    # - with `simplify`, features whose exterior ring covers less than min_area_px are culled.
+    # Returns (world int64 coords without closing points, ring_offsets, ring_valid, feature_valid).
+    unit = extent / tile_size
+    rings = np.repeat(np.arange(len(ring_offsets) - 1), np.diff(ring_offsets))
+    open_mask = np.ones(len(coords), dtype=bool)
+    open_mask[ring_offsets[1:][np.diff(ring_offsets) > 0] - 1] = False
+    pts, rings = coords[open_mask], rings[open_mask]
+    scale = (2 ** zoom) * extent
+    world = np.empty((len(pts), 2), dtype=np.int64)
+    world[:, 0] = np.rint((pts[:, 0] + 180.0) / 360.0 * scale)
+    world[:, 1] = np.rint((1.0 - np.arcsinh(np.tan(np.radians(pts[:, 1]))) / np.pi) / 2.0 * scale)
+
+    def neighbours(rings):
+        n = len(rings)
+        starts = np.flatnonzero(np.r_[True, rings[1:] != rings[:-1]]) if n else np.empty(0, dtype=np.int64)
+        ends = np.r_[starts[1:], n] - 1
+        prev = np.arange(n) - 1
+        nxt = np.arange(n) + 1
+        if n:
+            prev[starts] = ends
+            nxt[ends] = starts
+        position = np.arange(n) - np.repeat(starts, ends - starts + 1)
+        return prev, nxt, position
+
+    prev, nxt, _ = neighbours(rings)
+    keep = np.any(world != world[prev], axis=1) | (prev == np.arange(len(world)))
+    world, rings = world[keep], rings[keep]
+
+    if simplify:
+        threshold = 2.0 * (tolerance_px * unit) ** 2
+        for _ in range(passes):
+            prev, nxt, position = neighbours(rings)
+            d_prev = (world[prev] - world).astype(np.float64)
+            d_next = (world[nxt] - world).astype(np.float64)
+            area2 = np.abs(d_prev[:, 0] * d_next[:, 1] - d_next[:, 0] * d_prev[:, 1])
+            cand = area2 < threshold
+            even = position % 2 == 0
+
+            def beats(j):
+                return ~cand[j] | (area2 < area2[j]) | ((area2 == area2[j]) & even & ~even[j])
+
+            remove = cand & beats(prev) & beats(nxt)
+            remaining = np.bincount(rings[~remove], minlength=len(ring_offsets) - 1)
+            remove &= remaining[rings] >= 3
+            if not remove.any():
+                break
+            world, rings = world[~remove], rings[~remove]
+
+    counts = np.bincount(rings, minlength=len(ring_offsets) - 1)
+    new_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    ring_valid = counts >= 3
+    first_ring = feature_rings[:-1]
+    feature_valid = ring_valid[first_ring] if len(first_ring) else np.zeros(0, dtype=bool)
+    if simplify and len(first_ring):
+        x = world[:, 0].astype(np.float64)
+        y = world[:, 1].astype(np.float64)
+        prev, nxt, _ = neighbours(rings)
+        cross = x * y[nxt] - x[nxt] * y
+        area = np.zeros(len(counts))
+        np.add.at(area, rings, cross)
+        feature_valid &= np.abs(area[first_ring]) / 2.0 >= min_area_px * unit * unit
+    return world, new_offsets, ring_valid, feature_valid
+
+
+AGGREGATE_CELL_DEG = 0.002
+
+def footprint_areas(store):
+    # Footprint area of every feature in m^2 (local equirectangular projection, holes subtracted).
+    if not len(store):
+        return np.zeros(0)
+    lat0 = math.radians(float(np.mean(store.coords[:, 1])))
+    x = store.coords[:, 0] * 111320.0 * math.cos(lat0)
+    y = store.coords[:, 1] * 110540.0
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    cross = np.append(cross, 0.0)
+    cross[store.ring_offsets[1:] - 1] = 0.0
+    ring_area = np.abs(np.add.reduceat(cross, store.ring_offsets[:-1])) / 2.0
+    ring_area[np.diff(store.ring_offsets) == 0] = 0.0
+    signed = np.where(store.ring_exterior.astype(bool), ring_area, -ring_area)
+    return np.maximum(np.add.reduceat(signed, store.feature_rings[:-1]), 0.0)
+
+def aggregate_store(store, cell=AGGREGATE_CELL_DEG):
+    # Bins the buildings of a store into a global lon/lat grid by centroid; returns per-cell partial
+    # sums so the results of several stores can be combined with combine_aggregates.
+    centroids = store.centroids()
+    heights = np.nan_to_num(store.render_height.astype(np.float64), nan=DEFAULT_RENDER_HEIGHT)
+    cells = np.floor(centroids / cell).astype(np.int64)
+    keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    height_max = np.zeros(len(keys))
+    np.maximum.at(height_max, inverse, heights)
     return {
-        'lat': lat, 'lon': lon,
-        'country': country, 'region': region,
-        'population': population, 'temp': temp, 'wind': wind, 'city': city
+        "cells": keys.reshape(-1, 2),
+        "count": np.bincount(inverse, minlength=len(keys)).astype(np.float64),
+        "area": np.bincount(inverse, footprint_areas(store), minlength=len(keys)),
+        "height_sum": np.bincount(inverse, heights, minlength=len(keys)),
+        "height_max": height_max,
     }
 
+def combine_aggregates(parts):
+    parts = [p for p in parts if len(p["cells"])]
+    if not parts:
+        return None
+    cells = np.concatenate([p["cells"] for p in parts])
+    keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    combined = {"cells": keys.reshape(-1, 2)}
+    for name in ("count", "area", "height_sum"):
+        combined[name] = np.bincount(inverse, np.concatenate([p[name] for p in parts]), minlength=len(keys))
+    combined["height_max"] = np.zeros(len(keys))
+    np.maximum.at(combined["height_max"], inverse, np.concatenate([p["height_max"] for p in parts]))
+    return combined
 
-def export_osm_buildings(api_user_adgent, city="Paris", output="buildings_cache.geojson", d=0.045):
-    url_nom = f"https://nominatim.openstreetmap.org/search?q={city}&format=json"
-    headers = {'User-Agent': f'ICX Tools OSM Extraction ({api_user_adgent})'} 
-    
-    resp_nom_raw = requests.get(url_nom, headers=headers)
-    if resp_nom_raw.status_code != 200:
-        raise Exception(f"Nominatim error {resp_nom_raw.status_code}: {resp_nom_raw.text[:200]}")
-    resp_nom = resp_nom_raw.json()
-    if not resp_nom:
-        raise Exception(f"City {city} not found or no data found!")
 
-    lat, lon = float(resp_nom[0]["lat"]), float(resp_nom[0]["lon"])
-    bbox = f"{lat-d},{lon-d},{lat+d},{lon+d}"
-    query = f"""
-    [out:json][timeout:90];
-    (
-      way["building"]({bbox});
-    );
-    out body;
-    >;
-    out skel qt;
-    """
+class BuildingVectorTiles:
+    # Slices the tiled building cache into Mapbox Vector Tiles on request. Cache tiles are mapped the
+    # first time they are needed, each building goes to the tile holding its anchor (no clipping),
+    # geometry comes from the per-zoom building_lod (simplified and culled below full_detail_zoom),
+    # and encoded tiles are memoized. Up to aggregate_max_zoom tiles carry the per-cell aggregate
+    # layer instead of individual buildings. Tiles are encoded outside the lock (one encode per tile at
+    # a time); stores dropped while encodes run are closed once the last one finishes.
+    CONTENT_TYPE = "application/x-protobuf"
 
-    overpass_urls = [
-        "https://overpass-api.de/api/interpreter",
-        "https://overpass.kumi.systems/api/interpreter",
-        "https://z.overpass-api.de/api/interpreter"
-    ]
-    resp_ov = None
-    for overpass_url in overpass_urls:
-        try:
-            resp_ov = requests.post(overpass_url, data={"data": query}, headers=headers, timeout=120)
-            if resp_ov.status_code == 200:
-                break
-            else:
-                print(f"Instance {overpass_url} code {resp_ov.status_code}")
-        except Exception as ex:
-            print(f"Erreur Overpass sur {overpass_url} : {ex}")  
-    if not resp_ov or resp_ov.status_code != 200:
-        raise Exception(f"Overpass error {resp_ov.status_code if resp_ov else '-'}: {resp_ov.text[:200] if resp_ov else 'No response'}")
+    def __init__(self, cache, layer="buildings", aggregate_layer="aggregate", minzoom=10, aggregate_max_zoom=12,
+                 full_detail_zoom=15, memo_size=512):
+        self.cache = cache
+        self.layer = layer
+        self.aggregate_layer = aggregate_layer
+        self.minzoom = minzoom
+        self.aggregate_max_zoom = aggregate_max_zoom
+        self.full_detail_zoom = full_detail_zoom
+        self.aggregates = {}
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+        self.memo = OrderedDict()
+        self.loaded = {}
+        self.pending = {}
+        self.encoding = 0
+        self.retired = []
+        self.generation = 0
 
-    data = resp_ov.json()
+    def _release(self, store):
+        # Called under the lock.
+        if self.encoding:
+            self.retired.append(store)
+        else:
+            store.close()
 
-    nodes = {str(n["id"]): (float(n["lon"]), float(n["lat"])) for n in data.get("elements", []) if n["type"] == "node"}
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.memo.clear()
+            for data in self.loaded.values():
+                if data is not None:
+                    self._release(data[0])
+            self.loaded.clear()
+            self.aggregates.clear()
 
-    geojson = {"type": "FeatureCollection", "features": []}
-    count = 0
-    for elem in data.get("elements", []):
-        if elem["type"] == "way" and "nodes" in elem:
-            coords = [nodes.get(str(nid)) for nid in elem["nodes"] if str(nid) in nodes]
-            if len(coords) < 3:
+    def invalidate_tiles(self, tiles):
+        # Forgets what was built from the given cache tiles (after they were fetched or updated).
+        tiles = set(tiles)
+        with self.lock:
+            self.generation += 1
+            for tile in tiles:
+                data = self.loaded.pop(self.cache.key(tile), None)
+                if data is not None:
+                    self._release(data[0])
+                self.aggregates.pop(self.cache.key(tile), None)
+            for z, x, y in list(self.memo):
+                if not tiles.isdisjoint(self._cache_tiles(z, x, y)):
+                    del self.memo[(z, x, y)]
+
+    def prune(self):
+        # Releases the stores of the tiles that left the cache (evicted or refetched under a new file name).
+        with self.cache.lock:
+            current = {key: entry["file"] for key, entry in self.cache.tiles.items()}
+        with self.lock:
+            for key in [key for key, data in self.loaded.items()
+                        if data is not None and os.path.basename(data[0].path) != current.get(key)]:
+                self._release(self.loaded.pop(key)[0])
+                self.aggregates.pop(key, None)
+
+    def trim(self, center, max_bytes):
+        # Releases the loaded cache tiles farthest from `center` (a cache tile) until the in-memory
+        # part (anchors and per-zoom LODs; the stores themselves are mmapped) fits in max_bytes.
+        with self.lock:
+            sizes = {}
+            for key, data in self.loaded.items():
+                if data is not None:
+                    sizes[key] = data[1].nbytes + sum(a.nbytes for lod in data[2].values() for a in lod)
+            total = sum(sizes.values())
+            by_distance = sorted(sizes, key=lambda k: -max(abs(int(k.split("/")[1]) - center[0]),
+                                                           abs(int(k.split("/")[2]) - center[1])))
+            released = 0
+            for key in by_distance:
+                if total <= max_bytes:
+                    break
+                self._release(self.loaded.pop(key)[0])
+                total -= sizes[key]
+                released += 1
+            return released
+
+    def _aggregate(self, tile):
+        key = self.cache.key(tile)
+        with self.lock:
+            if key in self.aggregates:
+                return self.aggregates[key]
+            data = self.loaded.get(key)
+            generation = self.generation
+        aggregate = self.cache.aggregate(tile, data[0] if data else None)
+        with self.lock:
+            if generation == self.generation:
+                self.aggregates.setdefault(key, aggregate)
+        return aggregate
+
+    def encode_aggregate(self, z, x, y, cell=AGGREGATE_CELL_DEG):
+        combined = combine_aggregates([a for a in (self._aggregate(t) for t in self._cache_tiles(z, x, y)) if a])
+        if combined is None:
+            return b""
+        south, west, north, east = tile_bounds(x, y, z)
+        centers = (combined["cells"] + 0.5) * cell
+        inside = np.flatnonzero((centers[:, 0] >= west) & (centers[:, 0] < east)
+                                & (centers[:, 1] > south) & (centers[:, 1] <= north))
+        if not len(inside):
+            return b""
+        scale = (2 ** z) * MVT_EXTENT
+        corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float64)
+        lonlat = (combined["cells"][inside][:, None, :] + corners[None, :, :]) * cell
+        px = np.rint((lonlat[..., 0] + 180.0) / 360.0 * scale) - x * MVT_EXTENT
+        py = np.rint((1.0 - np.arcsinh(np.tan(np.radians(lonlat[..., 1]))) / np.pi) / 2.0 * scale) - y * MVT_EXTENT
+        rings = np.stack((px, py), axis=-1).astype(np.int64)
+        lat_mid = np.radians(centers[inside, 1])
+        cell_area = (cell * 111320.0) * (cell * 110540.0) * np.cos(lat_mid)
+        features = []
+        for k, c in enumerate(inside.tolist()):
+            count = combined["count"][c]
+            features.append((None, mvt_polygon_geometry([rings[k]]), {
+                "count": int(count),
+                "area": round(float(combined["area"][c]), 1),
+                "coverage": round(min(float(combined["area"][c] / cell_area[k]), 1.0), 3),
+                "mean_height": round(float(combined["height_sum"][c] / count), 1),
+                "max_height": round(float(combined["height_max"][c]), 1),
+            }))
+        return encode_mvt_layer(self.aggregate_layer, features)
+
+    def _load(self, tile):
+        key = self.cache.key(tile)
+        with self.lock:
+            if key in self.loaded:
+                return self.loaded[key]
+            generation = self.generation
+        store = self.cache.open_store(tile)
+        data = None if store is None else (store, store.anchors(), {})
+        with self.lock:
+            if key in self.loaded or generation != self.generation:
+                # Loaded by another encode, or invalidated meanwhile: this copy only serves the current one.
+                if store is not None:
+                    self.retired.append(store)
+                return self.loaded.get(key, data)
+            self.loaded[key] = data
+        return data
+
+    def _lod(self, data, z):
+        # Per-zoom LOD of a whole cache tile, computed once; zooms past full_detail_zoom share one entry.
+        store, _, lods = data
+        z = min(z, self.full_detail_zoom)
+        lod = lods.get(z)
+        if lod is None:
+            lod = building_lod(store.coords, store.ring_offsets, store.feature_rings, z,
+                               simplify=z < self.full_detail_zoom)
+            with self.lock:
+                lod = lods.setdefault(z, lod)
+        return lod
+
+    def _cache_tiles(self, z, x, y):
+        cz = self.cache.zoom
+        if z >= cz:
+            return [(x >> (z - cz), y >> (z - cz))]
+        k = 1 << (cz - z)
+        return [(cx, cy) for cy in range(y * k, (y + 1) * k) for cx in range(x * k, (x + 1) * k)]
+
+    def encode(self, z, x, y):
+        if z < self.minzoom:
+            return b""
+        if z <= self.aggregate_max_zoom:
+            return self.encode_aggregate(z, x, y)
+        south, west, north, east = tile_bounds(x, y, z)
+        selected = []
+        for tile in self._cache_tiles(z, x, y):
+            data = self._load(tile)
+            if data is None:
                 continue
-            if coords[0] != coords[-1]:
-                coords.append(coords[0])
-            props = elem.get('tags', {})
-
-            info_keys = [
-                'name', 'building', 'building:levels', 'height',
-                'roof:shape', 'roof:material', 'roof:height',
-                'addr:street', 'addr:housenumber', 'addr:postcode', 'addr:city',
-                'start_date', 'amenity', 'shop', 'office', 'industrial',
-                'website', 'brand', 'condition', 'surface', 'source'
-            ]
-            properties_dict = {k: props.get(k, None) for k in info_keys if k in props}
-            for k, v in props.items():
-                if k not in properties_dict:
-                    properties_dict[k] = v
-
-            geojson["features"].append({
-                "type": "Feature",
-                "geometry": {"type": "Polygon", "coordinates": [coords]},
-                "properties": properties_dict
-            })
-            count += 1
-
-    with open(output, "w", encoding="utf-8") as f:
-        json.dump(geojson, f)
-    print(f"Buildings saved to {output} ({count} buildings)")
-    return lat, lon
+            store, anchors, _ = data
+            world, ring_offsets, ring_valid, feature_valid = self._lod(data, z)
+            shift = z - min(z, self.full_detail_zoom)
+            origin = np.array([x, y], dtype=np.int64) * MVT_EXTENT
+            inside = (feature_valid & (anchors[:, 0] >= west) & (anchors[:, 0] < east)
+                      & (anchors[:, 1] > south) & (anchors[:, 1] <= north))
+            for i in np.flatnonzero(inside).tolist():
+                rings, exterior = [], []
+                skip = False
+                for r in range(store.feature_rings[i], store.feature_rings[i + 1]):
+                    if store.ring_exterior[r]:
+                        skip = not ring_valid[r]
+                    if skip or not ring_valid[r]:
+                        continue
+                    rings.append((world[ring_offsets[r]:ring_offsets[r + 1]] << shift) - origin)
+                    exterior.append(bool(store.ring_exterior[r]))
+                geometry = mvt_polygon_geometry(rings, exterior)
+                fid = int(store.ids[i])  # MVT ids are unsigned: relations (negative ids) go without
+                selected.append((fid if fid >= 0 else None, geometry, store.properties(i, TILE_PROPERTIES)))
+        return encode_mvt_layer(self.layer, selected)
+
+    def get_tile(self, z, x, y):
+        key = (z, x, y)
+        while True:
+            with self.lock:
+                if key in self.memo:
+                    self.memo.move_to_end(key)
+                    metrics.count("vector_tiles.memo_hit")
+                    return self.memo[key], self.CONTENT_TYPE
+                pending = self.pending.get(key)
+                if pending is None:
+                    # This request encodes the tile; the concurrent ones wait for it then read the memo.
+                    pending = self.pending[key] = threading.Event()
+                    self.encoding += 1
+                    generation = self.generation
+                    break
+            pending.wait()
+        data = None
+        try:
+            with metrics.span("render.vector_tile", z=z, x=x, y=y) as span:
+                data = self.encode(z, x, y)
+                span["bytes"] = len(data)
+        finally:
+            with self.lock:
+                del self.pending[key]
+                self.encoding -= 1
+                if data is not None and generation == self.generation:
+                    self.memo[key] = data
+                    if len(self.memo) > self.memo_size:
+                        self.memo.popitem(last=False)
+                if not self.encoding:
+                    for store in self.retired:
+                        store.close()
+                    self.retired.clear()
+            pending.set()
+        return data, self.CONTENT_TYPE
+
+
+# --- SPATIAL INDEX ---
+STR_NODE_SIZE = 16
+METERS_PER_DEG_LAT = 110540.0
+METERS_PER_DEG_LON = 111320.0
+
+def feature_bboxes(store):
+    # (n, 4) west, south, east, north of every feature.
+    if not len(store):
+        return np.empty((0, 4))
+    starts = store.ring_offsets[store.feature_rings[:-1]]
+    return np.hstack((np.minimum.reduceat(store.coords, starts, axis=0), np.maximum.reduceat(store.coords, starts, axis=0)))
+
+def build_str_index(store, node_size=STR_NODE_SIZE):
+    # Sort-Tile-Recursive packed R-tree. Leaves are the feature boxes in STR order (`order`), every
+    # upper level packs node_size consecutive boxes of the level below; all levels are stored leaf
+    # first in `boxes`, delimited by `level_offsets`. `id_order` sorts the features by way id.
+    boxes = feature_bboxes(store)
+    n = len(boxes)
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+    slice_size = node_size * max(1, math.ceil(math.sqrt(math.ceil(n / node_size)))) if n else 1
+    by_x = np.argsort(centers[:, 0], kind="stable")
+    slice_of = np.empty(n, dtype=np.int64)
+    slice_of[by_x] = np.arange(n) // slice_size
+    order = np.lexsort((centers[:, 1], slice_of))
+    levels = [boxes[order]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        starts = np.arange(0, len(level), node_size)
+        levels.append(np.hstack((np.minimum.reduceat(level[:, :2], starts, axis=0),
+                                 np.maximum.reduceat(level[:, 2:], starts, axis=0))))
+    level_offsets = np.zeros(len(levels) + 1, dtype=np.int64)
+    np.cumsum([len(level) for level in levels], out=level_offsets[1:])
+    return {
+        "order": order.astype(np.int64),
+        "boxes": np.vstack(levels) if n else np.empty((0, 4)),
+        "level_offsets": level_offsets,
+        "node_size": np.array(node_size),
+        "id_order": np.argsort(store.ids, kind="stable").astype(np.int64),
+    }
+
+def str_query(index, west, south, east, north):
+    # Features whose bbox intersects the query box, walked level by level from the root.
+    offsets, boxes, node_size = index["level_offsets"], index["boxes"], int(index["node_size"])
+    if len(offsets) < 2:
+        return np.empty(0, dtype=np.int64)
+    nodes = np.arange(offsets[-1] - offsets[-2])
+    for level in range(len(offsets) - 2, -1, -1):
+        if level < len(offsets) - 2:
+            nodes = (nodes[:, None] * node_size + np.arange(node_size)).ravel()
+            nodes = nodes[nodes < offsets[level + 1] - offsets[level]]
+        b = boxes[offsets[level] + nodes]
+        nodes = nodes[(b[:, 0] <= east) & (b[:, 2] >= west) & (b[:, 1] <= north) & (b[:, 3] >= south)]
+        if not len(nodes):
+            break
+    return index["order"][nodes]
+
+def feature_edges(store, features):
+    # Segments (a, b) of every ring of `features`, with the position in `features` they belong to.
+    rings, counts = feature_ring_index(store.feature_rings, features)
+    coords, offsets = take_rings(store.coords, store.ring_offsets, rings)
+    owner = np.repeat(np.repeat(np.arange(len(features)), counts), np.diff(offsets))
+    keep = np.ones(len(coords), dtype=bool)
+    keep[offsets[1:] - 1] = False
+    keep = np.flatnonzero(keep)
+    return coords[keep], coords[keep + 1], owner[keep]
+
+def point_feature_distances(store, features, lon, lat):
+    # Distance in metres from (lon, lat) to each feature footprint, 0 inside (even-odd rule, so holes count).
+    a, b, owner = feature_edges(store, features)
+    kx = METERS_PER_DEG_LON * math.cos(math.radians(lat))
+    ax, ay = (a[:, 0] - lon) * kx, (a[:, 1] - lat) * METERS_PER_DEG_LAT
+    bx, by = (b[:, 0] - lon) * kx, (b[:, 1] - lat) * METERS_PER_DEG_LAT
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((ay > 0) != (by > 0)) & (0 < ax + (bx - ax) * (0 - ay) / (by - ay))
+        dx, dy = bx - ax, by - ay
+        t = np.clip(np.nan_to_num(-(ax * dx + ay * dy) / (dx * dx + dy * dy)), 0.0, 1.0)
+    edge_distance = np.hypot(ax + t * dx, ay + t * dy)
+    distances = np.full(len(features), np.inf)
+    np.minimum.at(distances, owner, edge_distance)
+    inside = np.bincount(owner, crosses, minlength=len(features)) % 2 == 1
+    distances[inside] = 0.0
+    return distances
+
+
+class BuildingIndex:
+    # Query side of the building cache for the viewer: point hit tests, bbox and nearest queries on
+    # the per-tile STR trees (built once, saved with the cache) and lookups by OSM way id. Buildings
+    # live in the tile of their anchor, so queries also look at the neighbouring cache tiles.
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.loaded = {}
+        self.id_table = None
+
+    def close(self):
+        with self.lock:
+            for data in self.loaded.values():
+                if data is not None:
+                    data[0].close()
+            self.loaded.clear()
+            self.id_table = None
+
+    def prune(self):
+        # Releases the tiles that left the cache (evicted or refetched under a new file name).
+        with self.cache.lock:
+            tiles = list(self.cache.tiles.items())  # viewport and city loads change the dict meanwhile
+        with self.lock:
+            current = {entry["file"] for _, entry in tiles}
+            for name in [name for name in self.loaded if name not in current]:
+                data = self.loaded.pop(name)
+                if data is not None:
+                    data[0].close()
+            self.id_table = None
+
+    def _load(self, tile):
+        entry = self.cache.tiles.get(self.cache.key(tile))
+        if not entry:
+            return None
+        if entry["file"] not in self.loaded:
+            store = self.cache.open_store(tile)
+            self.loaded[entry["file"]] = None if store is None else (store, self.cache.spatial_index(tile, store))
+        return self.loaded[entry["file"]]
 
+    def _search(self, west, south, east, north):
+        x0, y0 = lonlat_to_tile(west, north, self.cache.zoom)
+        x1, y1 = lonlat_to_tile(east, south, self.cache.zoom)
+        for y in range(y0 - 1, y1 + 2):
+            for x in range(x0 - 1, x1 + 2):
+                data = self._load((x, y))
+                if data is not None:
+                    features = str_query(data[1], west, south, east, north)
+                    if len(features):
+                        yield data[0], features
+
+    @staticmethod
+    def _summary(store, i, **extra):
+        lon, lat = ring_centroids(*take_rings(store.coords, store.ring_offsets, store.feature_rings[i:i + 1]))[0]
+        return dict({"id": int(store.ids[i]), "lon": round(float(lon), 7), "lat": round(float(lat), 7),
+                     "properties": store.properties(i)}, **extra)
+
+    def hit_test(self, lon, lat):
+        # Building under the point; the smallest footprint wins (building:part inside a building).
+        with self.lock:
+            best = None
+            for store, features in self._search(lon, lat, lon, lat):
+                hits = features[point_feature_distances(store, features, lon, lat) == 0.0]
+                if not len(hits):
+                    continue
+                areas = np.array([np.ptp(store.rings(i)[0], axis=0).prod() for i in hits.tolist()])
+                k = int(np.argmin(areas))
+                if best is None or areas[k] < best[0]:
+                    best = (float(areas[k]), store, int(hits[k]))
+            return None if best is None else self._summary(best[1], best[2])
+
+    def bbox(self, west, south, east, north, limit=1000):
+        with self.lock:
+            result = []
+            for store, features in self._search(west, south, east, north):
+                for i in features[:limit - len(result)].tolist():
+                    result.append(self._summary(store, i))
+                if len(result) >= limit:
+                    break
+            return result
+
+    def nearest(self, lon, lat, max_distance=250.0):
+        # Closest footprint within max_distance metres (0 when the point is inside one); the search
+        # box grows from 25 m until something is found.
+        with self.lock:
+            radius = min(25.0, max_distance)
+            while True:
+                dlat = radius / METERS_PER_DEG_LAT
+                dlon = radius / (METERS_PER_DEG_LON * max(math.cos(math.radians(lat)), 1e-6))
+                best = None
+                for store, features in self._search(lon - dlon, lat - dlat, lon + dlon, lat + dlat):
+                    distances = point_feature_distances(store, features, lon, lat)
+                    k = int(np.argmin(distances))
+                    if distances[k] <= radius and (best is None or distances[k] < best[0]):
+                        best = (float(distances[k]), store, int(features[k]))
+                if best is not None:
+                    return self._summary(best[1], best[2], distance=round(best[0], 2))
+                if radius >= max_distance:
+                    return None
+                radius = min(radius * 4.0, max_distance)
+
+    def _id_table(self):
+        # Sorted way ids of every cached tile, rebuilt when the set of tile files changes.
+        with self.cache.lock:
+            tiles = list(self.cache.tiles.items())  # viewport and city loads change the dict meanwhile
+        files = sorted(entry["file"] for _, entry in tiles)
+        if self.id_table is None or self.id_table[0] != files:
+            stores, ids, owners, positions = [], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], \
+                [np.empty(0, dtype=np.int64)]
+            for key, _ in tiles:
+                _, x, y = key.split("/")
+                data = self._load((int(x), int(y)))
+                if data is None:
+                    continue
+                store, index = data
+                ids.append(store.ids[index["id_order"]])
+                owners.append(np.full(len(store), len(stores), dtype=np.int64))
+                positions.append(index["id_order"])
+                stores.append(store)
+            ids, owners, positions = np.concatenate(ids), np.concatenate(owners), np.concatenate(positions)
+            order = np.argsort(ids, kind="stable")
+            self.id_table = (files, ids[order], owners[order], positions[order], stores)
+        return self.id_table
+
+    def get_building(self, way_id):
+        # Full GeoJSON feature (every stored tag) of an OSM way.
+        with self.lock:
+            _, ids, owners, positions, stores = self._id_table()
+            k = int(np.searchsorted(ids, int(way_id)))
+            if k >= len(ids) or ids[k] != int(way_id):
+                return None
+            return stores[owners[k]].feature(int(positions[k]))
+
+
+class ViewerSession:
+    # Persistent viewer for in-process city switches: the page stays loaded while the new city is
+    # geocoded, extracted and looked up on one background worker. The page is driven through
+    # evaluate_js: cityLoading (fly-to as soon as the city is located), then setCity (info panel and
+    # building source refresh) or cityFailed. A newer request supersedes one still in progress.
+    def __init__(self, tile_cache, city_cache, building_tiles, building_index, user_agent, d=0.02,
+                 keep_tags=None, overpass_mode="geom", offline=False):
+        self.tile_cache = tile_cache
+        self.city_cache = city_cache
+        self.building_tiles = building_tiles
+        self.building_index = building_index
+        self.user_agent = user_agent
+        self.d = d
+        self.keep_tags = keep_tags
+        self.overpass_mode = overpass_mode
+        self.offline = offline
+        self.window = None
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.worker = ThreadPoolExecutor(max_workers=1)
+
+    def switch_city(self, city):
+        city = (city or "").strip()
+        if not city:
+            return {"status": "ignored"}
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+        self.worker.submit(self._load_city, city, generation)
+        return {"status": "loading", "city": city}
+
+    def _current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def _load_city(self, city, generation):
+        if not self._current(generation):
+            return
+        t0 = time.perf_counter()
+        try:
+            geo = geocode_city(city, self.city_cache, self.offline, fallback=None)
+            self._push("cityLoading", {"city": city, "lat": geo["lat"], "lon": geo["lon"]}, generation)
+            export_osm_buildings(self.user_agent, city=city, output=None, d=self.d, cache=self.tile_cache,
+                                 center=(geo["lat"], geo["lon"]), offline=self.offline, keep_tags=self.keep_tags,
+                                 overpass_mode=self.overpass_mode)
+            infos = get_city_infos(city, cache=self.city_cache, offline=self.offline)
+        except Exception as e:
+            print(f"City switch to {city} failed: {e}")
+            self._push("cityFailed", {"city": city, "error": str(e)}, generation)
+            return
+        self.building_tiles.invalidate()
+        self.building_index.prune()
+        infos["seconds"] = round(time.perf_counter() - t0, 2)
+        print(f"Switched to {city} in {infos['seconds']} s")
+        self._push("setCity", infos, generation)
+        if self._current(generation):
+            try:
+                self.window.set_title(f"3D MapTiler/OSM Map + Satellite Terrain – {city}")
+            except Exception:
+                pass
+
+    def _push(self, function, payload, generation):
+        if self.window is None or not self._current(generation):
+            return
+        self.window.evaluate_js(f"{function}({json.dumps(payload)})")
+
+    def close(self):
+        self.worker.shutdown(wait=False)
+
+
+class ViewportLoader:
+    # Grows the building cache with exploration. The page reports its bounds on moveend; the cache
+    # tiles of the view plus a prefetch margin (nearest first, at most max_tiles) that are missing or
+    # stale are fetched on a pool of `workers` threads, skipping tiles the view has left before
+    # their turn came. Updated tiles are dropped from the vector tile memo and the building index,
+    # and the page is told (at most every push_delay seconds) which cache tiles to reload. Loaded
+    # tiles far from the view are released past max_loaded_bytes.
+    def __init__(self, cache, building_tiles, user_agent, keep_tags=None, overpass_mode="geom", workers=2,
+                 margin=0.5, max_tiles=48, min_zoom=12.0, max_loaded_bytes=256 * 1024 * 1024, offline=False,
+                 push_delay=1.0, building_index=None):
+        self.cache = cache
+        self.building_tiles = building_tiles
+        self.building_index = building_index
+        self.headers = {'User-Agent': f'ICX Tools OSM Extraction ({user_agent})'}
+        self.keep_tags = keep_tags
+        self.queries = OVERPASS_QUERY_MODES[overpass_mode]
+        self.query_hash = overpass_query_hash(self.queries["full"], keep_tags=keep_tags)
+        self.margin = margin
+        self.max_tiles = max_tiles
+        self.min_zoom = min_zoom
+        self.max_loaded_bytes = max_loaded_bytes
+        self.offline = offline
+        self.push_delay = push_delay
+        self.window = None
+        self.lock = threading.Lock()
+        self.wanted = set()
+        self.in_flight = set()
+        self.updated = set()
+        self.push_timer = None
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def viewport(self, west, south, east, north, zoom):
+        dx, dy = (east - west) * self.margin, (north - south) * self.margin
+        center = lonlat_to_tile((west + east) / 2.0, (south + north) / 2.0, self.cache.zoom)
+        self.building_tiles.trim(center, self.max_loaded_bytes)
+        if zoom < self.min_zoom:
+            with self.lock:
+                self.wanted = set()
+            return {"tiles": 0, "queued": 0}
+        tiles = self.cache.tiles_for_bbox(max(south - dy, -85.0), max(west - dx, -180.0),
+                                          min(north + dy, 85.0), min(east + dx, 180.0))
+        tiles = sorted(tiles, key=lambda t: max(abs(t[0] - center[0]), abs(t[1] - center[1])))[:self.max_tiles]
+        with self.lock:
+            self.wanted = set(tiles)
+            todo = [] if self.offline else [t for t in self.cache.missing(tiles, self.query_hash) if t not in self.in_flight]
+            self.in_flight.update(todo)
+        for run in sorted(tile_runs(todo), key=lambda r: min(max(abs(t[0] - center[0]), abs(t[1] - center[1])) for t in r)):
+            self.pool.submit(self._load, run)
+        return {"tiles": len(tiles), "queued": len(todo)}
+
+    def _load(self, run):
+        with self.lock:
+            skipped = [t for t in run if t not in self.wanted]
+            run = [t for t in run if t in self.wanted]
+            self.in_flight.difference_update(skipped)
+        try:
+            stale = [t for t in run if self.cache.refreshable(t, self.query_hash)]
+            update_building_tiles(self.cache, [t for t in run if t not in stale], stale, self.query_hash,
+                                  self.headers, self.keep_tags, self.queries)
+        except Exception as e:
+            print(f"Background building load failed: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.difference_update(run)
+        if not run:
+            return
+        self.building_tiles.invalidate_tiles(run)
+        self.cache.evict(protect=self.wanted)
+        self.building_tiles.prune()  # stores of refetched or evicted tiles
+        if self.building_index is not None:
+            self.building_index.prune()
+        self.cache.retry_removals()  # files that were still mapped when evicted (Windows)
+        with self.lock:
+            self.updated.update(run)
+            if self.push_timer is None:
+                self.push_timer = threading.Timer(self.push_delay, self._push)
+                self.push_timer.daemon = True
+                self.push_timer.start()
+
+    def _push(self):
+        with self.lock:
+            updated, self.updated, self.push_timer = self.updated, set(), None
+        if self.window is not None and updated:
+            self.window.evaluate_js(f"buildingsUpdated({json.dumps({'tiles': sorted(updated)})})")
+
+    def close(self):
+        with self.lock:
+            self.wanted = set()
+            if self.push_timer is not None:
+                self.push_timer.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ViewerApi:
+    # pywebview js_api: window.pywebview.api.<method>(...) from the page.
+    def __init__(self, index, session=None, loader=None):
+        self._index = index
+        self._session = session
+        self._loader = loader
+
+    def metrics(self, events, tiles=None):
+        # Viewer-side timings (ms since the page started) and building tile fetch totals.
+        for event in events:
+            event = dict(event)
+            metrics.event(f"viewer.{event.pop('name', 'unnamed')}", **event)
+        if tiles and tiles.get("count"):
+            metrics.count("viewer.building_tiles", int(tiles["count"]))
+            metrics.count("viewer.building_tiles.bytes", int(tiles.get("bytes") or 0))
+            metrics.event("viewer.building_tiles", **tiles)
+        return True
+
+    def viewport(self, west, south, east, north, zoom):
+        if self._loader is None:
+            return {"tiles": 0, "queued": 0}
+        return self._loader.viewport(float(west), float(south), float(east), float(north), float(zoom))
+
+    def switch_city(self, city):
+        if self._session is None:
+            return {"status": "unavailable"}
+        return self._session.switch_city(str(city))
+
+    def hit_test(self, lon, lat):
+        return self._index.hit_test(float(lon), float(lat))
+
+    def bbox(self, west, south, east, north, limit=1000):
+        return self._index.bbox(float(west), float(south), float(east), float(north), int(limit))
+
+    def nearest(self, lon, lat, max_distance=250):
+        return self._index.nearest(float(lon), float(lat), float(max_distance))
+
+    def get_building(self, way_id):
+        return self._index.get_building(int(way_id))
 
 
 # --- HTML TEMPLATE ---
@@ -224,11 +3629,16 @@ HTML_TEMPLATE = """
 </head>
 <body>
   <div class="bar">
-    <b>City: {city}</b><br/>
-    <small>Coordinates: {lat:.5f}, {lon:.5f}</small><br>
-    <small>Country: <b>{country}</b>, Region: <b>{region}</b></small><br>
-    <small>Population: <b>{population}</b></small><br>
-    <small>Weather: <b>{temp}°C</b> / Wind: <b>{wind} km/h</b></small>
+    <b>City: <span id="city_name">{city}</span></b><br/>
+    <small>Coordinates: <span id="city_coords">{lat:.5f}, {lon:.5f}</span></small><br>
+    <small>Country: <b id="city_country">{country}</b>, Region: <b id="city_region">{region}</b></small><br>
+    <small>Population: <b id="city_population">{population}</b></small><br>
+    <small>Weather: <b id="city_temp">{temp}°C</b> / Wind: <b id="city_wind">{wind} km/h</b></small>
+    <div class="slider-container">
+      <input type="text" id="city_input" placeholder="Go to city…" size="16">
+      <button id="city_go">Go</button>
+      <small id="city_status"></small>
+    </div>
     <br><label for="style">Style: </label>
     <select id="style">
       <option value="DEFAULT">Default</option>
@@ -263,6 +3673,27 @@ HTML_TEMPLATE = """
       'SATELLITE': maptilersdk.MapStyle.SATELLITE,
       'DARK': maptilersdk.MapStyle.DARK,
     }};
+    // Version of each building cache tile (zoom {building_cache_zoom}), bumped when the background
+    // loader updated it: a building tile URL carries the versions of the cache tiles it covers, so
+    // only the tiles whose data changed bypass the browser cache.
+    let buildingTileVersions = {{}};
+    let buildingReloadFallback = false;  // warned once
+    function coveredCacheTiles(z, x, y) {{
+      const cz = {building_cache_zoom};
+      if (z >= cz) return [[x >> (z - cz), y >> (z - cz)]];
+      const k = 1 << (cz - z), tiles = [];
+      for (let cy = y * k; cy < (y + 1) * k; cy++)
+        for (let cx = x * k; cx < (x + 1) * k; cx++) tiles.push([cx, cy]);
+      return tiles;
+    }}
+    function buildingTileRequest(url, resourceType) {{
+      let m = resourceType === 'Tile' && url.match(/\/buildings\/(\d+)\/(\d+)\/(\d+)\.pbf/);
+      if (!m) return {{url: url}};
+      let version = 0;
+      for (const [cx, cy] of coveredCacheTiles(+m[1], +m[2], +m[3])) version += buildingTileVersions[cx + '/' + cy] || 0;
+      return {{url: version ? url + (url.indexOf('?') < 0 ? '?' : '&') + 't=' + version : url}};
+    }}
+
     let map = new maptilersdk.Map({{
       container: "map",
       style: styleList.STREETS,
@@ -270,7 +3701,8 @@ HTML_TEMPLATE = """
       zoom: 13,
       pitch: 45,
       bearing: -17.6,
-      enableTerrain: true
+      enableTerrain: true,
+      transformRequest: buildingTileRequest
     }});
     map.addControl(new maptilersdk.NavigationControl(), 'top-right');
     let initial = {{
@@ -283,6 +3715,115 @@ HTML_TEMPLATE = """
       opac_sat: "0.55"
     }};
     let terrainEnabled = true;
+    let cityMarker;
+    let buildingsVersion = 0;
+
+    // Viewer timings relayed to Python (ViewerApi.metrics): ms since the page started, plus the
+    // building tile fetches seen by the browser.
+    let viewerTimings = [];
+    let buildingTileStats = {{count: 0, total_ms: 0, max_ms: 0, bytes: 0}};
+    function viewerTiming(name, fields) {{
+      viewerTimings.push(Object.assign({{name: name, ms: Math.round(performance.now() * 10) / 10}}, fields || {{}}));
+    }}
+    function flushViewerTimings() {{
+      if (!(window.pywebview && window.pywebview.api && window.pywebview.api.metrics)) return;
+      if (!viewerTimings.length && !buildingTileStats.count) return;
+      window.pywebview.api.metrics(viewerTimings.splice(0), buildingTileStats);
+      buildingTileStats = {{count: 0, total_ms: 0, max_ms: 0, bytes: 0}};
+    }}
+    if (window.PerformanceObserver) {{
+      new PerformanceObserver(function(list) {{
+        list.getEntries().forEach(function(e) {{
+          if (e.name.indexOf('/buildings/') < 0) return;
+          buildingTileStats.count += 1;
+          buildingTileStats.total_ms += e.duration;
+          buildingTileStats.max_ms = Math.max(buildingTileStats.max_ms, e.duration);
+          buildingTileStats.bytes += e.transferSize || e.encodedBodySize || 0;
+        }});
+      }}).observe({{entryTypes: ['resource']}});
+    }}
+    window.addEventListener('pywebviewready', flushViewerTimings);
+
+    // City switching: the page stays, Python pushes cityLoading / setCity / cityFailed.
+    function requestCity() {{
+      let name = document.getElementById("city_input").value.trim();
+      if (!name) return;
+      if (!(window.pywebview && window.pywebview.api && window.pywebview.api.switch_city)) {{
+        document.getElementById("city_status").textContent = "City switching needs the viewer window.";
+        return;
+      }}
+      document.getElementById("city_status").textContent = "Locating " + name + "…";
+      window.pywebview.api.switch_city(name);
+      viewerTiming('city_requested', {{city: name}});
+    }}
+    document.getElementById("city_go").onclick = requestCity;
+    document.getElementById("city_input").onkeydown = function(e) {{
+      if (e.key === "Enter") requestCity();
+    }};
+    function cityLoading(info) {{
+      document.getElementById("city_status").textContent = "Loading " + info.city + "…";
+      initial.center = [info.lon, info.lat];
+      if (cityMarker) cityMarker.setLngLat(initial.center);
+      map.flyTo({{center: initial.center, zoom: initial.zoom, pitch: initial.pitch, bearing: initial.bearing, essential: true}});
+    }}
+    function setCity(info) {{
+      document.getElementById("city_name").textContent = info.city;
+      document.getElementById("city_coords").textContent = info.lat.toFixed(5) + ", " + info.lon.toFixed(5);
+      document.getElementById("city_country").textContent = info.country;
+      document.getElementById("city_region").textContent = info.region;
+      document.getElementById("city_population").textContent = info.population;
+      document.getElementById("city_temp").textContent = info.temp + "°C";
+      document.getElementById("city_wind").textContent = info.wind + " km/h";
+      document.getElementById("city_status").textContent = "Loaded in " + info.seconds + " s";
+      document.title = "3D MapTiler/OSM Map + Satellite Terrain – " + info.city;
+      initial.center = [info.lon, info.lat];
+      if (cityMarker) cityMarker.setLngLat(initial.center);
+      refreshBuildingSource();
+      viewerTiming('city_shown', {{city: info.city}});
+      map.once('idle', function() {{
+        viewerTiming('city_rendered', {{city: info.city}});
+        flushViewerTimings();
+      }});
+    }}
+    function refreshBuildingSource() {{
+      // New tile URLs so tiles the browser cached before the extraction are requested again.
+      buildingsVersion += 1;
+      let source = map.getSource('osm_buildings');
+      if (source && source.setTiles) source.setTiles(['{buildings_tiles_url}?v=' + buildingsVersion]);
+    }}
+    function buildingsUpdated(info) {{
+      // Reloads only the loaded building tiles over the updated cache tiles. MapLibre's tile cache
+      // is internal (checked against the MapLibre of the pinned SDK, v3.8.0 above): when it is not
+      // found, the whole source is refreshed through the public setTiles.
+      let changed = {{}};
+      for (const [x, y] of info.tiles) {{
+        changed[x + '/' + y] = true;
+        buildingTileVersions[x + '/' + y] = (buildingTileVersions[x + '/' + y] || 0) + 1;
+      }}
+      let caches = map.style && (map.style.tileManagers || map.style.sourceCaches);
+      let cache = caches && caches['osm_buildings'];
+      if (!cache || !cache._tiles || !cache._reloadTile) {{
+        if (!buildingReloadFallback) console.warn("buildingsUpdated: MapLibre tile cache not found, refreshing the whole building source");
+        buildingReloadFallback = true;
+        refreshBuildingSource();
+        return;
+      }}
+      for (const id in cache._tiles) {{
+        const c = cache._tiles[id].tileID.canonical;
+        if (coveredCacheTiles(c.z, c.x, c.y).some(t => changed[t[0] + '/' + t[1]])) cache._reloadTile(id, 'reloading');
+      }}
+      map.triggerRepaint();
+    }}
+    function updateCityInfos(info) {{
+      // Population and weather fetched after a cache-first start.
+      if (document.getElementById("city_name").textContent !== info.city) return;
+      document.getElementById("city_population").textContent = info.population;
+      document.getElementById("city_temp").textContent = info.temp + "°C";
+      document.getElementById("city_wind").textContent = info.wind + " km/h";
+    }}
+    function cityFailed(info) {{
+      document.getElementById("city_status").textContent = "Could not load " + info.city + ": " + info.error;
+    }}
 
     function setBothBuildingsOpacity(val) {{
       if (map.getLayer('Building 3D')) {{
@@ -291,6 +3832,9 @@ HTML_TEMPLATE = """
       if (map.getLayer('osm_buildings_layer')) {{
         map.setPaintProperty('osm_buildings_layer', 'fill-extrusion-opacity', parseFloat(val));
       }}
+      if (map.getLayer('osm_buildings_aggregate')) {{
+        map.setPaintProperty('osm_buildings_aggregate', 'fill-extrusion-opacity', parseFloat(val));
+      }}
     }}
     function setSatOpacity(val) {{
       if (map.getLayer('satellite_layer')) {{
@@ -334,7 +3878,7 @@ HTML_TEMPLATE = """
         if (!map.getSource('terrain')) {{
           map.addSource('terrain', {{
             type: 'raster-dem',
-            url: 'https://api.maptiler.com/tiles/terrain-rgb/tiles.json?key={api_key}',
+            tiles: ['{terrain_tiles_url}'],
             tileSize: 256,
             maxzoom: 12
           }});
@@ -345,9 +3889,10 @@ HTML_TEMPLATE = """
       }}
     }};
     map.on('load', function () {{
+      viewerTiming('map_load');
       map.addSource('terrain', {{
         type: 'raster-dem',
-        url: 'https://api.maptiler.com/tiles/terrain-rgb/tiles.json?key={api_key}',
+        tiles: ['{terrain_tiles_url}'],
         tileSize: 256,
         maxzoom: 12
       }});
@@ -357,7 +3902,7 @@ HTML_TEMPLATE = """
       map.addSource('satellite', {{
         type: 'raster',
         tiles: [
-          'https://api.maptiler.com/tiles/satellite/{{z}}/{{x}}/{{y}}.jpg?key={api_key}'
+          '{satellite_tiles_url}'
         ],
         tileSize: 256
       }});
@@ -393,41 +3938,62 @@ HTML_TEMPLATE = """
       }}, labelLayerId);
       setBothBuildingsOpacity(document.getElementById("opacity").value);
 
-      fetch('{geojson_cache_filename}')
-        .then(function(response) {{
-          if (!response.ok) {{
-            console.error('GeoJSON loading error: ' + response.statusText + ' for ' + '{geojson_cache_filename}');
-            return {{ "type": "FeatureCollection", "features": [] }};
-          }}
-          return response.json();
-        }})
-        .then(function(geojson) {{
-          if (!geojson || geojson.features.length === 0) {{
-            console.warn("Loaded GeoJSON is empty or invalid.");
-            return;
-          }}
-          map.addSource('osm_buildings', {{ type: 'geojson', data: geojson }});
-          map.addLayer({{
-            id: 'osm_buildings_layer',
-            type: 'fill-extrusion',
-            source: 'osm_buildings',
-            paint: {{
-              'fill-extrusion-color': '#d4af37',
-              'fill-extrusion-height': [
-                'coalesce',
-                ['to-number', ['get', 'height']],
-                30
-              ],
-              'fill-extrusion-opacity': parseFloat(document.getElementById("opacity").value)
-            }}
-          }});
-          setBothBuildingsOpacity(document.getElementById("opacity").value);
-        }})
-        .catch(function(error) {{
-          console.error("Critical GeoJSON fetch error:", error);
-        }});
+      map.addSource('osm_buildings', {{
+        type: 'vector',
+        tiles: ['{buildings_tiles_url}'],
+        tileSize: 512,
+        minzoom: 10,
+        maxzoom: 15
+      }});
+      viewerTiming('buildings_source_added');
+      map.on('sourcedata', function onBuildingsData(e) {{
+        if (e.sourceId !== 'osm_buildings' || !e.isSourceLoaded) return;
+        viewerTiming('buildings_loaded');
+        map.off('sourcedata', onBuildingsData);
+      }});
+      map.once('idle', function() {{
+        viewerTiming('first_render');
+        flushViewerTimings();
+      }});
+      map.addLayer({{
+        id: 'osm_buildings_aggregate',
+        type: 'fill-extrusion',
+        source: 'osm_buildings',
+        'source-layer': 'aggregate',
+        maxzoom: {aggregate_below_zoom},
+        paint: {{
+          'fill-extrusion-color': ['interpolate', ['linear'], ['get', 'coverage'], 0, '#f3e5ab', 0.3, '#d4af37', 0.6, '#8a6d1d'],
+          'fill-extrusion-height': ['get', 'mean_height'],
+          'fill-extrusion-opacity': parseFloat(document.getElementById("opacity").value)
+        }}
+      }});
+      map.addLayer({{
+        id: 'osm_buildings_layer',
+        type: 'fill-extrusion',
+        source: 'osm_buildings',
+        'source-layer': 'buildings',
+        minzoom: {aggregate_below_zoom},
+        paint: {{
+          'fill-extrusion-color': '#d4af37',
+          'fill-extrusion-height': ['get', 'render_height'],
+          'fill-extrusion-base': ['get', 'render_min_height'],
+          'fill-extrusion-opacity': parseFloat(document.getElementById("opacity").value)
+        }}
+      }});
+      setBothBuildingsOpacity(document.getElementById("opacity").value);
 
-      new maptilersdk.Marker().setLngLat([ {lon}, {lat} ]).addTo(map);
+      cityMarker = new maptilersdk.Marker().setLngLat(initial.center).addTo(map);
+
+      // Background building loading around the view (Python side: ViewportLoader).
+      function reportViewport() {{
+        if (!(window.pywebview && window.pywebview.api && window.pywebview.api.viewport)) return;
+        let b = map.getBounds();
+        window.pywebview.api.viewport(b.getWest(), b.getSouth(), b.getEast(), b.getNorth(), map.getZoom());
+      }}
+      map.on('moveend', reportViewport);
+      map.on('moveend', flushViewerTimings);
+      window.addEventListener('pywebviewready', reportViewport);
+      reportViewport();
 
       map.on('move', function() {{
         let z = map.getZoom().toFixed(2);
@@ -437,53 +4003,91 @@ HTML_TEMPLATE = """
           '<br/>Zoom: ' + z + ' / Pitch: ' + pitch + ' / Bearing: ' + bearing;
       }});
 
-      map.on('click', function(e) {{
-        var buildingFeatures = map.queryRenderedFeatures(e.point, {{
-          layers: ['Building 3D', 'osm_buildings_layer']
+      // OSM tag keys and values are user data: always escaped before going into popup HTML.
+      function escapeHtml(value) {{
+        return String(value).replace(/[&<>"']/g, function(c) {{
+          return {{'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}}[c];
         }});
-                
+      }}
+
+      function buildingPopupHtml(props, extra) {{
+        let infoHtml = "<h4>" + escapeHtml(props.name || props.amenity || props.building || "Building") + "</h4>";
+        let height_val = props.height || props.render_height;
+        if (height_val) {{
+          try {{ height_val = parseFloat(height_val).toFixed(1); }} catch (e) {{}}
+          infoHtml += "<b>Height:</b> " + escapeHtml(height_val) + (props.height ? "m" : "m (estimated)") + "<br/>";
+        }}
+        if (props['building:levels']) {{
+          infoHtml += "<b>Floors:</b> " + escapeHtml(props['building:levels']) + "<br/>";
+        }}
+        if (props.building) {{
+          infoHtml += "<b>Type:</b> " + escapeHtml(props.building) + "<br/>";
+        }} else if (props.amenity) {{
+          infoHtml += "<b>Usage:</b> " + escapeHtml(props.amenity) + "<br/>";
+        }}
+        if (props["addr:street"]) {{
+            infoHtml += "<b>Adresse:</b> " + escapeHtml(props["addr:street"]);
+            if (props["addr:housenumber"]) infoHtml += " " + escapeHtml(props["addr:housenumber"]);
+            if (props["addr:postcode"]) infoHtml += ", " + escapeHtml(props["addr:postcode"]);
+            if (props["addr:city"]) infoHtml += " " + escapeHtml(props["addr:city"]);
+            infoHtml += "<br/>";
+         }}
+        if (extra) {{
+          // Tags only known to the Python side index (not carried by the rendered tiles).
+          let shown = ['name', 'amenity', 'building', 'height', 'building:levels', 'addr:street', 'addr:housenumber',
+                       'addr:postcode', 'addr:city', 'render_height', 'render_min_height', 'render_levels'];
+          for (let key in props) {{
+            if (shown.indexOf(key) < 0) infoHtml += "<b>" + escapeHtml(key) + ":</b> " + escapeHtml(props[key]) + "<br/>";
+          }}
+          infoHtml += "<small>" + (extra.id < 0 ? "OSM relation " + escapeHtml(-extra.id) : "OSM way " + escapeHtml(extra.id)) + "</small>";
+        }}
+        return infoHtml;
+      }}
+
+      map.on('click', function(e) {{
         if (typeof currentPopup !== 'undefined' && currentPopup) {{
           currentPopup.remove();
           currentPopup = null;
         }}
-        if (buildingFeatures.length > 0) {{
-          let props = buildingFeatures[0].properties;
-          
-         
-          let coords = e.lngLat;
-          let infoHtml = "<h4>" + (props.name || props.amenity || props.building || "Building") + "</h4>";
-          let height_val = props.height || props.render_height;
-          if (height_val) {{
-            try {{ height_val = parseFloat(height_val).toFixed(1); }} catch (e) {{}}
-            infoHtml += "<b>Height:</b> " + height_val + (props.height ? "m" : "m (estimated)") + "<br/>";
-          }}
-          if (props['building:levels']) {{
-            infoHtml += "<b>Floors:</b> " + props['building:levels'] + "<br/>";
-          }}
-          if (props.building) {{
-            infoHtml += "<b>Type:</b> " + props.building + "<br/>";
-          }} else if (props.amenity) {{
-            infoHtml += "<b>Usage:</b> " + props.amenity + "<br/>";
-          }}
+        if (window.pywebview && window.pywebview.api && window.pywebview.api.hit_test
+            && map.getZoom() >= {aggregate_below_zoom}) {{
+          window.pywebview.api.hit_test(e.lngLat.lng, e.lngLat.lat).then(function(building) {{
+            if (!building) {{
+              renderedFeaturePopup(e);
+              return;
+            }}
+            currentPopup = new maptilersdk.Popup({{offset: 25}})
+              .setLngLat(e.lngLat)
+              .setHTML(buildingPopupHtml(building.properties, building))
+              .addTo(map);
+          }}).catch(function() {{ renderedFeaturePopup(e); }});
+        }} else {{
+          renderedFeaturePopup(e);
+        }}
+      }});
 
-          //alert(props);
-              
-          if (props["addr:street"]) {{
-              infoHtml += "<b>Adresse:</b> " + props["addr:street"];
-              if (props["addr:housenumber"]) infoHtml += " " + props["addr:housenumber"];
-              if (props["addr:postcode"]) infoHtml += ", " + props["addr:postcode"];
-              if (props["addr:city"]) infoHtml += " " + props["addr:city"];
-              infoHtml += "<br/>";
-           }}    
-              
-              
-              
-              
+      function renderedFeaturePopup(e) {{
+        var buildingFeatures = map.queryRenderedFeatures(e.point, {{
+          layers: ['Building 3D', 'osm_buildings_layer']
+        }});
+        if (buildingFeatures.length > 0) {{
           currentPopup = new maptilersdk.Popup({{offset: 25}})
-            .setLngLat(coords)
-            .setHTML(infoHtml)
+            .setLngLat(e.lngLat)
+            .setHTML(buildingPopupHtml(buildingFeatures[0].properties))
             .addTo(map);
         }} else {{
+          var cellFeatures = map.queryRenderedFeatures(e.point, {{
+            layers: ['osm_buildings_aggregate']
+          }});
+          if (cellFeatures.length > 0) {{
+            let cell = cellFeatures[0].properties;
+            currentPopup = new maptilersdk.Popup({{offset: 25}})
+              .setLngLat(e.lngLat)
+              .setHTML("<b>Buildings:</b> " + cell.count + "<br/><b>Built area:</b> " + Math.round(cell.area) + " m²" +
+                       "<br/><b>Mean height:</b> " + cell.mean_height + "m<br/><b>Max height:</b> " + cell.max_height + "m")
+              .addTo(map);
+            return;
+          }}
           var roadFeatures = map.queryRenderedFeatures(e.point, {{
             layers: ['road', 'transportation', 'transportation-name']
           }});
@@ -493,13 +4097,13 @@ HTML_TEMPLATE = """
             if (roadName) {{
               currentPopup = new maptilersdk.Popup({{offset: 25}})
                 .setLngLat(e.lngLat)
-                .setHTML("<b>Road:</b> " + roadName)
+                .setHTML("<b>Road:</b> " + escapeHtml(roadName))
                 .addTo(map);
               return;
             }}
           }}
         }}
-      }});
+      }}
     }});
   </script>
 </body>
@@ -507,6 +4111,8 @@ HTML_TEMPLATE = """
 """
 
 if __name__ == '__main__':
+    timer = StartupTimer()
+    timer.mark("imports")
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--Path', type=str, default='.', help='Path.')
@@ -515,7 +4121,51 @@ if __name__ == '__main__':
     parser.add_argument('--City', type=str, default="New York", help='City Name.')
     parser.add_argument('--AskCity', action='store_true', help='Tkinter dialog to enter city name')
     parser.add_argument('--ForceOSM', action='store_true', help='Force extraction/save of OSM cache at each launch')
+    parser.add_argument('--RefreshOSM', action='store_true', help='Update the cached buildings from the OSM changes since they were fetched.')
+    parser.add_argument('--CacheMaxMB', type=int, default=512, help='Size cap of the building tile cache (0 = unlimited).')
+    parser.add_argument('--ExportGeoJSON', type=str, default='', help='Also export the buildings around the city to this GeoJSON file.')
+    parser.add_argument('--ExportExtended', action='store_true', help='Exported GeoJSON features also carry the OSM id and the render_* properties.')
+    parser.add_argument('--KeepTags', type=str, default='all', help="OSM tags kept in the building cache (the map tiles only carry the viewer ones): 'all', 'viewer' or a comma separated list.")
+    parser.add_argument('--CacheMaxAgeDays', type=int, default=30, help='Refetch building tiles older than this (0 = never).')
+    parser.add_argument('--AggregateBelowZoom', type=int, default=14, help='Show the building density grid instead of single buildings below this zoom.')
+    parser.add_argument('--ViewportWorkers', type=int, default=2, help='Parallel background building loads around the view (0 = only the initial area).')
+    parser.add_argument('--LiveCacheMaxMB', type=int, default=256, help='Memory for building tiles kept ready to serve; the farthest are released first.')
+    parser.add_argument('--NoTileProxy', action='store_true', help='Load satellite/terrain tiles directly from MapTiler.')
+    parser.add_argument('--TileProxyPort', type=int, default=0, help='Port of the local tile proxy (0 = any free port).')
+    parser.add_argument('--TileCacheMaxMB', type=int, default=1024, help='Size cap of the satellite/terrain tile cache (0 = unlimited).')
+    parser.add_argument('--TileCacheMaxAgeDays', type=int, default=30, help='Refetch satellite/terrain tiles older than this (0 = never).')
+    parser.add_argument('--OverpassMode', choices=sorted(OVERPASS_QUERY_MODES), default='geom',
+                        help="'geom': inline way geometry and multipolygon relations, 'nodes': node list + way refs.")
+    parser.add_argument('--ExtractWorkers', type=int, default=EXTRACT_WORKERS, help='Overpass queries run in parallel for one extraction.')
+    parser.add_argument('--ExtractMaxBuildings', type=int, default=EXTRACT_MAX_BUILDINGS, help='Estimated buildings per Overpass query; larger areas are split.')
+    parser.add_argument('--OverpassMirrors', type=str, default=",".join(OVERPASS_URLS), help='Comma separated Overpass interpreter URLs.')
+    parser.add_argument('--Offline', action='store_true', help='Do not touch the network, launch from cached data only.')
+    parser.add_argument('--Batch', type=str, default='', help="Headless pre-warm of a city list (file, one city per line, or 'Paris;Lyon').")
+    parser.add_argument('--BatchWorkers', type=int, default=4, help='Cities processed in parallel in batch mode.')
+    parser.add_argument('--BatchState', type=str, default='', help='Resumable batch state/report file (default: <Path>/batch_state.json).')
+    parser.add_argument('--BatchExportDir', type=str, default='', help='Also write one GeoJSON file per city to this directory in batch mode.')
+    parser.add_argument('--RateLimits', type=str, default='', help="Per upstream requests/s[/burst], e.g. 'nominatim=1,overpass=0.5/2'.")
+    parser.add_argument('--GeoNamesUser', type=str, default='', help='GeoNames account used when Wikidata has no population (default: $GEONAMES_USERNAME, none = skip).')
+    parser.add_argument('--Endpoints', type=str, default='', help="Upstream base URLs, e.g. 'nominatim=http://localhost:8081,open-meteo=http://localhost:8082'.")
+    parser.add_argument('--Metrics', type=str, default='', help='Append spans, counters and viewer timings to this JSON lines file.')
+    parser.add_argument('--Profile', type=str, default='', help='Profile the building extraction (cProfile + tracemalloc) into files starting with this path.')
+    parser.add_argument('--StartupReport', type=str, default='', help='Write the startup timing breakdown to this JSON file.')
+    parser.add_argument('--ExitAfterStartup', action='store_true', help='Close the viewer as soon as its window is shown (benchmarks).')
+    parser.add_argument('--StartupBudgetMs', type=int, default=0, help='Warn when startup to window takes longer than this (0 = no budget).')
     args = parser.parse_args()
+    ENDPOINTS.update({name: url.rstrip("/") for name, url in parse_mapping(args.Endpoints).items()})
+    if args.Metrics:
+        metrics.open(args.Metrics)
+    rate_limiter.configure(parse_rate_limits(args.RateLimits))
+    if args.GeoNamesUser:
+        GEONAMES_USERNAME = args.GeoNamesUser
+    EXTRACT_WORKERS = args.ExtractWorkers
+    GEOJSON_EXTENDED = args.ExportExtended
+    EXTRACT_MAX_BUILDINGS = args.ExtractMaxBuildings
+
+    probe = ConnectivityProbe()
+    if not args.Offline:
+        probe.start()
 
     MAPTILER_API_KEY = args.API_KEY
     
@@ -532,57 +4182,159 @@ if __name__ == '__main__':
         if not city:
             sys.exit(0)
     
-    if not (internet_connection_1() or internet_connection_2()):
-        print("No Internet Connection !!!")
-        sys.exit(1)
-    
     if not os.path.exists(args.Path):
         os.makedirs(args.Path)
+    overpass_mirrors = OverpassMirrorPool([u.strip() for u in args.OverpassMirrors.split(",") if u.strip()],
+                                          state_path=os.path.join(args.Path, "overpass_mirrors.json"))
+    timer.mark("args")
     
     d_box = 0.02
-    geojson_cache_filename = "buildings_cache.geojson"
-    geojson_cache_path = os.path.join(args.Path, geojson_cache_filename)
-    
-    should_extract = args.ForceOSM or not os.path.exists(geojson_cache_path) or (os.path.exists(geojson_cache_path) and os.stat(geojson_cache_path).st_size == 0)
-    if should_extract:
-        if OVERPY_AVAILABLE:
-            print("Extracting OSM buildings cache…")
-            try:
-                export_osm_buildings(API_USER_AGENT,city=city, output=geojson_cache_path, d=d_box)
-            except Exception as e:
-                print(f"OSM extraction failed: {e}")
-        else:
-            print("WARNING: Extraction skipped because the 'overpy' module is not installed.")
-    if not os.path.exists(geojson_cache_path) or os.stat(geojson_cache_path).st_size == 0:
-        print(f"Creating empty GeoJSON cache file: {geojson_cache_path}.")
-        with open(geojson_cache_path, "w", encoding="utf-8") as f:
-            json.dump({"type": "FeatureCollection", "features": []}, f)
+    if args.KeepTags == 'all':
+        keep_tags = None
+    elif args.KeepTags == 'viewer':
+        keep_tags = VIEWER_KEEP_TAGS
+    else:
+        keep_tags = [t.strip() for t in args.KeepTags.split(",") if t.strip()]
+    tile_cache = BuildingTileCache(
+        os.path.join(args.Path, "osm_tiles"),
+        max_bytes=args.CacheMaxMB * 1024 * 1024 if args.CacheMaxMB > 0 else None,
+        max_age=args.CacheMaxAgeDays * 86400 if args.CacheMaxAgeDays > 0 else None
+    )
     
-    print(f"OSM cache found: {geojson_cache_path}. Preparing for browser loading.")
-    infos = get_city_infos(city)
+    city_cache = TTLCache(os.path.join(args.Path, "city_infos_cache.json"))
+    if args.Batch:
+        batch = BatchPrewarm(tile_cache, city_cache, API_USER_AGENT,
+                             args.BatchState or os.path.join(args.Path, "batch_state.json"), d=d_box, keep_tags=keep_tags,
+                             workers=args.BatchWorkers, export_dir=args.BatchExportDir or None, force=args.ForceOSM,
+                             refresh=args.RefreshOSM, overpass_mode=args.OverpassMode)
+        if args.Profile:
+            print("--Profile covers the extraction of a viewer launch, not batch mode")
+        failed = batch.run(read_city_list(args.Batch))
+        if args.Metrics:
+            metrics.report()
+            metrics.close()
+        sys.exit(1 if failed else 0)
+    # Only block on the connectivity probe when nothing is cached for this city.
+    offline = args.Offline or probe.offline_known()
+    city_cached = city_cache.get(f"geocode:{city.lower()}") is not None
+    if not offline and not city_cached:
+        offline = not probe.wait(timeout=8)
+    if offline:
+        print("Offline mode: launching from cached data only.")
+    try:
+        infos = get_city_infos(city, cache=city_cache, offline=offline, cached_only=city_cached)
+    except Exception as e:
+        print(f"No Internet Connection !!! ({e})" if offline else f"City lookup failed: {e}")
+        sys.exit(1)
+    # Cache-first start: the window opens with the cached infos while the population and weather
+    # (when missing or expired) are fetched, then pushed into the page once it is loaded.
+    infos_worker = ThreadPoolExecutor(max_workers=1)
+    infos_update = None if offline or not city_cached else infos_worker.submit(get_city_infos, city, city_cache)
+    timer.mark("city_infos")
+
+    print("Extracting OSM buildings cache…")
+    try:
+        with profile_section(os.path.join(args.Path, args.Profile)) if args.Profile else nullcontext():
+            export_osm_buildings(API_USER_AGENT, city=city, output=args.ExportGeoJSON or None, d=d_box,
+                                 cache=tile_cache, center=(infos['lat'], infos['lon']), force=args.ForceOSM,
+                                 offline=offline or probe.offline_known(), keep_tags=keep_tags, refresh=args.RefreshOSM,
+                                 overpass_mode=args.OverpassMode)
+    except Exception as e:
+        print(f"OSM extraction failed: {e}")
+    print("Preparing for browser loading.")
+    timer.mark("buildings")
+    tile_proxy = TileProxy(
+        os.path.join(args.Path, "tiles_cache.mbtiles"), {} if args.NoTileProxy else MAPTILER_TILE_LAYERS,
+        api_key=MAPTILER_API_KEY,
+        max_bytes=args.TileCacheMaxMB * 1024 * 1024 if args.TileCacheMaxMB > 0 else None,
+        max_age=args.TileCacheMaxAgeDays * 86400 if args.TileCacheMaxAgeDays > 0 else None
+    )
+    # Vector tiles are 512 px, so map zoom Z shows tiles of zoom Z - 1.
+    building_tiles = BuildingVectorTiles(tile_cache, aggregate_max_zoom=args.AggregateBelowZoom - 2)
+    tile_proxy.add_source("buildings", building_tiles.get_tile)
+    building_index = BuildingIndex(tile_cache)
+    session = ViewerSession(tile_cache, city_cache, building_tiles, building_index, API_USER_AGENT, d=d_box,
+                            keep_tags=keep_tags, overpass_mode=args.OverpassMode, offline=offline)
+    loader = None
+    if args.ViewportWorkers > 0:
+        loader = ViewportLoader(tile_cache, building_tiles, API_USER_AGENT, keep_tags=keep_tags,
+                                overpass_mode=args.OverpassMode, workers=args.ViewportWorkers,
+                                max_loaded_bytes=args.LiveCacheMaxMB * 1024 * 1024, offline=offline,
+                                building_index=building_index)
+    tile_proxy_url = tile_proxy.start(port=args.TileProxyPort)
+    print(f"Tile server listening on {tile_proxy_url}")
+    if args.NoTileProxy:
+        tile_urls = {layer: url.replace("{key}", MAPTILER_API_KEY) for layer, url in MAPTILER_TILE_LAYERS.items()}
+    else:
+        tile_urls = {layer: f"{tile_proxy_url}/{layer}/{{z}}/{{x}}/{{y}}" for layer in MAPTILER_TILE_LAYERS}
+    timer.mark("tile_server")
     html_content = HTML_TEMPLATE.format(
         api_key=MAPTILER_API_KEY,
-        geojson_cache_filename=geojson_cache_filename,
+        satellite_tiles_url=tile_urls["satellite"],
+        terrain_tiles_url=tile_urls["terrain-rgb"],
+        buildings_tiles_url=f"{tile_proxy_url}/buildings/{{z}}/{{x}}/{{y}}.pbf",
+        building_cache_zoom=tile_cache.zoom,
+        aggregate_below_zoom=args.AggregateBelowZoom,
         **infos
     )
-    html_temp_filename = "temp_map_viewer.html"
+    html_temp_filename = f"temp_map_viewer_{os.getpid()}.html"  # one per viewer sharing --Path
     html_temp_path = os.path.join(args.Path, html_temp_filename)
     with open(html_temp_path, "w", encoding="utf-8") as f:
         f.write(html_content)
     print(f"Temporary HTML file created: {html_temp_path}.")
+    timer.mark("html")
     
+    def push_city_infos(future):
+        if future.exception() is None and future.result() != infos:
+            window.evaluate_js(f"updateCityInfos({json.dumps(future.result())})")
+
+    def on_window_loaded():
+        if infos_update is not None:
+            infos_update.add_done_callback(push_city_infos)
+
+    def on_window_shown():
+        timer.mark("window_shown")
+        timer.report(args.StartupBudgetMs)
+        if args.ExitAfterStartup:
+            window.destroy()
+
     try:
+        import webview
+        timer.mark("webview_import")
         os.chdir(args.Path)
         print(f"Changed working directory to: {os.getcwd()}")
-        webview.create_window(
+        window = webview.create_window(
             f"3D MapTiler/OSM Map + Satellite Terrain – {city}",
             url=html_temp_path,
             width=1200,
-            height=890
+            height=890,
+            js_api=ViewerApi(building_index, session, loader)
         )
+        session.window = window
+        if loader:
+            loader.window = window
+        window.events.shown += on_window_shown
+        window.events.loaded += on_window_loaded
         webview.start()
     except Exception as e:
         print(f"Error when starting webview: {e}")
+    finally:
+        print(f"Tile proxy stats: {tile_proxy.stats()}")
+        if args.StartupReport:
+            timer.save(args.StartupReport, window_shown=any(name == "window_shown" for name, _ in timer.phases))
+        tile_proxy.stop()
+        infos_worker.shutdown(wait=False)
+        session.close()
+        if loader:
+            loader.close()
+        building_index.close()
+        try:
+            os.remove(html_temp_path)
+        except OSError:
+            pass
+        if args.Metrics:
+            metrics.report()
+            metrics.close()
 
 
    
\ No newline at end of file
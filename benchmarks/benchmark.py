@@ -0,0 +1,854 @@
+# Author(s): Dr. Patrick Lemoine
+
+# Reproducible benchmarks of WebViewMapTilerCache11.py. Synthetic or recorded Overpass responses are
+# replayed by a local stand-in of every upstream (Nominatim, Overpass, Wikidata, GeoNames,
+# Open-Meteo, the connectivity check) with a configurable latency, so nothing touches the network.
+#
+#   python benchmarks/benchmark.py                            synthetic 10k, 100k and 1M ways
+#   python benchmarks/benchmark.py --Sizes 10k,100k --LatencyMs 150 --Repeat 3
+#   python benchmarks/benchmark.py --Record Lyon              record a real Overpass response
+#   python benchmarks/benchmark.py --Fixtures lyon --Sizes ''  benchmark recorded fixtures only
+#   python benchmarks/benchmark.py --Compare old.json new.json
+#   python benchmarks/benchmark.py --CheckMirrors              Overpass mirror racing against stand-ins
+#   python benchmarks/benchmark.py --CheckTileProxy            TileProxy cache and eviction against a stand-in
+#
+# Stages (each in its own process, so the peak RSS is the stage's own):
+#   download           Overpass response streamed from the stand-in
+#   parse              iter_overpass_elements over the fixture
+#   join               parse + node join / ring assembly (write_osm_building_features, no output)
+#   serialize_geojson  join + GeoJSONFeatureWriter
+#   serialize_store    join + one BuildingStoreWriter per cache tile (what fetch_building_tiles does)
+#   export_cold        export_osm_buildings into an empty tile cache, through the stand-in
+#   export_warm        export_osm_buildings again, everything cached
+#   startup_cold/warm  the viewer launched against the stand-in (--StartupReport), up to its window
+# join_only and serialize_only are derived by difference. Results go to benchmarks/results/ as JSON.
+
+import os
+import sys
+import re
+import json
+import math
+import time
+import mmap
+import shutil
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+VIEWER = os.path.join(ROOT, "WebViewMapTilerCache11.py")
+FIXTURE_DIR = os.path.join(HERE, "fixtures")
+RESULT_DIR = os.path.join(HERE, "results")
+
+STAGES = ["download", "parse", "join", "serialize_geojson", "serialize_store", "export_cold", "export_warm"]
+STARTUP_STAGES = ["startup_cold", "startup_warm"]
+
+SYNTHETIC_CENTER = (45.76, 4.83)
+SYNTHETIC_SPACING = 0.0003  # degrees between neighbouring buildings, about 30 m
+SYNTHETIC_OSM_BASE = "2026-01-01T00:00:00Z"
+STAND_IN_TILE_BYTES = 1024
+BENCHMARK_CITY = "Benchmark"
+
+
+def parse_size(spec):
+    # "10k" -> 10000, "1M" -> 1000000
+    spec = spec.strip()
+    scale = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}.get(spec[-1:], 1)
+    return int(float(spec.rstrip("kKmM")) * scale)
+
+
+def peak_rss_mb():
+    # Linux: VmHWM, which starts over at exec (ru_maxrss keeps the peak of the parent at fork).
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def child_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_version():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", VIEWER], cwd=ROOT, capture_output=True,
+                               text=True, timeout=10).stdout.strip()
+        return commit + ("-dirty" if dirty else "") if commit else None
+    except Exception:
+        return None
+
+
+# --- FIXTURES ---
+# A fixture is an Overpass XML response (<name>.osm) plus <name>.json: center, half size `d` of the
+# queried box, layout ("geom" or "nodes", see OVERPASS_QUERY_MODES) and element counts.
+
+def fixture_paths(name):
+    return os.path.join(FIXTURE_DIR, f"{name}.osm"), os.path.join(FIXTURE_DIR, f"{name}.json")
+
+
+def load_fixture(name):
+    osm_path, meta_path = fixture_paths(name)
+    if not os.path.exists(osm_path) or not os.path.exists(meta_path):
+        raise Exception(f"Fixture {name} not found in {FIXTURE_DIR}")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    meta.update(name=name, path=osm_path, bytes=os.path.getsize(osm_path))
+    return meta
+
+
+def synthetic_footprints(n, seed=1):
+    # n buildings on a jittered grid around SYNTHETIC_CENTER: rectangles and L shapes, one in 50 a
+    # courtyard building (a multipolygon relation in the geom layout). Returns the rings and tags.
+    rng = np.random.default_rng(seed)
+    side = int(math.ceil(math.sqrt(n)))
+    half = side * SYNTHETIC_SPACING / 2
+    i = np.arange(n)
+    x = SYNTHETIC_CENTER[1] - half + (i % side) * SYNTHETIC_SPACING + rng.uniform(0, SYNTHETIC_SPACING * 0.3, n)
+    y = SYNTHETIC_CENTER[0] - half + (i // side) * SYNTHETIC_SPACING + rng.uniform(0, SYNTHETIC_SPACING * 0.3, n)
+    w = rng.uniform(0.00008, 0.0002, n)
+    h = rng.uniform(0.00008, 0.0002, n)
+    shape = rng.random(n)
+    levels = rng.integers(1, 12, n)
+    kinds = np.array(["yes", "house", "apartments", "commercial", "industrial"])[rng.integers(0, 5, n)]
+    tag_draw = rng.random((n, 4))
+    for k in range(n):
+        x0, y0, x1, y1 = x[k], y[k], x[k] + w[k], y[k] + h[k]
+        if shape[k] < 0.8:
+            outer = [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+        else:
+            xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+            outer = [(x0, y0), (x1, y0), (x1, ym), (xm, ym), (xm, y1), (x0, y1), (x0, y0)]
+        inner = None
+        if k % 50 == 49:
+            outer = [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+            dx, dy = (x1 - x0) * 0.3, (y1 - y0) * 0.3
+            inner = [(x0 + dx, y0 + dy), (x1 - dx, y0 + dy), (x1 - dx, y1 - dy), (x0 + dx, y1 - dy), (x0 + dx, y0 + dy)]
+        tags = {"building": str(kinds[k])}
+        if tag_draw[k, 0] < 0.4:
+            tags["building:levels"] = str(levels[k])
+        if tag_draw[k, 1] < 0.15:
+            tags["height"] = f"{levels[k] * 3.2:.1f}"
+        if tag_draw[k, 2] < 0.1:
+            tags["name"] = f"Building {k}"
+        if tag_draw[k, 3] < 0.05:
+            tags["roof:shape"] = "gabled"
+        yield k, outer, inner, tags
+
+
+def _xml_tags(tags, indent):
+    return "".join(f'{indent}<tag k="{k}" v="{v}"/>\n' for k, v in tags.items())
+
+
+def _xml_bounds(ring, indent):
+    lons = [p[0] for p in ring]
+    lats = [p[1] for p in ring]
+    return f'{indent}<bounds minlat="{min(lats):.7f}" minlon="{min(lons):.7f}" maxlat="{max(lats):.7f}" maxlon="{max(lons):.7f}"/>\n'
+
+
+def _xml_geom(ring, indent):
+    return "".join(f'{indent}<nd lat="{lat:.7f}" lon="{lon:.7f}"/>\n' for lon, lat in ring)
+
+
+def write_synthetic_fixture(name, n, layout="geom", seed=1):
+    # Same shape as the Overpass answer to the `layout` full query, written in chunks so 1M ways
+    # never sit in memory as text.
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    osm_path, meta_path = fixture_paths(name)
+    header = ('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark">\n'
+              f'<note>Synthetic buildings for benchmarks.</note>\n<meta osm_base="{SYNTHETIC_OSM_BASE}"/>\n\n')
+    ways = relations = 0
+    t0 = time.perf_counter()
+    with open(osm_path + ".part", "w", encoding="utf-8") as f:
+        f.write(header)
+        chunk = []
+        if layout == "nodes":
+            # Nodes first (out skel qt), then the ways referencing them (.w out body).
+            node_id = 1000000000
+            way_refs = []
+            for k, outer, inner, tags in synthetic_footprints(n, seed):
+                refs = []
+                for lon, lat in outer[:-1]:
+                    chunk.append(f'  <node id="{node_id}" lat="{lat:.7f}" lon="{lon:.7f}"/>\n')
+                    refs.append(node_id)
+                    node_id += 1
+                way_refs.append((k, refs + refs[:1], tags))
+                if len(chunk) > 50000:
+                    f.write("".join(chunk))
+                    chunk = []
+            for k, refs, tags in way_refs:
+                chunk.append(f'  <way id="{100000000 + k}">\n' + "".join(f'    <nd ref="{r}"/>\n' for r in refs)
+                             + _xml_tags(tags, "    ") + "  </way>\n")
+                ways += 1
+                if len(chunk) > 10000:
+                    f.write("".join(chunk))
+                    chunk = []
+        else:
+            courtyards = []
+            for k, outer, inner, tags in synthetic_footprints(n, seed):
+                if inner is not None:
+                    courtyards.append((k, outer, inner, tags))
+                    continue
+                chunk.append(f'  <way id="{100000000 + k}">\n' + _xml_bounds(outer, "    ") + _xml_geom(outer, "    ")
+                             + _xml_tags(tags, "    ") + "  </way>\n")
+                ways += 1
+                if len(chunk) > 10000:
+                    f.write("".join(chunk))
+                    chunk = []
+            for k, outer, inner, tags in courtyards:
+                chunk.append(f'  <relation id="{10000000 + k}">\n' + _xml_bounds(outer, "    ")
+                             + f'    <member type="way" ref="{200000000 + 2 * k}" role="outer">\n' + _xml_geom(outer, "      ")
+                             + '    </member>\n'
+                             + f'    <member type="way" ref="{200000001 + 2 * k}" role="inner">\n' + _xml_geom(inner, "      ")
+                             + '    </member>\n' + _xml_tags({**tags, "type": "multipolygon"}, "    ") + "  </relation>\n")
+                relations += 1
+        f.write("".join(chunk))
+        f.write("\n</osm>\n")
+    os.replace(osm_path + ".part", osm_path)
+    side = int(math.ceil(math.sqrt(n)))
+    meta = {"source": "synthetic", "layout": layout, "center": list(SYNTHETIC_CENTER),
+            "d": round(side * SYNTHETIC_SPACING / 2 + SYNTHETIC_SPACING, 6), "ways": ways, "relations": relations,
+            "seed": seed}
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1)
+    print(f"Fixture {name}: {ways} ways, {relations} relations, {os.path.getsize(osm_path) / 1e6:.1f} MB "
+          f"in {time.perf_counter() - t0:.1f} s")
+
+
+def synthetic_fixture(size, layout="geom"):
+    name = f"synthetic_{size}_{layout}"
+    if not os.path.exists(fixture_paths(name)[1]):
+        write_synthetic_fixture(name, parse_size(size), layout)
+    return name
+
+
+def record_fixture(city, user_agent, d=0.02, layout="geom"):
+    # Saves the live Overpass answer for `city` (the viewer's full query over +-d degrees) as a fixture.
+    viewer = import_viewer()
+    headers = {'User-Agent': f'ICX Tools OSM Extraction ({user_agent})'}
+    lat, lon = viewer.geocode_nominatim(city, headers)
+    query = viewer.OVERPASS_QUERY_MODES[layout]["full"].format(bbox=f"{lat - d},{lon - d},{lat + d},{lon + d}")
+    name = re.sub(r"[^a-z0-9]+", "_", city.lower()).strip("_") + ("" if layout == "geom" else f"_{layout}")
+    osm_path, meta_path = fixture_paths(name)
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    with viewer.fetch_overpass(query, headers) as resp_ov:
+        with open(osm_path + ".part", "wb") as f:
+            shutil.copyfileobj(resp_ov.raw, f, 1 << 20)
+    os.replace(osm_path + ".part", osm_path)
+    counts = {"way": 0, "relation": 0}
+    with open(osm_path, "rb") as f:
+        for elem in viewer.iter_overpass_elements(f):
+            if elem[0] in ("way", "way_geom"):
+                counts["way"] += 1
+            elif elem[0] == "relation":
+                counts["relation"] += 1
+    meta = {"source": "overpass", "city": city, "layout": layout, "center": [lat, lon], "d": d,
+            "ways": counts["way"], "relations": counts["relation"], "recorded": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1)
+    print(f"Recorded fixture {name}: {meta['ways']} ways, {meta['relations']} relations, "
+          f"{os.path.getsize(osm_path) / 1e6:.1f} MB")
+    return name
+
+
+# --- STAND-IN SERVER ---
+class FixtureIndex:
+    # Byte spans and bounds of the ways/relations of a geom layout fixture, so bbox queries get the
+    # elements they intersect, like Overpass. Fixtures without <bounds> (nodes layout) are served whole.
+    ELEMENT_RE = re.compile(rb'<(way|relation) id="\d+"[^>]*>\s*<bounds minlat="([-\d.]+)" minlon="([-\d.]+)" '
+                            rb'maxlat="([-\d.]+)" maxlon="([-\d.]+)"/>')
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        spans, bounds = [], []
+        for m in self.ELEMENT_RE.finditer(self.data):
+            end = self.data.find(b"</" + m.group(1) + b">", m.end()) + len(m.group(1)) + 3
+            spans.append((m.start(), end))
+            bounds.append([float(v) for v in m.group(2, 3, 4, 5)])
+        self.spans = np.array(spans, dtype=np.int64).reshape(-1, 2)
+        self.bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        first = int(self.spans[0, 0]) if len(self.spans) else 0
+        self.header = bytes(self.data[:first])
+        self.footer = (self.data.rfind(b"</osm>"), len(self.data))
+        base = re.search(rb'osm_base="([^"]+)"', self.header)
+        self.osm_base = base.group(1).decode() if base else SYNTHETIC_OSM_BASE
+
+    def _hit(self, south, west, north, east):
+        b = self.bounds
+        return (b[:, 0] <= north) & (b[:, 2] >= south) & (b[:, 1] <= east) & (b[:, 3] >= west)
+
+    def select(self, south, west, north, east):
+        # Byte spans making up the answer for a bbox.
+        if not len(self.spans):
+            return [(0, len(self.data))]
+        return [(0, len(self.header))] + [tuple(s) for s in self.spans[self._hit(south, west, north, east)].tolist()] + [self.footer]
+
+    def count(self, south, west, north, east):
+        # Elements of a bbox, for `out count` queries (every way of a fixture served whole).
+        if not len(self.spans):
+            return sum(1 for _ in re.finditer(rb"<way ", self.data))
+        return int(self._hit(south, west, north, east).sum())
+
+    def chunks(self, spans, size=1 << 20):
+        out = []
+        pending = 0
+        for start, end in spans:
+            out.append(self.data[start:end])
+            pending += end - start
+            if pending >= size:
+                yield b"".join(out)
+                out, pending = [], 0
+        if out:
+            yield b"".join(out)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type="application/json"):
+        self.server.count(self.path, len(body))
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        lat, lon = self.server.center
+        if url.path == "/__stats":
+            return self._send(json.dumps(self.server.stats).encode())
+        if url.path == "/search":
+            return self._send(json.dumps([{
+                "lat": str(lat), "lon": str(lon), "display_name": query.get("q", [BENCHMARK_CITY])[0],
+                "boundingbox": [str(lat - 0.1), str(lat + 0.1), str(lon - 0.1), str(lon + 0.1)],
+                "address": {"city": BENCHMARK_CITY, "state": "Stand-in", "country": "Benchmark"}}]).encode())
+        if url.path == "/w/api.php" and query.get("action") == ["wbgetclaims"]:
+            claim = {"mainsnak": {"datavalue": {"value": {"amount": "+500000"}}}, "rank": "normal",
+                     "qualifiers": {"P585": [{"datavalue": {"value": {"time": "+2024-01-01T00:00:00Z"}}}]}}
+            return self._send(json.dumps({"claims": {"P1082": [claim]}}).encode())
+        if url.path == "/w/api.php":
+            return self._send(json.dumps({"search": [{"id": "Q1", "description": "city"}]}).encode())
+        if url.path == "/sparql":
+            items = re.findall(r"wd:(Q\d+)", query.get("query", [""])[0])
+            rows = [{"item": {"value": f"http://www.wikidata.org/entity/{q}"}, "population": {"value": "500000"},
+                     "rank": {"value": "http://wikiba.se/ontology#NormalRank"}} for q in items]
+            return self._send(json.dumps({"results": {"bindings": rows}}).encode())
+        if url.path == "/searchJSON":
+            return self._send(json.dumps({"geonames": [{"population": 500000}]}).encode())
+        if url.path == "/v1/forecast":
+            return self._send(json.dumps({"current_weather": {"temperature": 15.0, "windspeed": 10.0}}).encode())
+        if url.path.startswith("/tiles/"):
+            # Map tiles: a fixed size body naming the tile.
+            return self._send(url.path.encode().ljust(STAND_IN_TILE_BYTES, b"\0"), "image/png")
+        if url.path == "/":
+            return self._send(b"ok", "text/plain")
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        query = parse_qs(body).get("data", [body])[0]
+        index = self.server.index
+        if self.server.status != 200:
+            self.server.count(self.path, 0)
+            time.sleep(self.server.latency)
+            self.send_response(self.server.status)
+            self.send_header("Retry-After", "60")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if "[adiff:" in query or "newer:" in query:
+            # A fixture never changes: empty diffs.
+            return self._send(f'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n'
+                              f'<meta osm_base="{index.osm_base}"/>\n</osm>\n'.encode(), "application/osm3s+xml")
+        if "out count" in query:
+            counts = [index.count(*map(float, box.split(","))) for box in re.findall(r'way\["building"\]\(([^)]+)\)', query)]
+            return self._send(json.dumps({"elements": [
+                {"type": "count", "id": 0, "tags": {"nodes": "0", "ways": str(c), "relations": "0", "total": str(c)}}
+                for c in counts]}).encode())
+        bbox = re.search(r'way\["building"\]\(([^)]+)\)', query)
+        south, west, north, east = map(float, bbox.group(1).split(",")) if bbox else (-90, -180, 90, 180)
+        spans = index.select(south, west, north, east)
+        length = sum(end - start for start, end in spans)
+        self.server.count(self.path, length)
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/osm3s+xml")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        t0 = time.monotonic()
+        sent = 0
+        for chunk in index.chunks(spans):
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.server.bandwidth:
+                delay = sent / self.server.bandwidth - (time.monotonic() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fixture, port=0, latency_ms=0, bandwidth_mbps=0, status=200):
+        super().__init__(("127.0.0.1", port), StandInHandler)
+        self.status = status  # answer of every Overpass query, e.g. 429 for a mirror asking to back off
+        self.index = FixtureIndex(fixture["path"])
+        self.center = tuple(fixture["center"])
+        self.latency = latency_ms / 1000.0
+        self.bandwidth = bandwidth_mbps * 1e6 / 8
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, path, size):
+        name = urlsplit(path).path
+        with self.lock:
+            entry = self.stats.setdefault(name, [0, 0])
+            entry[0] += 1
+            entry[1] += size
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stand_in(fixture, latency_ms, bandwidth_mbps):
+    # The stand-in runs in its own process so its CPU and memory never count in a stage.
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--Serve", fixture["name"], "--Port", str(port),
+                             "--LatencyMs", str(latency_ms), "--BandwidthMbps", str(bandwidth_mbps)])
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc, url
+        except OSError:
+            if proc.poll() is not None:
+                raise Exception(f"Stand-in server for {fixture['name']} exited with code {proc.returncode}")
+            time.sleep(0.2)
+    proc.kill()
+    raise Exception("Stand-in server did not start")
+
+
+def check_mirrors(fetches=4, slow_ms=5000, fast_ms=50):
+    # OverpassMirrorPool against three stand-ins, listed worst first: one answering 429, a slow one
+    # and a fast one. The fast mirror must win every fetch (from the first one on, by hedging once
+    # the slow mirror passes the hedge delay) well before the slow mirror could answer.
+    viewer = import_viewer()
+    fixture = load_fixture(synthetic_fixture("10k"))
+    servers = [StandInServer(fixture, status=429), StandInServer(fixture, latency_ms=slow_ms),
+               StandInServer(fixture, latency_ms=fast_ms)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = [f"http://127.0.0.1:{server.server_address[1]}/api/interpreter" for server in servers]
+    pool = viewer.OverpassMirrorPool(urls)
+    lat, lon = fixture["center"]
+    query = viewer.OVERPASS_GEOM_BUILDINGS_QUERY.format(bbox=f"{lat},{lon},{lat + 0.002},{lon + 0.002}")
+    ok = True
+    for k in range(fetches):
+        t0 = time.monotonic()
+        resp = pool.fetch(query, {})
+        resp.content
+        resp.close()
+        elapsed = time.monotonic() - t0
+        winner = ("429", "slow", "fast")[urls.index(resp.url)]
+        ok = ok and winner == "fast" and elapsed < slow_ms / 1000.0 / 2
+        print(f"  fetch {k + 1}: {winner} mirror in {elapsed:.2f} s")
+    for server in servers:
+        server.shutdown()
+    print("Mirror racing: " + ("ok" if ok else "FAILED, the fast mirror must win every fetch"))
+    return ok
+
+
+def check_tile_proxy(max_tiles=3, max_age=1.0):
+    # TileProxy in front of a stand-in tile server: a first request is a miss fetched upstream, the
+    # second a hit served from the TileStore, and evict() keeps the most recently used tiles under the
+    # size cap and drops the tiles older than max_age.
+    viewer = import_viewer()
+    import requests
+    server = StandInServer(load_fixture(synthetic_fixture("10k")))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream = f"http://127.0.0.1:{server.server_address[1]}/tiles/{{z}}/{{x}}/{{y}}.png"
+    work_dir = tempfile.mkdtemp(prefix="bench_tile_proxy_")
+    proxy = viewer.TileProxy(os.path.join(work_dir, "tiles.mbtiles"), {"satellite": upstream},
+                             max_bytes=max_tiles * STAND_IN_TILE_BYTES)
+    url = proxy.start()
+    failures = []
+
+    def check(name, condition):
+        print(f"  {name}: {'ok' if condition else 'FAILED'}")
+        if not condition:
+            failures.append(name)
+
+    def upstream_count():
+        with server.lock:
+            return sum(n for path, (n, _) in server.stats.items() if path.startswith("/tiles/"))
+
+    def get(z, x, y):
+        resp = requests.get(f"{url}/satellite/{z}/{x}/{y}.png", timeout=10)
+        return resp.status_code == 200 and resp.content.startswith(f"/tiles/{z}/{x}/{y}.png".encode())
+
+    try:
+        check("miss fetched upstream", get(14, 0, 0) and upstream_count() == 1 and proxy.stats()["misses"] == 1)
+        check("hit served from the store", get(14, 0, 0) and upstream_count() == 1 and proxy.stats()["hits"] == 1)
+        for x in range(1, max_tiles + 2):
+            get(14, x, 0)
+        get(14, 0, 0)
+        proxy.store.evict()
+        kept = {x for (x,) in proxy.store.db.execute("SELECT tile_column FROM tiles").fetchall()}
+        check("size eviction keeps the most recently used tiles",
+              len(kept) == max_tiles and 0 in kept and max_tiles + 1 in kept)
+        proxy.store.max_age = max_age
+        time.sleep(max_age + 0.1)
+        before = upstream_count()
+        check("expired tile fetched again", get(14, 0, 0) and upstream_count() == before + 1)
+        check("age eviction drops the expired tiles", proxy.store.evict() == max_tiles - 1)
+        stats = proxy.stats()
+        check("counters", stats == {"hits": 2, "misses": max_tiles + 3, "errors": 0})
+    finally:
+        proxy.stop()
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print("Tile proxy: " + ("ok" if not failures else f"FAILED ({', '.join(failures)})"))
+    return not failures
+
+
+def stand_in_stats(url):
+    import requests
+    return requests.get(f"{url}/__stats", timeout=10).json()
+
+
+# --- STAGES ---
+def import_viewer():
+    sys.path.insert(0, ROOT)
+    import WebViewMapTilerCache11 as viewer
+    return viewer
+
+
+def point_viewer_at(viewer, url):
+    viewer.ENDPOINTS.update({name: url for name in viewer.ENDPOINTS})
+    viewer.overpass_mirrors = viewer.OverpassMirrorPool([f"{url}/api/interpreter"])
+    # The code is measured, not the politeness delays.
+    viewer.rate_limiter.configure({name: (0, 1) for name in viewer.DEFAULT_RATE_LIMITS})
+
+
+class CountingSink:
+    # write_polygons sink that only counts, to time parsing and assembly alone.
+    def __init__(self):
+        self.count = 0
+
+    def write_polygons(self, coords, ring_offsets, way_ids, properties, ring_exterior=None, feature_rings=None):
+        self.count += len(way_ids)
+
+
+def run_stage(stage, fixture, url, work_dir):
+    # Runs one stage in this process; returns its measurements.
+    if stage.startswith("startup_"):
+        return run_startup(fixture, url, work_dir, warm=stage == "startup_warm")
+    viewer = import_viewer()
+    point_viewer_at(viewer, url)
+    keep_tags = viewer.VIEWER_KEEP_TAGS
+    queries = viewer.OVERPASS_QUERY_MODES[fixture["layout"]]
+    lat, lon = fixture["center"]
+    d = fixture["d"]
+    result = {}
+    cache_dir = os.path.join(work_dir, "osm_tiles")
+    if stage == "export_cold":
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    stats_before = stand_in_stats(url) if stage in ("download", "export_cold", "export_warm") else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    if stage == "download":
+        headers = {'User-Agent': 'ICX Tools OSM Extraction (benchmark)'}
+        query = queries["full"].format(bbox=f"{lat - d},{lon - d},{lat + d},{lon + d}")
+        size = 0
+        with viewer.fetch_overpass(query, headers) as resp_ov:
+            for chunk in iter(lambda: resp_ov.raw.read(1 << 16), b""):
+                size += len(chunk)
+        result["bytes"] = size
+    elif stage == "parse":
+        count = 0
+        with open(fixture["path"], "rb") as f:
+            for _ in viewer.iter_overpass_elements(f):
+                count += 1
+        result["elements"] = count
+    elif stage == "join":
+        sink = CountingSink()
+        with open(fixture["path"], "rb") as f:
+            viewer.write_osm_building_features(viewer.iter_overpass_elements(f), sink, keep_tags=keep_tags)
+        result["features"] = sink.count
+    elif stage == "serialize_geojson":
+        output = os.path.join(work_dir, "buildings.geojson")
+        with open(fixture["path"], "rb") as f:
+            with viewer.GeoJSONFeatureWriter(output) as writer:
+                result["features"] = viewer.write_osm_building_features(viewer.iter_overpass_elements(f), writer,
+                                                                         keep_tags=keep_tags)
+        result["output_bytes"] = os.path.getsize(output)
+    elif stage == "serialize_store":
+        cache = viewer.BuildingTileCache(os.path.join(work_dir, "store_tiles"))
+        tiles = cache.tiles_for_bbox(lat - d, lon - d, lat + d, lon + d)
+        writers = {t: viewer.BuildingStoreWriter(cache.new_tile_path(t, "benchmark")) for t in tiles}
+        with open(fixture["path"], "rb") as f:
+            viewer.write_osm_building_features(viewer.iter_overpass_elements(f),
+                                               viewer.TileFeatureRouter(cache.zoom, writers), keep_tags=keep_tags)
+        for writer in writers.values():
+            writer.close()
+        result["features"] = sum(w.count for w in writers.values())
+        result["tiles"] = len(writers)
+        result["output_bytes"] = sum(os.path.getsize(w.path) for w in writers.values())
+    elif stage in ("export_cold", "export_warm"):
+        cache = viewer.BuildingTileCache(cache_dir)
+        viewer.export_osm_buildings("benchmark", city=BENCHMARK_CITY, output=None, d=d, cache=cache, center=(lat, lon),
+                                    keep_tags=keep_tags, overpass_mode=fixture["layout"])
+        result["tiles"] = len(cache.tiles)
+        result["features"] = sum(e["count"] for e in cache.tiles.values())
+    else:
+        raise Exception(f"Unknown stage {stage}")
+    result["seconds"] = round(time.perf_counter() - wall, 4)
+    result["cpu_seconds"] = round(time.process_time() - cpu, 4)
+    if stats_before is not None:
+        stats = stand_in_stats(url)
+        before, after = stats_before.get("/api/interpreter", [0, 0]), stats.get("/api/interpreter", [0, 0])
+        result["overpass_requests"] = after[0] - before[0]
+        result["overpass_bytes"] = after[1] - before[1]
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run_startup(fixture, url, work_dir, warm):
+    # The viewer itself, pointed at the stand-in; its StartupTimer breakdown comes back through
+    # --StartupReport and, the viewer being this process' only child, RUSAGE_CHILDREN is its peak. Without a display pywebview cannot open the window: the report then stops at
+    # "html" (window_shown false).
+    path = os.path.join(work_dir, "viewer")
+    if not warm:
+        shutil.rmtree(path, ignore_errors=True)
+    report_path = os.path.join(work_dir, "startup.json")
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    upstreams = ("nominatim", "wikidata", "wikidata-sparql", "geonames", "open-meteo", "connectivity")
+    endpoints = ",".join(f"{name}={url}" for name in upstreams)
+    rate_limits = ",".join(f"{name}=0" for name in ("nominatim", "overpass", "wikidata", "geonames", "open-meteo"))
+    cmd = [sys.executable, VIEWER, "--Path", path, "--City", BENCHMARK_CITY, "--API_USER_AGENT", "benchmark",
+           "--Endpoints", endpoints, "--OverpassMirrors", f"{url}/api/interpreter", "--RateLimits", rate_limits,
+           "--OverpassMode", fixture["layout"], "--ViewportWorkers", "0",
+           "--StartupReport", report_path, "--ExitAfterStartup"]
+    wall = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=3600)
+    result = {"seconds": round(time.perf_counter() - wall, 4), "exit_code": proc.returncode,
+              "peak_rss_mb": child_peak_rss_mb()}
+    if os.path.exists(report_path):
+        with open(report_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        result.update(startup_ms=report["total_ms"], phases_ms=report["phases_ms"], window_shown=report.get("window_shown"))
+    else:
+        result["error"] = (proc.stdout + proc.stderr)[-2000:]
+    return result
+
+
+def run_stage_process(stage, fixture, url, work_dir):
+    cmd = [sys.executable, os.path.abspath(__file__), "--Stage", stage, "--Fixture", fixture["name"],
+           "--Server", url, "--WorkDir", work_dir]
+    proc = subprocess.run(cmd, capture_output=True, text=True, timeout=7200)
+    lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+    if proc.returncode != 0 or not lines:
+        return {"error": (proc.stdout + proc.stderr)[-2000:]}
+    return json.loads(lines[-1])
+
+
+def best_of(runs):
+    # Fastest run, with the largest peak memory seen over all runs.
+    ok = [r for r in runs if "error" not in r]
+    if not ok:
+        return dict(runs[-1])
+    best = dict(min(ok, key=lambda r: r["seconds"]))
+    rss = [r["peak_rss_mb"] for r in ok if r.get("peak_rss_mb") is not None]
+    best["peak_rss_mb"] = max(rss) if rss else None
+    best["runs_seconds"] = [r["seconds"] for r in ok]
+    return best
+
+
+def benchmark_fixture(fixture, stages, repeat, latency_ms, bandwidth_mbps, baseline_rss):
+    print(f"== {fixture['name']}: {fixture['ways']} ways, {fixture['relations']} relations, "
+          f"{fixture['bytes'] / 1e6:.1f} MB ({fixture['layout']})")
+    proc, url = start_stand_in(fixture, latency_ms, bandwidth_mbps)
+    work_dir = tempfile.mkdtemp(prefix=f"bench_{fixture['name']}_")
+    results = {}
+    try:
+        for stage in stages:
+            runs = [run_stage_process(stage, fixture, url, work_dir) for _ in range(repeat)]
+            result = best_of(runs)
+            if result.get("peak_rss_mb") is not None and baseline_rss is not None:
+                result["peak_rss_over_baseline_mb"] = round(result["peak_rss_mb"] - baseline_rss, 1)
+            results[stage] = result
+            shown = f"{result['seconds']:.3f} s" if "seconds" in result else "failed"
+            print(f"  {stage:<18} {shown:>12}  peak {result.get('peak_rss_mb')} MB"
+                  + (f"  ({result['error'].strip().splitlines()[-1]})" if "error" in result else ""))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    # Stage costs on their own (the stages above are cumulative).
+    def seconds(stage):
+        return results.get(stage, {}).get("seconds")
+    derived = {}
+    if seconds("join") is not None and seconds("parse") is not None:
+        derived["join_only"] = round(seconds("join") - seconds("parse"), 4)
+    for stage in ("serialize_geojson", "serialize_store"):
+        if seconds(stage) is not None and seconds("join") is not None:
+            derived[f"{stage}_only"] = round(seconds(stage) - seconds("join"), 4)
+    return results, derived
+
+
+def baseline_rss_mb():
+    # Peak RSS of a process that only imports the viewer, to subtract from the stages.
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--Baseline"], capture_output=True, text=True)
+    try:
+        return json.loads(proc.stdout.strip().splitlines()[-1])["peak_rss_mb"]
+    except Exception:
+        return None
+
+
+def compare(old_path, new_path, threshold=0.10):
+    # Per fixture and stage: time and peak memory of new vs old. Returns the regressions.
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{old.get('version')} -> {new.get('version')}")
+    regressions = []
+    for name, fixture in new["fixtures"].items():
+        before = old.get("fixtures", {}).get(name)
+        if not before:
+            continue
+        print(f"== {name}")
+        for stage, result in fixture["stages"].items():
+            prev = before["stages"].get(stage)
+            if not prev or "seconds" not in prev or "seconds" not in result:
+                continue
+            ratio = result["seconds"] / prev["seconds"] if prev["seconds"] else float("inf")
+            mem = ""
+            if result.get("peak_rss_mb") and prev.get("peak_rss_mb"):
+                mem = f"  peak {prev['peak_rss_mb']} -> {result['peak_rss_mb']} MB"
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions.append((name, stage, ratio))
+            print(f"  {stage:<18} {prev['seconds']:9.3f} -> {result['seconds']:9.3f} s  x{ratio:.2f}{mem}{flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks of the building extraction and viewer startup.")
+    parser.add_argument('--Sizes', type=str, default='10k,100k,1M', help="Synthetic fixture sizes in ways ('' = none).")
+    parser.add_argument('--Layouts', type=str, default='geom', help="Synthetic Overpass layouts: 'geom', 'nodes' or both.")
+    parser.add_argument('--Fixtures', type=str, default='', help='Recorded fixtures to benchmark too (names in benchmarks/fixtures).')
+    parser.add_argument('--Stages', type=str, default=",".join(STAGES + STARTUP_STAGES), help='Comma separated stages to run.')
+    parser.add_argument('--Repeat', type=int, default=1, help='Runs per stage; the fastest is kept.')
+    parser.add_argument('--LatencyMs', type=float, default=50, help='Stand-in latency before every response.')
+    parser.add_argument('--BandwidthMbps', type=float, default=0, help='Stand-in Overpass transfer rate (0 = unlimited).')
+    parser.add_argument('--Output', type=str, default='', help='Results JSON (default: benchmarks/results/<time>.json).')
+    parser.add_argument('--Record', type=str, default='', help='Record the live Overpass answer for this city as a fixture.')
+    parser.add_argument('--RecordRadius', type=float, default=0.02, help='Half size in degrees of the recorded box.')
+    parser.add_argument('--API_USER_AGENT', type=str, default='', help='User agent for --Record.')
+    parser.add_argument('--Compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two results files.')
+    parser.add_argument('--CheckMirrors', action='store_true', help='Check that the fastest Overpass mirror wins against slow and failing stand-ins.')
+    parser.add_argument('--CheckTileProxy', action='store_true', help='Check the TileProxy hits, misses and eviction against a stand-in tile server.')
+    parser.add_argument('--Threshold', type=float, default=0.10, help='Slowdown reported as a regression by --Compare.')
+    # Internal: stand-in server and single stage processes.
+    parser.add_argument('--Serve', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--Port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--Stage', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--Fixture', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--Server', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--WorkDir', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--Baseline', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.Compare:
+        sys.exit(1 if compare(*args.Compare, threshold=args.Threshold) else 0)
+    if args.CheckMirrors:
+        sys.exit(0 if check_mirrors() else 1)
+    if args.CheckTileProxy:
+        sys.exit(0 if check_tile_proxy() else 1)
+    if args.Baseline:
+        import_viewer()
+        print(json.dumps({"peak_rss_mb": peak_rss_mb()}))
+        sys.exit(0)
+    if args.Serve:
+        server = StandInServer(load_fixture(args.Serve), port=args.Port, latency_ms=args.LatencyMs,
+                               bandwidth_mbps=args.BandwidthMbps)
+        server.serve_forever()
+    if args.Stage:
+        print(json.dumps(run_stage(args.Stage, load_fixture(args.Fixture), args.Server, args.WorkDir)))
+        sys.exit(0)
+    if args.Record:
+        record_fixture(args.Record, args.API_USER_AGENT, d=args.RecordRadius)
+        sys.exit(0)
+
+    stages = [s.strip() for s in args.Stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES + STARTUP_STAGES]
+    if unknown:
+        raise Exception(f"Unknown stages: {', '.join(unknown)}")
+    names = [synthetic_fixture(size.strip(), layout.strip()) for size in args.Sizes.split(",") if size.strip()
+             for layout in args.Layouts.split(",") if layout.strip()]
+    names += [n.strip() for n in args.Fixtures.split(",") if n.strip()]
+    baseline = baseline_rss_mb()
+    report = {
+        "version": git_version(), "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"latency_ms": args.LatencyMs, "bandwidth_mbps": args.BandwidthMbps, "repeat": args.Repeat,
+                     "rate_limits": "off"},
+        "baseline_rss_mb": baseline, "fixtures": {}
+    }
+    for name in names:
+        fixture = load_fixture(name)
+        stage_results, derived = benchmark_fixture(fixture, stages, args.Repeat, args.LatencyMs, args.BandwidthMbps, baseline)
+        report["fixtures"][name] = {
+            "source": fixture.get("source"), "layout": fixture["layout"], "ways": fixture["ways"],
+            "relations": fixture["relations"], "bytes": fixture["bytes"], "center": fixture["center"], "d": fixture["d"],
+            "stages": stage_results, "derived_seconds": derived
+        }
+    output = args.Output or os.path.join(RESULT_DIR, time.strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved to {output}")